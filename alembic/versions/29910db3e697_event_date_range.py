@@ -0,0 +1,133 @@
+"""event date range
+
+Revision ID: 29910db3e697
+Revises: 45ab52b835e8
+Create Date: 2026-10-17 13:05:47.662390
+
+"""
+import re
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '29910db3e697'
+down_revision: Union[str, None] = '45ab52b835e8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Строк в одном executemany при заполнении диапазонов
+BATCH_SIZE = 1000
+
+
+# Копия app.utils.date_parser на момент миграции: миграция не должна
+# зависеть от кода приложения, который будет меняться дальше
+_MONTHS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'мая': 5, 'май': 5,
+    'июн': 6, 'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12,
+}
+_ISO_DATE_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+_NUMERIC_DATE_RE = re.compile(r'\b(\d{1,2})\.(\d{1,2})(?:\.(\d{4}|\d{2}))?\b')
+_TEXT_DATE_RE = re.compile(r'(\d{1,2})(?:\s*[-–—]\s*(\d{1,2}))?\s+([а-яё]+)(?:\s+(\d{4}))?', re.IGNORECASE)
+_YEAR_ROLLOVER = timedelta(days=183)
+
+
+def _make_date(year: Optional[int], month: int, day: int, reference: date) -> Optional[date]:
+    try:
+        if year is not None:
+            if year < 100:
+                year += 2000
+            return date(year, month, day)
+        value = date(reference.year, month, day)
+        if value < reference - _YEAR_ROLLOVER:
+            value = date(reference.year + 1, month, day)
+        return value
+    except ValueError:
+        return None
+
+
+def _parse_date_string(value: str, reference: date) -> list:
+    result = []
+
+    iso_matches = _ISO_DATE_RE.findall(value)
+    for year, month, day in iso_matches:
+        parsed = _make_date(int(year), int(month), int(day), reference)
+        if parsed:
+            result.append(parsed)
+    if iso_matches:
+        return result
+
+    for day_from, day_to, month_name, year in _TEXT_DATE_RE.findall(value):
+        month = _MONTHS.get(month_name.lower()[:3])
+        if not month:
+            continue
+        year = int(year) if year else None
+        for day in filter(None, (day_from, day_to)):
+            parsed = _make_date(year, month, int(day), reference)
+            if parsed:
+                result.append(parsed)
+    if result:
+        return result
+
+    for day, month, year in _NUMERIC_DATE_RE.findall(value):
+        parsed = _make_date(int(year) if year else None, int(month), int(day), reference)
+        if parsed:
+            result.append(parsed)
+    return result
+
+
+def _parse_event_dates(dates, reference: Optional[datetime] = None):
+    reference_date = (reference or datetime.now()).date()
+    parsed = []
+    for value in dates or []:
+        if value:
+            parsed.extend(_parse_date_string(str(value), reference_date))
+    if not parsed:
+        return None, None
+    return datetime.combine(min(parsed), time.min), datetime.combine(max(parsed), time.max)
+
+
+def upgrade() -> None:
+    op.add_column('events', sa.Column('starts_at', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('events', sa.Column('ends_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(op.f('ix_events_starts_at'), 'events', ['starts_at'], unique=False)
+    op.create_index(op.f('ix_events_ends_at'), 'events', ['ends_at'], unique=False)
+
+    # Заполняем диапазоны для существующих событий; год без явного указания
+    # считается относительно даты загрузки события
+    events = sa.table(
+        'events',
+        sa.column('id', sa.Integer),
+        sa.column('dates', sa.JSON),
+        sa.column('created_at', sa.DateTime(timezone=True)),
+        sa.column('starts_at', sa.DateTime(timezone=True)),
+        sa.column('ends_at', sa.DateTime(timezone=True)),
+    )
+    update = (
+        events.update()
+        .where(events.c.id == sa.bindparam('event_id'))
+        .values(starts_at=sa.bindparam('range_start'), ends_at=sa.bindparam('range_end'))
+    )
+    bind = op.get_bind()
+    rows = bind.execute(sa.select(events.c.id, events.c.dates, events.c.created_at)).fetchall()
+    batch = []
+    for event_id, dates, created_at in rows:
+        starts_at, ends_at = _parse_event_dates(dates, reference=created_at)
+        if starts_at is None:
+            continue
+        batch.append({'event_id': event_id, 'range_start': starts_at, 'range_end': ends_at})
+        if len(batch) >= BATCH_SIZE:
+            bind.execute(update, batch)
+            batch = []
+    if batch:
+        bind.execute(update, batch)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_events_ends_at'), table_name='events')
+    op.drop_index(op.f('ix_events_starts_at'), table_name='events')
+    op.drop_column('events', 'ends_at')
+    op.drop_column('events', 'starts_at')
@@ -0,0 +1,56 @@
+"""event city bucket
+
+Revision ID: 45ab52b835e8
+Revises: a3e315298f2b
+Create Date: 2026-10-17 11:40:05.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '45ab52b835e8'
+down_revision: Union[str, None] = 'a3e315298f2b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MAIN_CITIES = ['Подгорица', 'Будва', 'Херцег-Нови', 'Тиват', 'Бар']
+OTHER_CITIES = 'Другие города'
+
+
+def upgrade() -> None:
+    cities = op.create_table('cities',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_index(op.f('ix_cities_id'), 'cities', ['id'], unique=False)
+    op.bulk_insert(cities, [{'name': name} for name in MAIN_CITIES])
+
+    op.add_column('events', sa.Column('city_bucket', sa.String(), nullable=True))
+    op.create_index('ix_events_city_bucket_created_at', 'events', ['city_bucket', 'created_at'], unique=False)
+
+    # Заполняем корзины для существующих событий
+    events = sa.table('events', sa.column('city', sa.String), sa.column('city_bucket', sa.String))
+    city = sa.func.trim(events.c.city)
+    op.execute(
+        events.update()
+        .where(city.in_(MAIN_CITIES))
+        .values(city_bucket=city)
+    )
+    op.execute(
+        events.update()
+        .where(events.c.city.isnot(None), city.notin_(MAIN_CITIES))
+        .values(city_bucket=OTHER_CITIES)
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_events_city_bucket_created_at', table_name='events')
+    op.drop_column('events', 'city_bucket')
+    op.drop_index(op.f('ix_cities_id'), table_name='cities')
+    op.drop_table('cities')
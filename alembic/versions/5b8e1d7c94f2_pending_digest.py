@@ -0,0 +1,65 @@
+"""pending digest
+
+Revision ID: 5b8e1d7c94f2
+Revises: 2c4ae92d70a5
+Create Date: 2026-10-17 15:02:44.118350
+
+"""
+from datetime import datetime, time
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8e1d7c94f2'
+down_revision: Union[str, None] = '2c4ae92d70a5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    pending_digest = op.create_table('pending_digest',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('event_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['event_id'], ['events.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'event_id')
+    )
+
+    # Заполняем очередь текущими предстоящими совпадениями, которые ещё не доставлены,
+    # чтобы первая рассылка в режиме дайджеста не потеряла уже загруженные события
+    users = sa.table('users', sa.column('id', sa.Integer), sa.column('is_subscribed', sa.Boolean))
+    events = sa.table('events', sa.column('id', sa.Integer), sa.column('city_bucket', sa.String), sa.column('ends_at', sa.DateTime))
+    user_categories = sa.table('user_categories', sa.column('user_id', sa.Integer), sa.column('category', sa.String))
+    user_cities = sa.table('user_cities', sa.column('user_id', sa.Integer), sa.column('city', sa.String))
+    event_categories = sa.table('event_categories', sa.column('event_id', sa.Integer), sa.column('category', sa.String))
+    delivered_events = sa.table('delivered_events', sa.column('user_id', sa.Integer), sa.column('event_id', sa.Integer))
+
+    since = datetime.combine(datetime.now().date(), time.min)
+    matches = sa.select(user_categories.c.user_id, event_categories.c.event_id).select_from(user_categories).join(
+        event_categories, event_categories.c.category == user_categories.c.category
+    ).join(
+        events, events.c.id == event_categories.c.event_id
+    ).join(
+        user_cities, sa.and_(
+            user_cities.c.user_id == user_categories.c.user_id,
+            user_cities.c.city == events.c.city_bucket
+        )
+    ).join(
+        users, users.c.id == user_categories.c.user_id
+    ).where(
+        users.c.is_subscribed == sa.true(),
+        sa.or_(events.c.ends_at.is_(None), events.c.ends_at >= since),
+        ~sa.exists().where(sa.and_(
+            delivered_events.c.user_id == user_categories.c.user_id,
+            delivered_events.c.event_id == event_categories.c.event_id
+        ))
+    ).distinct()
+    op.execute(pending_digest.insert().from_select(['user_id', 'event_id'], matches))
+
+
+def downgrade() -> None:
+    op.drop_table('pending_digest')
@@ -0,0 +1,46 @@
+"""event categories
+
+Revision ID: a3e315298f2b
+Revises: 8ff71f86a081
+Create Date: 2026-10-17 10:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3e315298f2b'
+down_revision: Union[str, None] = '8ff71f86a081'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    event_categories = op.create_table('event_categories',
+    sa.Column('event_id', sa.Integer(), nullable=False),
+    sa.Column('category', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['event_id'], ['events.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('event_id', 'category')
+    )
+    op.create_index(op.f('ix_event_categories_category'), 'event_categories', ['category'], unique=False)
+
+    # Заполняем таблицу из существующих строк events.category (разделитель ;)
+    events = sa.table('events', sa.column('id', sa.Integer), sa.column('category', sa.String))
+    rows = []
+    for event_id, category in op.get_bind().execute(sa.select(events.c.id, events.c.category)):
+        seen = set()
+        for item in (category or '').split(';'):
+            item = item.strip()
+            if item and item not in seen:
+                seen.add(item)
+                rows.append({'event_id': event_id, 'category': item})
+    if rows:
+        op.bulk_insert(event_categories, rows)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_event_categories_category'), table_name='event_categories')
+    op.drop_table('event_categories')
@@ -11,6 +11,16 @@ class Settings:
     # Postmark configuration
     POSTMARK_API_TOKEN: str = os.getenv("POSTMARK_API_TOKEN", "your-api-token-here")
     POSTMARK_SENDER_EMAIL: str = os.getenv("POSTMARK_SENDER_EMAIL", "noreply@my-events.com")
+    POSTMARK_API_URL: str = os.getenv("POSTMARK_API_URL", "https://api.postmarkapp.com")
+    # HTTP-клиент Postmark: размер пула keep-alive соединений и таймауты (сек).
+    # Повторов на уровне клиента нет — см. EMAIL_MAX_ATTEMPTS
+    POSTMARK_POOL_SIZE: int = int(os.getenv("POSTMARK_POOL_SIZE", "16"))
+    POSTMARK_KEEP_ALIVE: bool = os.getenv("POSTMARK_KEEP_ALIVE", "true").lower() == "true"
+    POSTMARK_CONNECT_TIMEOUT: float = float(os.getenv("POSTMARK_CONNECT_TIMEOUT", "5"))
+    POSTMARK_READ_TIMEOUT: float = float(os.getenv("POSTMARK_READ_TIMEOUT", "30"))
+    # Общий лимит скорости отправки (писем в секунду, 0 — без ограничения) и размер всплеска
+    EMAIL_RATE_PER_SECOND: float = float(os.getenv("EMAIL_RATE_PER_SECOND", "50"))
+    EMAIL_RATE_BURST: int = int(os.getenv("EMAIL_RATE_BURST", "100"))
     
     # Database
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
@@ -20,6 +30,60 @@ class Settings:
     ALGORITHM: str = os.getenv("ALGORITHM", "HS256")
     ACCESS_TOKEN_EXPIRE_MINUTES: int = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
     
+    # Размер пачки пользователей для пакетного подбора событий
+    MATCH_CHUNK_SIZE: int = int(os.getenv("MATCH_CHUNK_SIZE", "1000"))
+    # Движок подбора для рассылки всем: "index" (множества) или "bitmask" (NumPy)
+    MATCH_ENGINE: str = os.getenv("MATCH_ENGINE", "index")
+    # Кэш результатов подбора: лимиты по числу записей и хранимых id событий,
+    # необязательный файл для сохранения между перезапусками
+    MATCH_CACHE_MAX_ENTRIES: int = int(os.getenv("MATCH_CACHE_MAX_ENTRIES", "10000"))
+    MATCH_CACHE_MAX_EVENT_IDS: int = int(os.getenv("MATCH_CACHE_MAX_EVENT_IDS", "1000000"))
+    MATCH_CACHE_PATH: str = os.getenv("MATCH_CACHE_PATH", "")
+    # Плановые рассылки отправляют накопленный дайджест (pending_digest) вместо полного подбора
+    DIGEST_MODE: bool = os.getenv("DIGEST_MODE", "false").lower() == "true"
+
+    # Конвейер рассылки: число потоков отправки и лимит писем в обработке
+    CAMPAIGN_SEND_WORKERS: int = int(os.getenv("CAMPAIGN_SEND_WORKERS", "8"))
+    CAMPAIGN_MAX_IN_FLIGHT: int = int(os.getenv("CAMPAIGN_MAX_IN_FLIGHT", "32"))
+    # Повторы неудачных отправок в конвейере: число попыток на письмо и
+    # экспоненциальная задержка с разбросом (база и потолок, в секундах)
+    EMAIL_MAX_ATTEMPTS: int = int(os.getenv("EMAIL_MAX_ATTEMPTS", "4"))
+    EMAIL_RETRY_BASE_SECONDS: float = float(os.getenv("EMAIL_RETRY_BASE_SECONDS", "2"))
+    EMAIL_RETRY_MAX_SECONDS: float = float(os.getenv("EMAIL_RETRY_MAX_SECONDS", "60"))
+    # Аренда кампании и её писем outbox запуском (сек): кампания или письмо
+    # в sending без продления дольше этого срока считаются брошенными
+    # и достаются следующему запуску
+    OUTBOX_LEASE_SECONDS: int = int(os.getenv("OUTBOX_LEASE_SECONDS", "600"))
+    # Незавершённая кампания старше этого срока (часы) не продолжается, а закрывается
+    NEWSLETTER_CAMPAIGN_MAX_AGE_HOURS: int = int(os.getenv("NEWSLETTER_CAMPAIGN_MAX_AGE_HOURS", "24"))
+    # Число процессов-шардов для рассылки всем подписчикам (1 — в текущем процессе)
+    NEWSLETTER_SHARDS: int = int(os.getenv("NEWSLETTER_SHARDS", "1"))
+    # Транспорт рассылки: "sync" (пул потоков) или "async" (asyncio + httpx)
+    EMAIL_TRANSPORT: str = os.getenv("EMAIL_TRANSPORT", "sync")
+    CAMPAIGN_ASYNC_MAX_IN_FLIGHT: int = int(os.getenv("CAMPAIGN_ASYNC_MAX_IN_FLIGHT", "200"))
+    # Пакетная отправка через /email/batch: размер пакета (0 — по одному письму)
+    # и максимальное время ожидания неполного пакета в секундах
+    EMAIL_BATCH_SIZE: int = int(os.getenv("EMAIL_BATCH_SIZE", "0"))
+    EMAIL_BATCH_FLUSH_SECONDS: float = float(os.getenv("EMAIL_BATCH_FLUSH_SECONDS", "1.0"))
+
+    # Шаблоны: автоперезагрузка изменённых файлов (только для разработки),
+    # кэш байткода на диске и каталог заранее скомпилированных шаблонов писем
+    TEMPLATES_AUTO_RELOAD: bool = os.getenv("TEMPLATES_AUTO_RELOAD", "false").lower() == "true"
+    TEMPLATES_BYTECODE_CACHE: bool = os.getenv("TEMPLATES_BYTECODE_CACHE", "true").lower() == "true"
+    TEMPLATES_BYTECODE_CACHE_DIR: str = os.getenv("TEMPLATES_BYTECODE_CACHE_DIR", "")
+    EMAIL_TEMPLATES_COMPILED_DIR: str = os.getenv("EMAIL_TEMPLATES_COMPILED_DIR", "")
+    # Минификация HTML-шаблонов писем при загрузке (отступы и комментарии)
+    EMAIL_TEMPLATES_MINIFY: bool = os.getenv("EMAIL_TEMPLATES_MINIFY", "true").lower() == "true"
+    # Кэш рендеринга писем по набору событий в пределах кампании (0 — рендерить каждое письмо целиком)
+    RENDER_CACHE_MAX_ENTRIES: int = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", "1024"))
+    # Кэш HTML-карточек событий по (id, updated_at) в пределах кампании
+    FRAGMENT_CACHE_MAX_ENTRIES: int = int(os.getenv("FRAGMENT_CACHE_MAX_ENTRIES", "4096"))
+    # Рендеринг писем в пуле процессов: число процессов (0 — в текущем процессе),
+    # писем в пачке на процесс и минимальный размер кампании, с которого запускается пул
+    RENDER_WORKERS: int = int(os.getenv("RENDER_WORKERS", "0"))
+    RENDER_CHUNK_SIZE: int = int(os.getenv("RENDER_CHUNK_SIZE", "50"))
+    RENDER_POOL_MIN_JOBS: int = int(os.getenv("RENDER_POOL_MIN_JOBS", "2000"))
+
     EMAIL_TEST_MODE: bool = os.getenv("EMAIL_TEST_MODE", "false").lower() == "true"
 
 settings = Settings()
@@ -1,6 +1,7 @@
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import Table, create_engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -14,6 +15,31 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+def insert_ignore(db, table: Table, rows: list):
+    """
+    INSERT строк, пропускающий строки с уже существующим ключом
+    (ON CONFLICT DO NOTHING) — для таблиц-связей, куда одна и та же пара
+    может прийти из разных путей (рассылка, дайджест, повтор).
+    """
+    if not rows:
+        return
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        # Без ON CONFLICT: каждая строка вставляется в своей точке сохранения,
+        # строка с существующим ключом откатывается и пропускается
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(table.insert(), row)
+            except IntegrityError:
+                pass
+        return
+    db.execute(insert(table).on_conflict_do_nothing(), rows)
+
 # Функция для dependency injection
 def get_db():
     db = SessionLocal()
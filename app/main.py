@@ -4,12 +4,14 @@ from fastapi.exception_handlers import http_exception_handler
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from app import models
 from app.core.auth import get_current_admin
 from app.database import engine, Base, get_db
 from app.services.advanced_scheduler import init_scheduler
+from app.services.email_service import postmark_client
+from app.services.template_service import page_templates, precompile_email_templates
+from app.utils.match_cache import match_cache
 from app.models import AdminUser
 
 # Импортируем настройки
@@ -21,7 +23,7 @@ Base.metadata.create_all(bind=engine)
 app = FastAPI(title="Event Newsletter App", version="0.1.0")
 
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
-templates = Jinja2Templates(directory="app/templates")
+templates = page_templates
 
 # Настройка CORS
 app.add_middleware(
@@ -52,6 +54,9 @@ async def admin_dashboard(request: Request):
 
 @app.on_event("startup")
 async def startup_event():
+    match_cache.load()
+    precompile_email_templates()
+    postmark_client.start()
     init_scheduler()
     # Создаём админа, если нет
     db = next(get_db())
@@ -63,6 +68,11 @@ async def startup_event():
         print("✅ Admin user created")
     db.close()
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    match_cache.save()
+    postmark_client.close()
+
 @app.exception_handler(StarletteHTTPException)
 async def custom_http_exception_handler(request: Request, exc: StarletteHTTPException):
     """
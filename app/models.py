@@ -1,10 +1,12 @@
-from sqlalchemy import Column, Integer, String, JSON, Text, DateTime, Table, ForeignKey, Boolean, Float, event
+from sqlalchemy import Column, Integer, String, JSON, Text, DateTime, Table, ForeignKey, Boolean, Float, Index, UniqueConstraint, event, inspect, select
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import Session, relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
 
 from app.database import Base
+from app.utils.date_parser import parse_event_dates
+from app.utils.taxonomy import DEFAULT_MAIN_CITIES, city_bucket, split_categories
 
 # Таблица для связи многие-ко-многим пользователей и категорий
 user_categories = Table(
@@ -22,6 +24,41 @@ user_cities = Table(
     Column('city', String, primary_key=True)
 )
 
+# Нормализованные категории событий: по строке на каждую категорию из Event.category
+event_categories = Table(
+    'event_categories',
+    Base.metadata,
+    Column('event_id', Integer, ForeignKey('events.id', ondelete='CASCADE'), primary_key=True),
+    Column('category', String, primary_key=True, index=True)
+)
+
+# История доставки: какие события уже ушли пользователю в рассылках
+delivered_events = Table(
+    'delivered_events',
+    Base.metadata,
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('event_id', Integer, ForeignKey('events.id', ondelete='CASCADE'), primary_key=True),
+    Column('delivered_at', DateTime(timezone=True), server_default=func.now())
+)
+
+# Очередь дайджеста: новые события, подобранные пользователю при загрузке и ещё не отправленные
+pending_digest = Table(
+    'pending_digest',
+    Base.metadata,
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('event_id', Integer, ForeignKey('events.id', ondelete='CASCADE'), primary_key=True),
+    Column('created_at', DateTime(timezone=True), server_default=func.now())
+)
+
+# Счётчики версий данных, общие для всех процессов: "events" увеличивается
+# при каждом изменении событий и инвалидирует кэш подбора (MatchCache)
+cache_versions = Table(
+    'cache_versions',
+    Base.metadata,
+    Column('name', String, primary_key=True),
+    Column('version', Integer, nullable=False, default=0)
+)
+
 user_subscription_types = Table(
     'user_subscription_types',
     Base.metadata,
@@ -57,13 +94,90 @@ class Event(Base):
     text = Column(Text, nullable=True)
     photo = Column(String, nullable=True)
     dates = Column(JSON)
+    # Диапазон дат, распознанный из dates при записи (см. parse_event_dates)
+    starts_at = Column(DateTime(timezone=True), nullable=True, index=True)
+    ends_at = Column(DateTime(timezone=True), nullable=True, index=True)
     languages = Column(JSON)
     age_restriction = Column(String, nullable=True)
     city = Column(String, nullable=True)
+    # Основной город или «Другие города»; вычисляется при записи из city
+    city_bucket = Column(String, nullable=True)
     url = Column(String, unique=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+    __table_args__ = (
+        Index('ix_events_city_bucket_created_at', 'city_bucket', 'created_at'),
+    )
+
+
+class City(Base):
+    """Основные города; события из остальных городов попадают в «Другие города»"""
+    __tablename__ = "cities"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, nullable=False)
+
+@event.listens_for(City.__table__, 'after_create')
+def seed_main_cities(target, connection, **kw):
+    connection.execute(target.insert(), [{"name": name} for name in DEFAULT_MAIN_CITIES])
+
+@event.listens_for(Session, 'before_flush')
+def assign_city_buckets(session, flush_context, instances):
+    """
+    Заполняет Event.city_bucket новых событий и событий с изменённым городом
+    по таблице основных городов — она читается один раз на flush, а не на
+    каждое событие.
+    """
+    events = [
+        obj for obj in session.new if isinstance(obj, Event)
+    ] + [
+        obj for obj in session.dirty
+        if isinstance(obj, Event) and inspect(obj).attrs.city.history.has_changes()
+    ]
+    if not events:
+        return
+    main_cities = {row.name for row in session.execute(select(City.name))}
+    for target in events:
+        target.city_bucket = city_bucket(target.city, main_cities)
+
+@event.listens_for(Event, 'before_insert')
+@event.listens_for(Event, 'before_update')
+def assign_event_date_range(mapper, connection, target):
+    """Заполняет Event.starts_at/ends_at из свободных строк Event.dates"""
+    state = inspect(target)
+    if state.persistent and not state.attrs.dates.history.has_changes():
+        return
+    target.starts_at, target.ends_at = parse_event_dates(target.dates, reference=target.created_at)
+
+@event.listens_for(Event, 'after_insert')
+@event.listens_for(Event, 'after_update')
+def sync_event_categories(mapper, connection, target):
+    """Поддерживает event_categories в соответствии с Event.category"""
+    if not inspect(target).attrs.category.history.has_changes():
+        return
+    connection.execute(
+        event_categories.delete().where(event_categories.c.event_id == target.id)
+    )
+    rows = [
+        {"event_id": target.id, "category": category}
+        for category in split_categories(target.category)
+    ]
+    if rows:
+        connection.execute(event_categories.insert(), rows)
+
+@event.listens_for(Event, 'after_delete')
+def delete_event_links(mapper, connection, target):
+    connection.execute(
+        event_categories.delete().where(event_categories.c.event_id == target.id)
+    )
+    connection.execute(
+        delivered_events.delete().where(delivered_events.c.event_id == target.id)
+    )
+    connection.execute(
+        pending_digest.delete().where(pending_digest.c.event_id == target.id)
+    )
+
 
 class NewsletterLog(Base):
     __tablename__ = "newsletter_logs"
@@ -78,6 +192,66 @@ class NewsletterLog(Base):
     schedule_id = Column(Integer, ForeignKey('newsletter_schedules.id'), nullable=True)
     schedule = relationship("NewsletterSchedule", back_populates="logs")
     
+class NewsletterCampaign(Base):
+    """Запуск рассылки; письма получателям лежат в newsletter_deliveries"""
+    __tablename__ = "newsletter_campaigns"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String, nullable=False)  # "all" — всем подписчикам, "users" — выбранным
+    user_ids = Column(JSON, nullable=True)  # для "users": отсортированные id получателей
+    # для шардов ("shard:i/n"): диапазон id получателей (after_user_id, upto_user_id],
+    # зафиксированный при создании — продолжение идёт по нему, а не по новому разбиению
+    after_user_id = Column(Integer, nullable=True)
+    upto_user_id = Column(Integer, nullable=True)
+    status = Column(String, nullable=False, default="running", index=True)  # running | completed | expired
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    # Аренда кампании запуском: кто её выполняет и когда последний раз продлил
+    claimed_by = Column(String, nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    deliveries = relationship("NewsletterDelivery", back_populates="campaign", passive_deletes=True)
+
+class NewsletterDelivery(Base):
+    """Исходящее письмо получателю в рамках кампании (outbox)"""
+    __tablename__ = "newsletter_deliveries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    campaign_id = Column(Integer, ForeignKey('newsletter_campaigns.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    event_ids = Column(JSON, nullable=False, default=list)
+    # pending -> sending -> sent | failed; skipped — нет новых событий, письмо не нужно
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    provider_message_id = Column(String, nullable=True)
+    last_error = Column(Text, nullable=True)
+    # Аренда письма в статусе sending: какой запуск его отправляет и когда
+    # последний раз продлил аренду (UTC); просроченная аренда снимается
+    claimed_by = Column(String, nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    campaign = relationship("NewsletterCampaign", back_populates="deliveries")
+
+    __table_args__ = (
+        UniqueConstraint('campaign_id', 'user_id', name='uq_newsletter_deliveries_campaign_user'),
+        Index('ix_newsletter_deliveries_campaign_status', 'campaign_id', 'status', 'id'),
+    )
+
+class NewsletterDeadLetter(Base):
+    """Письмо, не отправленное после всех попыток; админ может отправить его повторно"""
+    __tablename__ = "newsletter_dead_letters"
+
+    id = Column(Integer, primary_key=True, index=True)
+    campaign_id = Column(Integer, ForeignKey('newsletter_campaigns.id', ondelete='SET NULL'), nullable=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    to_email = Column(String, nullable=False)
+    event_ids = Column(JSON, nullable=False, default=list)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    # dead — ждёт разбора, replayed — отправлено повторно, discarded — повтор не нужен
+    status = Column(String, nullable=False, default="dead", index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    replayed_at = Column(DateTime(timezone=True), nullable=True)
+
 class NewsletterSchedule(Base):
     __tablename__ = "newsletter_schedules"
     id = Column(Integer, primary_key=True, index=True)
@@ -1,133 +1,25 @@
 from fastapi import APIRouter, BackgroundTasks, Body, Depends, Form, HTTPException, Request, Response
 from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
-from typing import Dict, List
+from typing import Dict, List, Optional
 from app import schemas, models
 from app.core.auth import create_access_token, get_current_admin
 from app.database import get_db
 from app.models import AdminUser
 from app.schemas import AdminUserCreate, ChangeCredentialsRequest, EventCountResponse, Token
-from app.services.email_service import send_email_via_postmark
-from app.utils.event_matcher import get_events_for_user
+from app.services.dead_letters import load_dead_letters
+from app.services.email_service import postmark_client
+from app.services.newsletter_service import replay_dead_letters
+from app.services.outbox import campaign_counts, claim_campaign, open_campaign
+from app.services.subscribers import count_subscribed_users
+from app.services.template_service import page_templates
+from app.tasks.newsletter import run_newsletter_job
 import logging
+from uuid import uuid4
 
 logger = logging.getLogger(__name__)
 router = APIRouter(tags=["admin"])
-templates = Jinja2Templates(directory="app/templates")
-
-def generate_newsletter_html(events: list, user: models.User) -> str:
-    events_html = ""
-    for event in events:
-        events_html += f"""
-        <div style="margin: 20px 0; padding: 15px; border: 1px solid #e0e0e0; border-radius: 8px; background: #fafafa;">
-            <h3 style="margin: 0 0 10px 0; color: #333;">{event.title}</h3>
-            <p style="margin: 5px 0; color: #666;">
-                <strong>📅 Даты:</strong> {', '.join(event.dates) if event.dates else 'Не указано'}
-            </p>
-            <p style="margin: 5px 0; color: #666;">
-                <strong>🏙️ Город:</strong> {event.city or 'Не указан'}
-            </p>
-            <p style="margin: 5px 0; color: #666;">
-                <strong>👥 Возраст:</strong> {event.age_restriction or 'Не указано'}
-            </p>
-            <p style="margin: 10px 0; color: #444;">{event.description or ''}</p>
-            <a href="{event.url}" style="display: inline-block; padding: 10px 20px; background: #007bff; color: white; text-decoration: none; border-radius: 4px; font-weight: bold;">
-                📍 Узнать подробнее
-            </a>
-        </div>
-        """
-    
-    return f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <title>Ваши рекомендации событий</title>
-    </head>
-    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; max-width: 600px; margin: 0 auto;">
-        <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 30px; color: white; text-align: center;">
-            <h1 style="margin: 0; font-size: 28px;">🎭 Event Newsletter</h1>
-            <p style="margin: 10px 0 0 0; opacity: 0.9;">Ваши персональные рекомендации</p>
-        </div>
-        
-        <div style="padding: 30px;">
-            <h2 style="color: #333; margin-bottom: 20px;">Привет, {user.email}!</h2>
-            <p style="color: #666;">Мы подобрали для вас события по вашим интересам:</p>
-            
-            {events_html if events_html else '<p style="color: #666; text-align: center; padding: 40px;">На этой неделе нет подходящих событий 😔<br>Но мы сообщим, когда появятся новые!</p>'}
-            
-            <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #eee;">
-                <p style="color: #999; font-size: 14px; text-align: center;">
-                    С уважением,<br>
-                    Команда Event Newsletter<br>
-                    <a href="https://your-site.com/unsubscribe?email={user.email}" style="color: #667eea; text-decoration: none;">
-                        🔕 Отписаться от рассылки
-                    </a>
-                </p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-
-def generate_newsletter_text(events: list, user: models.User) -> str:
-    events_text = ""
-    for event in events:
-        events_text += f"""
-{event.title}
-Даты: {', '.join(event.dates) if event.dates else 'Не указано'}
-Город: {event.city or 'Не указан'}
-Возраст: {event.age_restriction or 'Не указано'}
-Описание: {event.description or ''}
-Ссылка: {event.url}
-{"-" * 50}
-        """
-    
-    return f"""
-Привет, {user.email}!
-Мы подобрали для вас события по вашим интересам:
-{events_text if events_text else 'На этой неделе нет подходящих событий. Но мы сообщим, когда появятся новые!'}
-С уважением,
-Команда Event Newsletter
-Отписаться от рассылки: https://your-site.com/unsubscribe?email={user.email}
-"""
-
-async def send_newsletter_to_user(user_id: int):
-    try:
-        from app.database import get_db
-        db = next(get_db())
-        
-        user = db.query(models.User).filter(models.User.id == user_id).first()
-        if not user:
-            logger.warning(f"User not found: {user_id}")
-            return
-
-        # Пропускаем отписавшихся
-        if not user.is_subscribed:
-            logger.info(f"User unsubscribed, skip: {user.email}")
-            return
-        
-        events = get_events_for_user(db, user)
-        if not events:
-            logger.info(f"No events for user: {user.email}")
-            return
-        
-        html_content = generate_newsletter_html(events, user)
-        text_content = generate_newsletter_text(events, user)
-        
-        send_email_via_postmark(
-            to_email=user.email,
-            subject="🎉 Ваши персональные рекомендации событий",
-            html_body=html_content,
-            text_body=text_content,
-            tag="newsletter"
-        )
-        
-        logger.info(f"Newsletter sent to {user.email}")
-        
-    except Exception as e:
-        logger.error(f"Error sending newsletter to user {user_id}: {str(e)}")
+templates = page_templates
 
 @router.get("/events-manager", response_class=HTMLResponse)
 async def events_manager_page(
@@ -153,17 +45,30 @@ async def send_newsletter_to_all_users(
     username: str = Depends(get_current_admin)  # <--- Защита
 ):
     try:
-        users = users = db.query(models.User).filter(models.User.is_subscribed == True).all()
-        if not users:
+        total_users = count_subscribed_users(db)
+        if not total_users:
             return {"status": "error", "message": "No users found"}
         
-        for user in users:
-            background_tasks.add_task(send_newsletter_to_user, user.id)
+        # Одна фоновая задача на всю кампанию: подписчики читаются пачками
+        # уже внутри неё, прерванная кампания продолжается с того же места.
+        # Аренда кампании в БД не даёт запустить её дважды, в том числе
+        # с другого экземпляра приложения
+        campaign = open_campaign(db, "all")
+        owner = uuid4().hex
+        if not claim_campaign(db, campaign.id, owner):
+            return {
+                "status": "running",
+                "message": f"Newsletter campaign {campaign.id} is already running",
+                "campaign_id": campaign.id,
+                "total_users": total_users
+            }
+        background_tasks.add_task(run_newsletter_job, campaign.id, owner)
         
         return {
             "status": "started",
-            "message": f"Started newsletter for {len(users)} users",
-            "total_users": len(users),
+            "message": f"Started newsletter for {total_users} users",
+            "campaign_id": campaign.id,
+            "total_users": total_users,
             "note": "Emails are being sent in background"
         }
         
@@ -171,6 +76,25 @@ async def send_newsletter_to_all_users(
         logger.error(f"Error starting newsletter: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error starting newsletter: {str(e)}")
 
+@router.get("/newsletter/campaigns/{campaign_id}", response_model=Dict)
+def get_newsletter_campaign(
+    campaign_id: int,
+    db: Session = Depends(get_db),
+    username: str = Depends(get_current_admin)
+):
+    """Состояние кампании и число писем по статусам outbox."""
+    campaign = db.get(models.NewsletterCampaign, campaign_id)
+    if campaign is None:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return {
+        "id": campaign.id,
+        "kind": campaign.kind,
+        "status": campaign.status,
+        "created_at": campaign.created_at,
+        "finished_at": campaign.finished_at,
+        "deliveries": campaign_counts(db, campaign.id)
+    }
+
 @router.get("/newsletter/logs/", response_model=List[schemas.NewsletterLog])
 def get_newsletter_logs(
     skip: int = 0,
@@ -183,6 +107,38 @@ def get_newsletter_logs(
     ).offset(skip).limit(limit).all()
     return logs
 
+@router.get("/dead-letters/", response_model=List[schemas.NewsletterDeadLetter])
+def get_dead_letters(
+    status: Optional[str] = "dead",
+    skip: int = 0,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    username: str = Depends(get_current_admin)
+):
+    """Письма, не отправленные после всех попыток (status=None — вся история)."""
+    return load_dead_letters(db, status=status, skip=skip, limit=limit)
+
+@router.post("/dead-letters/replay", response_model=Dict)
+def replay_newsletter_dead_letters(
+    request: schemas.DeadLetterReplayRequest = Body(default=schemas.DeadLetterReplayRequest()),
+    db: Session = Depends(get_db),
+    username: str = Depends(get_current_admin)
+):
+    """Повторно отправляет выбранные письма dead-letter (или все, если ids не указаны)."""
+    replayed, successful, failed = replay_dead_letters(db, request.ids)
+    return {
+        "status": "completed",
+        "replayed": replayed,
+        "successful": successful,
+        "failed": failed
+    }
+
+@router.get("/email-transport/stats", response_model=Dict)
+def get_email_transport_stats(
+    username: str = Depends(get_current_admin)
+):
+    return postmark_client.stats()
+
 @router.post("/login", response_model=Token)
 async def login(
     request: Request,
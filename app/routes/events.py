@@ -1,15 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, UploadFile, File
 from pydantic import ValidationError
 from sqlalchemy import desc
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import Dict, List, Optional
 import csv
 import io
 
 from app.database import get_db
 from app import models, schemas
+from app.services.digest_service import enqueue_pending_digests, requeue_event_digests
 from app.utils.csv_parser import parse_csv_row
-from app.utils.event_matcher import get_events_for_user
+from app.utils.event_matcher import get_events_for_users, upcoming_since
+from app.utils.match_cache import get_cached_events_for_user, match_cache
 from app.core.auth import get_current_admin
 
 
@@ -23,6 +25,7 @@ async def upload_csv(
     current_admin: str = Depends(get_current_admin)
 ):
     results = {"total_rows": 0, "successful": 0, "failed": 0, "errors": []}
+    created_events = []
     try:
         if not file.filename.endswith('.csv'):
             raise HTTPException(status_code=400, detail="Only CSV files are allowed")
@@ -44,11 +47,15 @@ async def upload_csv(
                     continue
                 db_event = models.Event(**ev.dict())
                 db.add(db_event); db.commit(); db.refresh(db_event)
+                created_events.append(db_event)
                 results["successful"] += 1
             except Exception as e:
                 db.rollback()
                 results["failed"] += 1
                 results["errors"].append(f"Row {idx+2}: {e}")
+        if results["successful"]:
+            match_cache.bump_version(db)
+            enqueue_pending_digests(db, created_events, since=upcoming_since())
         return {"message": "CSV processing completed", "results": results}
     except UnicodeDecodeError:
         raise HTTPException(status_code=400, detail="Invalid file encoding.")
@@ -62,7 +69,11 @@ async def clear_all_events(
     current_admin: str = Depends(get_current_admin)
 ):
     try:
+        db.execute(models.event_categories.delete())
+        db.execute(models.delivered_events.delete())
+        db.execute(models.pending_digest.delete())
         db.query(models.Event).delete(); db.commit()
+        match_cache.bump_version(db)
         return {"message": "All events have been deleted", "deleted": True}
     except Exception as e:
         db.rollback()
@@ -80,13 +91,34 @@ async def get_events_count(
 @router.get("/user/{user_id}/recommended", response_model=List[schemas.Event])
 async def get_recommended_events(
     user_id: int,
+    upcoming_only: bool = False,
     db: Session = Depends(get_db),
     current_admin: str = Depends(get_current_admin)
 ):
     user = db.query(models.User).filter(models.User.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return get_events_for_user(db, user)
+    since = upcoming_since() if upcoming_only else None
+    return get_cached_events_for_user(db, user, since=since)
+
+
+@router.post("/users/recommended", response_model=Dict[int, List[schemas.Event]])
+async def get_recommended_events_batch(
+    user_ids: List[int] = Body(...),
+    chunk_size: Optional[int] = Query(None, ge=1),
+    upcoming_only: bool = False,
+    db: Session = Depends(get_db),
+    current_admin: str = Depends(get_current_admin)
+):
+    since = upcoming_since() if upcoming_only else None
+    return get_events_for_users(db, user_ids, chunk_size=chunk_size, since=since)
+
+
+@router.get("/match-cache/stats", response_model=Dict)
+async def get_match_cache_stats(
+    current_admin: str = Depends(get_current_admin)
+):
+    return match_cache.stats()
 
 
 @router.get("/", response_model=List[schemas.Event])
@@ -115,6 +147,8 @@ async def create_event(
     try:
         db_event = models.Event(**event.dict())
         db.add(db_event); db.commit(); db.refresh(db_event)
+        match_cache.bump_version(db)
+        enqueue_pending_digests(db, [db_event], since=upcoming_since())
         return db_event
     except ValidationError as e:
         raise HTTPException(status_code=422, detail=e.errors())
@@ -145,6 +179,8 @@ async def update_event(
     if not ev: raise HTTPException(status_code=404, detail="Not found")
     for f, v in event.dict(exclude_unset=True).items(): setattr(ev, f, v)
     db.commit(); db.refresh(ev)
+    match_cache.bump_version(db)
+    requeue_event_digests(db, ev, since=upcoming_since())
     return ev
 
 
@@ -157,5 +193,6 @@ async def delete_event(
     ev = db.query(models.Event).filter(models.Event.id == event_id).first()
     if not ev: raise HTTPException(status_code=404, detail="Not found")
     db.delete(ev); db.commit()
+    match_cache.bump_version(db)
     return {"message": "Event deleted successfully"}
 
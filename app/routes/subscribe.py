@@ -5,6 +5,8 @@ from sqlalchemy.orm import Session
 from typing import List
 from app.database import get_db
 from app import models, schemas
+from app.services.digest_service import requeue_user_digests
+from app.utils.event_matcher import upcoming_since
 
 router = APIRouter()
 
@@ -69,6 +71,8 @@ async def subscribe(
                     )
                 )
             db.commit()
+            # Дайджест собирается заново по новым категориям и городам
+            requeue_user_digests(db, [db_user.id], since=upcoming_since())
             return {
                 "status": "success",
                 "message": "User categories updated successfully"
@@ -111,6 +115,8 @@ async def subscribe(
                     )
                 )
             db.commit()
+            # Новый подписчик получает в дайджесте уже опубликованные события
+            requeue_user_digests(db, [db_user.id], since=upcoming_since())
             return {
                 "status": "success",
                 "message": "User created and subscribed successfully"
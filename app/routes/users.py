@@ -4,6 +4,8 @@ from typing import List
 from app.database import get_db
 from app import models, schemas
 from app.core.auth import get_current_admin
+from app.services.digest_service import requeue_user_digests
+from app.utils.event_matcher import upcoming_since
 
 router = APIRouter()
 
@@ -63,6 +65,7 @@ def create_user(
                 )
     
     db.commit()
+    requeue_user_digests(db, [db_user.id], since=upcoming_since())
     
     # Формируем ответ
     categories = [
@@ -313,6 +316,9 @@ def update_user(
     
     db.commit()
     db.refresh(db_user)
+    # Подписка или предпочтения изменились — дайджест собирается заново
+    if user.is_subscribed is not None or user.categories is not None or user.cities is not None:
+        requeue_user_digests(db, [user_id], since=upcoming_since())
     
     # Получение данных для ответа
     categories = [
@@ -384,6 +390,8 @@ def update_user_by_email(
             )
     db.commit()
     db.refresh(db_user)
+    if user_data.categories is not None:
+        requeue_user_digests(db, [db_user.id], since=upcoming_since())
     categories = [
         row.category for row in db.execute(
             models.user_categories.select().where(
@@ -443,6 +451,22 @@ def delete_user(
             models.user_subscription_types.c.user_id == user_id
         )
     )
+    db.execute(
+        models.delivered_events.delete().where(
+            models.delivered_events.c.user_id == user_id
+        )
+    )
+    db.execute(
+        models.pending_digest.delete().where(
+            models.pending_digest.c.user_id == user_id
+        )
+    )
+    db.query(models.NewsletterDelivery).filter(
+        models.NewsletterDelivery.user_id == user_id
+    ).delete(synchronize_session=False)
+    db.query(models.NewsletterDeadLetter).filter(
+        models.NewsletterDeadLetter.user_id == user_id
+    ).delete(synchronize_session=False)
     db.delete(db_user)
     db.commit()
     return {"message": "User deleted successfully"}
@@ -67,6 +67,8 @@ class EventUpdate(BaseModel):
 
 class Event(EventBase):
     id: int
+    starts_at: Optional[datetime] = None
+    ends_at: Optional[datetime] = None
     created_at: datetime
     updated_at: Optional[datetime] = None
 
@@ -139,6 +141,24 @@ class NewsletterLog(NewsletterLogBase):
     class Config:
         from_attributes = True
 
+class NewsletterDeadLetter(BaseModel):
+    id: int
+    campaign_id: Optional[int] = None
+    user_id: int
+    to_email: str
+    event_ids: List[int] = []
+    attempts: int
+    last_error: Optional[str] = None
+    status: str
+    created_at: Optional[datetime] = None
+    replayed_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class DeadLetterReplayRequest(BaseModel):
+    ids: Optional[List[int]] = None  # None — все письма, ждущие разбора
+
 class AdminUserCreate(BaseModel):
     username: str
     password: str
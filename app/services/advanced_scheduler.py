@@ -8,6 +8,7 @@ from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.triggers.combining import OrTrigger
 from sqlalchemy.orm import Session
+from app.core.config import settings
 from app.database import get_db
 from app.services import newsletter_service
 from app.models import NewsletterSchedule
@@ -158,7 +159,9 @@ def run_scheduled_newsletter(schedule_id: int):
         logger.info(f"Running scheduled newsletter: {schedule.name}")
         schedule.last_run = datetime.utcnow()
         db.commit()
-        if schedule.user_ids:
+        if settings.DIGEST_MODE:
+            newsletter_service.send_pending_digests(db, schedule.user_ids or None)
+        elif schedule.user_ids:
             newsletter_service.send_newsletter_to_users(db, schedule.user_ids)
         else:
             newsletter_service.send_newsletter_to_all_users(db)
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Awaitable, Callable, Iterable, Iterator, List, Optional, Tuple, Union
+from app import models
+from app.core.config import settings
+from app.services.email_service import BatchingSender, SendResult
+from app.services.task_service import RetryQueue
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class OutgoingEmail:
+    """Готовое к отправке письмо — только простые данные, без ORM-объектов."""
+    user_id: int
+    to_email: str
+    subject: str
+    html_body: str
+    event_ids: List[int] = field(default_factory=list)
+    attempts: int = 0
+    text_body: Optional[str] = None
+
+
+# (пользователь, события, письмо) — письма нет, если событий нет, или
+# вместо него ошибка рендеринга
+RenderedJob = Tuple[models.User, List[models.Event], Union[OutgoingEmail, Exception, None]]
+
+
+def render_in_process(
+    jobs: Iterable[Tuple[models.User, List[models.Event]]],
+    render: Callable[[models.User, List[models.Event]], OutgoingEmail]
+) -> Iterator[RenderedJob]:
+    """Стадия рендеринга по умолчанию: письма рендерятся по одному в координаторе."""
+    for user, events in jobs:
+        email = None
+        if events:
+            try:
+                email = render(user, events)
+            except Exception as e:
+                email = e
+        yield user, events, email
+
+
+class CampaignRunner:
+    """
+    Конвейер рассылки: подбор -> рендеринг -> отправка.
+
+    Подбор и рендеринг выполняются в потоке-координаторе (им нужны ORM-объекты
+    и сессия, которые нельзя делить между потоками), отправка — в пуле из
+    workers потоков. Одновременно в пуле не больше max_in_flight писем: когда
+    лимит достигнут, координатор ждёт завершения отправок, прежде чем
+    подбирать и рендерить следующие письма. Результаты отправок обрабатываются
+    в координаторе (on_result), поэтому запись в БД остаётся однопоточной.
+    Рендеринг можно вынести в пул процессов (render_stage, см. RenderPool):
+    тогда координатор только передаёт ему данные и забирает готовые письма.
+
+    С batcher (BatchingSender) письма вместо пула уходят в пакетную отправку;
+    лимит в обработке тогда не меньше двух пакетов, чтобы следующий пакет
+    набирался, пока предыдущий отправляется.
+
+    Письмо с временной ошибкой (SendResult.retryable) не блокирует конвейер:
+    оно откладывается в retry_queue с экспоненциальной задержкой и уходит
+    снова, когда подойдёт срок, а координатор тем временем продолжает
+    подбор и отправку. В on_result попадает только окончательный результат —
+    успех, постоянная ошибка или исчерпанные попытки (email.attempts).
+    """
+
+    def __init__(
+        self,
+        send: Callable[..., bool],
+        workers: Optional[int] = None,
+        max_in_flight: Optional[int] = None,
+        batcher: Optional[BatchingSender] = None,
+        retry_queue: Optional[RetryQueue] = None
+    ):
+        self.send = send
+        self.batcher = batcher
+        self.retry_queue = retry_queue if retry_queue is not None else RetryQueue()
+        self.workers = workers or settings.CAMPAIGN_SEND_WORKERS
+        self.max_in_flight = max(max_in_flight or settings.CAMPAIGN_MAX_IN_FLIGHT, self.workers)
+        if batcher is not None:
+            self.max_in_flight = max(self.max_in_flight, 2 * batcher.batch_size)
+        self.successful = 0
+        self.failed = 0
+        self.retried = 0
+        # Размер писем (HTML + текст, байты UTF-8) — для учёта объёма передачи провайдеру
+        self.rendered = 0
+        self.payload_bytes = 0
+
+    def _send(self, email: OutgoingEmail) -> bool:
+        return self.send(
+            to_email=email.to_email,
+            subject=email.subject,
+            html_body=email.html_body,
+            text_body=email.text_body
+        )
+
+    def _rendered(self, jobs, render, render_stage) -> Iterator[RenderedJob]:
+        """Письма стадии рендеринга; пропуски и ошибки рендеринга сразу учитываются в счётчиках."""
+        for user, events, email in (render_stage or partial(render_in_process, render=render))(jobs):
+            if not events:
+                logger.info(f"ℹ️ No new events for user {user.email}. Skipping.")
+                self.successful += 1
+                email = None
+            elif isinstance(email, Exception):
+                logger.error(f"⚠️ Failed to render email for {user.email}: {str(email)}")
+                self.failed += 1
+                email = None
+            else:
+                self.rendered += 1
+                self.payload_bytes += len(email.html_body.encode()) + len((email.text_body or "").encode())
+            yield user, events, email
+
+    def bytes_per_message(self) -> float:
+        return self.payload_bytes / self.rendered if self.rendered else 0.0
+
+    def _log_payload(self):
+        if self.rendered:
+            logger.info(f"📦 {self.rendered} emails rendered, {self.bytes_per_message() / 1024:.1f} KB per message (HTML + text)")
+
+    def _submit(self, pool: ThreadPoolExecutor, email: OutgoingEmail):
+        email.attempts += 1
+        if self.batcher is not None:
+            return self.batcher.submit(email.to_email, email.subject, email.html_body, email.text_body)
+        return pool.submit(self._send, email)
+
+    def _complete(self, future, email: OutgoingEmail, on_result: Callable[[OutgoingEmail, SendResult], None]):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"⚠️ Failed to send email to {email.to_email}: {str(e)}")
+            result = SendResult(False, error=str(e))
+        sent = bool(result)
+        if not sent and getattr(result, "retryable", False) and self.retry_queue.can_retry(email.attempts):
+            delay = self.retry_queue.schedule(email, email.attempts)
+            self.retried += 1
+            logger.warning(f"🔁 Retrying email to {email.to_email} in {delay:.1f}s (attempt {email.attempts + 1}/{self.retry_queue.max_attempts})")
+            return
+        try:
+            on_result(email, result)
+        except Exception as e:
+            logger.error(f"⚠️ Failed to process user {email.to_email}: {str(e)}")
+            sent = False
+        if sent:
+            self.successful += 1
+        else:
+            self.failed += 1
+
+    def run(
+        self,
+        jobs: Iterable[Tuple[models.User, List[models.Event]]],
+        render: Callable[[models.User, List[models.Event]], OutgoingEmail],
+        on_result: Callable[[OutgoingEmail, SendResult], None],
+        render_stage: Optional[Callable[[Iterable], Iterable[RenderedJob]]] = None
+    ) -> Tuple[int, int]:
+        """
+        Отправляет письма по парам (пользователь, события) и возвращает
+        (successful, failed). Пользователь без событий считается успешным,
+        ошибка рендеринга или отправки — неудачей. render_stage (например,
+        RenderPool) заменяет рендеринг по одному письму через render.
+        """
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="campaign-send") as pool:
+
+            def drain(timeout=None):
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._complete(future, in_flight.pop(future), on_result)
+
+            def submit(email):
+                # Обратное давление: ждём, пока освободится место в пуле отправки
+                while len(in_flight) >= self.max_in_flight:
+                    drain()
+                in_flight[self._submit(pool, email)] = email
+
+            def resubmit_due():
+                for email in self.retry_queue.pop_due():
+                    submit(email)
+
+            try:
+                for user, events, email in self._rendered(jobs, render, render_stage):
+                    if email is None:
+                        continue
+                    submit(email)
+                    resubmit_due()
+            finally:
+                # Уже отправленные письма учитываются даже при ошибке подбора;
+                # отложенные повторы дожидаются своего срока
+                while True:
+                    if self.batcher is not None:
+                        self.batcher.flush()
+                    if in_flight:
+                        drain(timeout=self.retry_queue.next_delay())
+                    elif self.retry_queue:
+                        time.sleep(self.retry_queue.next_delay())
+                    else:
+                        break
+                    resubmit_due()
+
+        self._log_payload()
+        return self.successful, self.failed
+
+
+class AsyncCampaignRunner(CampaignRunner):
+    """
+    Асинхронный вариант конвейера: отправки — задачи asyncio в одном потоке,
+    до max_in_flight одновременно. send — корутина с той же сигнатурой, что
+    send_email_via_postmark. Подбор, рендеринг и on_result, как и в
+    CampaignRunner, выполняются в координаторе между ожиданиями.
+    """
+
+    def __init__(self, send: Callable[..., Awaitable[bool]], max_in_flight: Optional[int] = None):
+        super().__init__(
+            send=send,
+            workers=1,
+            max_in_flight=max_in_flight or settings.CAMPAIGN_ASYNC_MAX_IN_FLIGHT
+        )
+
+    async def _send_async(self, email: OutgoingEmail) -> bool:
+        email.attempts += 1
+        return await self.send(
+            to_email=email.to_email,
+            subject=email.subject,
+            html_body=email.html_body,
+            text_body=email.text_body
+        )
+
+    async def run(
+        self,
+        jobs: Iterable[Tuple[models.User, List[models.Event]]],
+        render: Callable[[models.User, List[models.Event]], OutgoingEmail],
+        on_result: Callable[[OutgoingEmail, SendResult], None],
+        render_stage: Optional[Callable[[Iterable], Iterable[RenderedJob]]] = None
+    ) -> Tuple[int, int]:
+        in_flight = {}
+
+        async def drain(timeout=None):
+            done, _ = await asyncio.wait(in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                self._complete(task, in_flight.pop(task), on_result)
+
+        async def submit(email):
+            while len(in_flight) >= self.max_in_flight:
+                await drain()
+            in_flight[asyncio.create_task(self._send_async(email))] = email
+
+        async def resubmit_due():
+            for email in self.retry_queue.pop_due():
+                await submit(email)
+
+        try:
+            for user, events, email in self._rendered(jobs, render, render_stage):
+                if email is None:
+                    continue
+
+                await submit(email)
+                # Даём задачам начать запросы и забираем уже завершённые
+                await asyncio.sleep(0)
+                if any(task.done() for task in in_flight):
+                    await drain()
+                await resubmit_due()
+        finally:
+            while True:
+                if in_flight:
+                    await drain(timeout=self.retry_queue.next_delay())
+                elif self.retry_queue:
+                    await asyncio.sleep(self.retry_queue.next_delay())
+                else:
+                    break
+                await resubmit_due()
+
+        self._log_payload()
+        return self.successful, self.failed
@@ -0,0 +1,68 @@
+import logging
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from typing import Iterable, List, Optional
+from app.models import NewsletterDeadLetter
+
+logger = logging.getLogger(__name__)
+
+DEAD = "dead"
+REPLAYED = "replayed"
+DISCARDED = "discarded"
+
+
+def add_dead_letter(db: Session, email, result, campaign_id: Optional[int] = None) -> NewsletterDeadLetter:
+    """Сохраняет письмо (OutgoingEmail), не отправленное после всех попыток."""
+    letter = NewsletterDeadLetter(
+        campaign_id=campaign_id,
+        user_id=email.user_id,
+        to_email=email.to_email,
+        event_ids=list(email.event_ids),
+        attempts=email.attempts,
+        last_error=getattr(result, "error", None),
+        status=DEAD
+    )
+    db.add(letter)
+    db.commit()
+    logger.warning(f"🪦 Email to {email.to_email} moved to dead letters after {email.attempts} attempts")
+    return letter
+
+
+def load_dead_letters(
+    db: Session,
+    ids: Optional[Iterable[int]] = None,
+    status: Optional[str] = DEAD,
+    skip: int = 0,
+    limit: Optional[int] = None
+) -> List[NewsletterDeadLetter]:
+    """Письма dead-letter по статусу (None — все), старые первыми."""
+    query = db.query(NewsletterDeadLetter)
+    if ids is not None:
+        query = query.filter(NewsletterDeadLetter.id.in_(list(ids)))
+    if status is not None:
+        query = query.filter(NewsletterDeadLetter.status == status)
+    query = query.order_by(NewsletterDeadLetter.id).offset(skip)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def resolve_dead_letters(
+    db: Session,
+    letters: List[NewsletterDeadLetter],
+    status: str,
+    attempts: int = 0,
+    error: Optional[str] = None
+):
+    """
+    Фиксирует итог повторной отправки: replayed/discarded закрывают письма,
+    dead оставляет их в очереди с обновлёнными попытками и ошибкой.
+    """
+    for letter in letters:
+        letter.attempts += attempts
+        letter.status = status
+        if status == DEAD:
+            letter.last_error = error
+        else:
+            letter.replayed_at = func.now()
+    db.commit()
@@ -0,0 +1,49 @@
+import logging
+from collections import defaultdict
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, Optional, Set
+from app import models
+from app.database import insert_ignore
+
+logger = logging.getLogger(__name__)
+
+
+def load_delivered_event_ids(
+    db: Session,
+    event_ids: Iterable[int],
+    user_ids: Optional[Iterable[int]] = None
+) -> Dict[int, Set[int]]:
+    """
+    Возвращает {user_id: {event_id, ...}} — какие из указанных событий
+    пользователи уже получали. Ограничение по event_ids держит выборку
+    в пределах событий текущей рассылки.
+    """
+    event_ids = list(event_ids)
+    delivered = defaultdict(set)
+    if not event_ids:
+        return delivered
+
+    stmt = models.delivered_events.select().where(
+        models.delivered_events.c.event_id.in_(event_ids)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(models.delivered_events.c.user_id.in_(list(user_ids)))
+    for row in db.execute(stmt).fetchall():
+        delivered[row.user_id].add(row.event_id)
+    return delivered
+
+
+def exclude_delivered(events: list, delivered_ids) -> list:
+    """Оставляет только события, которые пользователь ещё не получал."""
+    if not delivered_ids:
+        return events
+    return [event for event in events if event.id not in delivered_ids]
+
+
+def record_delivered_events(db: Session, user_id: int, event_ids: Iterable[int]):
+    """Запоминает, что события отправлены пользователю."""
+    rows = [{"user_id": user_id, "event_id": event_id} for event_id in event_ids]
+    if rows:
+        # Событие могло уже уйти пользователю другим путём (дайджест, повтор)
+        insert_ignore(db, models.delivered_events, rows)
+        db.commit()
@@ -0,0 +1,189 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import and_, exists, or_, select
+from sqlalchemy.orm import Session
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from app import models
+from app.database import insert_ignore
+from app.services.delivery_history import exclude_delivered, load_delivered_event_ids
+from app.utils.event_matcher import date_window_filter, get_events_for_users
+from app.utils.taxonomy import split_categories
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriberIndex:
+    """
+    Обратный индекс (категория, корзина города) -> id подписанных пользователей.
+    Строится одним запросом при загрузке событий и позволяет сразу определить,
+    кому подходит новое событие.
+    """
+
+    def __init__(self, postings: Dict[Tuple[str, str], Set[int]]):
+        self.postings = postings
+
+    @classmethod
+    def load(
+        cls,
+        db: Session,
+        categories: Optional[Iterable[str]] = None,
+        cities: Optional[Iterable[str]] = None
+    ) -> "SubscriberIndex":
+        """Загружает индекс; categories/cities сужают его до нужных ключей."""
+        uc = models.user_categories
+        ucity = models.user_cities
+        stmt = select(uc.c.category, ucity.c.city, uc.c.user_id).select_from(uc).join(
+            ucity, ucity.c.user_id == uc.c.user_id
+        ).join(
+            models.User, models.User.id == uc.c.user_id
+        ).where(
+            models.User.is_subscribed == True
+        )
+        if categories is not None:
+            stmt = stmt.where(uc.c.category.in_(list(categories)))
+        if cities is not None:
+            stmt = stmt.where(ucity.c.city.in_(list(cities)))
+
+        postings = defaultdict(set)
+        for category, city, user_id in db.execute(stmt):
+            postings[(category, city)].add(user_id)
+        return cls(postings)
+
+    def users_for_event(self, event: models.Event) -> Set[int]:
+        if event.city_bucket is None:
+            return set()
+        users = set()
+        for category in split_categories(event.category):
+            users |= self.postings.get((category, event.city_bucket), set())
+        return users
+
+
+def enqueue_pending_digests(
+    db: Session,
+    events: List[models.Event],
+    index: Optional[SubscriberIndex] = None,
+    since: Optional[datetime] = None
+) -> int:
+    """
+    Добавляет новые события в pending_digest подходящих пользователей.
+    События, закончившиеся до since, пропускаются; строки, уже стоящие
+    в очереди, не дублируются. Возвращает число строк.
+    """
+    events = [
+        event for event in events
+        if since is None or event.ends_at is None or event.ends_at >= since
+    ]
+    if not events:
+        return 0
+    if index is None:
+        categories = {c for event in events for c in split_categories(event.category)}
+        cities = {event.city_bucket for event in events if event.city_bucket}
+        index = SubscriberIndex.load(db, categories, cities)
+
+    rows = [
+        {"user_id": user_id, "event_id": event.id}
+        for event in events
+        for user_id in index.users_for_event(event)
+    ]
+    insert_ignore(db, models.pending_digest, rows)
+    db.commit()
+    logger.info(f"📥 Queued {len(rows)} digest entries for {len(events)} events")
+    return len(rows)
+
+
+def requeue_event_digests(db: Session, event: models.Event, since: Optional[datetime] = None) -> int:
+    """
+    Пересобирает очередь по изменённому событию: категории, город или даты
+    могли измениться, поэтому строки события удаляются и ставятся заново
+    для пользователей, которым оно подходит сейчас.
+    """
+    db.execute(models.pending_digest.delete().where(models.pending_digest.c.event_id == event.id))
+    db.commit()
+    return enqueue_pending_digests(db, [event], since=since)
+
+
+def requeue_user_digests(db: Session, user_ids: Iterable[int], since: Optional[datetime] = None) -> int:
+    """
+    Пересобирает очередь пользователей по их текущим предпочтениям — после
+    подписки или изменения категорий и городов: в дайджест попадают все
+    подходящие предстоящие события, которые пользователь ещё не получал.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    pd = models.pending_digest
+    db.execute(pd.delete().where(pd.c.user_id.in_(user_ids)))
+    events_by_user = get_events_for_users(db, user_ids, since=since)
+    event_ids = {event.id for events in events_by_user.values() for event in events}
+    delivered = load_delivered_event_ids(db, event_ids, user_ids)
+    rows = [
+        {"user_id": user_id, "event_id": event.id}
+        for user_id, events in events_by_user.items()
+        for event in exclude_delivered(events, delivered.get(user_id))
+    ]
+    insert_ignore(db, pd, rows)
+    db.commit()
+    logger.info(f"📥 Queued {len(rows)} digest entries for {len(user_ids)} users")
+    return len(rows)
+
+
+def load_pending_digests(
+    db: Session,
+    user_ids: Optional[Iterable[int]] = None,
+    since: Optional[datetime] = None
+) -> Dict[int, List[models.Event]]:
+    """
+    Читает накопленные события подписанных пользователей:
+    {user_id: [event, ...]}, события по created_at по убыванию.
+    """
+    pd = models.pending_digest
+    stmt = select(pd.c.user_id, models.Event).join(
+        models.Event, models.Event.id == pd.c.event_id
+    ).join(
+        models.User, models.User.id == pd.c.user_id
+    ).where(
+        models.User.is_subscribed == True,
+        *date_window_filter(since)
+    ).order_by(
+        pd.c.user_id,
+        models.Event.created_at.desc()
+    )
+    if user_ids is not None:
+        stmt = stmt.where(pd.c.user_id.in_(list(user_ids)))
+
+    pending = defaultdict(list)
+    for user_id, event in db.execute(stmt):
+        pending[user_id].append(event)
+    return pending
+
+
+def clear_pending_digests(db: Session, user_id: int, event_ids: Iterable[int]):
+    """Удаляет отправленные события из очереди пользователя."""
+    event_ids = list(event_ids)
+    if event_ids:
+        db.execute(models.pending_digest.delete().where(
+            models.pending_digest.c.user_id == user_id,
+            models.pending_digest.c.event_id.in_(event_ids)
+        ))
+        db.commit()
+
+
+def purge_pending_digests(db: Session, since: datetime) -> int:
+    """
+    Чистит очередь от строк, которые уже не будут отправлены: закончившиеся
+    события, отписавшиеся пользователи и события, уже доставленные другой
+    рассылкой.
+    """
+    pd = models.pending_digest
+    de = models.delivered_events
+    expired = select(models.Event.id).where(models.Event.ends_at < since)
+    unsubscribed = select(models.User.id).where(models.User.is_subscribed == False)
+    delivered = exists().where(and_(de.c.user_id == pd.c.user_id, de.c.event_id == pd.c.event_id))
+    result = db.execute(pd.delete().where(or_(
+        pd.c.event_id.in_(expired),
+        pd.c.user_id.in_(unsubscribed),
+        delivered
+    )))
+    db.commit()
+    return result.rowcount or 0
@@ -1,15 +1,27 @@
+import asyncio
 import os
 import logging
+import threading
+import time
+import httpx
 import requests
-from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass
 from datetime import datetime
 from email.message import EmailMessage
+from email.utils import parsedate_to_datetime
 from email.policy import SMTP
 
 from app.core.config import settings  # Убедись, что app.core.config импортируется из твоей структуры проекта
 
 logger = logging.getLogger(__name__)
 
+# Максимальное число сообщений в одном запросе /email/batch
+POSTMARK_BATCH_LIMIT = 500
+
 # Путь к папке test_emails
 TEST_EMAIL_DIR = './test_emails'
 os.makedirs(TEST_EMAIL_DIR, exist_ok=True)
@@ -41,21 +53,23 @@ def save_email_to_file(to_email: str, subject: str, html_body: str, text_body: O
     with open(os.path.join(TEST_EMAIL_DIR, filename), 'wb') as f:
         f.write(msg.as_bytes(policy=SMTP))
 
-def send_email_via_postmark(to_email: str, subject: str, html_body: str, text_body: Optional[str] = None, **kwargs) -> bool:
-    """Отправляет письмо через Postmark или сохраняет в файл (если тестовый режим)."""
-    if settings.EMAIL_TEST_MODE:
-        save_email_to_file(to_email, subject, html_body, text_body)
-        logger.info(f"📧 Email saved to {TEST_EMAIL_DIR} (test mode) for {to_email}")
-        return True
+@dataclass(frozen=True)
+class SendResult:
+    """Результат отправки письма; в логических выражениях ведёт себя как bool.
+    retryable — ошибка временная (сеть, лимит, 5xx), письмо стоит отправить ещё раз."""
+    sent: bool
+    message_id: Optional[str] = None
+    error: Optional[str] = None
+    retryable: bool = False
 
-    if not settings.POSTMARK_API_TOKEN:
-        logger.error("Postmark API token not configured")
-        return False
+    def __bool__(self):
+        return self.sent
 
+def build_postmark_message(to_email: str, subject: str, html_body: str, text_body: Optional[str] = None) -> dict:
+    """Тело сообщения Postmark для /email и элементов /email/batch."""
     if text_body is None:
         text_body = html_to_text(html_body)
-
-    payload = {
+    return {
         "From": settings.POSTMARK_SENDER_EMAIL,
         "To": to_email,
         "Subject": subject,
@@ -64,31 +78,520 @@ def send_email_via_postmark(to_email: str, subject: str, html_body: str, text_bo
         "MessageStream": "outbound"
     }
 
-    headers = {
+def postmark_headers() -> dict:
+    return {
         "Accept": "application/json",
-        "Content-Type": "application/json",
-        "X-Postmark-Server-Token": settings.POSTMARK_API_TOKEN
+        "Content-Type": "application/json"
     }
 
+# Ответы, означающие превышение лимита провайдера
+THROTTLE_STATUSES = (429, 503)
+
+def is_retryable_status(status_code: int) -> bool:
+    """Временная ошибка провайдера: лимит или сбой на его стороне."""
+    return status_code in THROTTLE_STATUSES or status_code >= 500
+
+def is_connect_failure(error: Exception) -> bool:
+    """
+    Запрос не дошёл до сервера: соединение не установлено. Только такую
+    сетевую ошибку можно повторять — при обрыве или таймауте после отправки
+    тела письмо могло быть уже принято.
+    """
+    if isinstance(error, (requests.exceptions.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = error.args[0] if error.args else None
+        # requests оборачивает ошибку urllib3 в MaxRetryError
+        reason = getattr(reason, "reason", reason)
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    return False
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах: число или HTTP-дата; None, если заголовка нет или он некорректен."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
     try:
-        response = requests.post(
-            "https://api.postmarkapp.com/email",
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+
+class RateLimiter:
+    """
+    Token bucket на отправку писем: rate писем в секунду в среднем и до burst
+    подряд. Один экземпляр (rate_limiter) разделяют все пути отправки процесса —
+    кампании, фоновые задачи админки, планировщик — поэтому вместе они не
+    превышают квоту.
+
+    На 429/503 текущая скорость уменьшается вдвое (но не ниже min_ratio от
+    настроенной), а отправка приостанавливается на Retry-After. Каждый
+    успешный ответ возвращает скорость к настроенной на recovery_ratio.
+    rate <= 0 отключает ограничение.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        min_ratio: float = 0.1,
+        recovery_ratio: float = 0.05,
+        default_pause: float = 1.0
+    ):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.min_ratio = min_ratio
+        self.recovery_ratio = recovery_ratio
+        self.default_pause = default_pause
+        self.current_rate = rate
+        self.throttled = 0
+        self.waited_seconds = 0.0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """Забирает токены и возвращает 0 или сколько секунд подождать перед новой попыткой."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.current_rate)
+            self._updated = now
+            if now < self._paused_until:
+                return self._paused_until - now
+            # Пакет больше burst допускается при полном ведре, уводя его в минус
+            needed = min(tokens, self.burst)
+            if self._tokens >= needed:
+                self._tokens -= tokens
+                return 0.0
+            return (needed - self._tokens) / self.current_rate
+
+    def acquire(self, tokens: int = 1):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            self.waited_seconds += wait
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int = 1):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            self.waited_seconds += wait
+            await asyncio.sleep(wait)
+
+    def throttle(self, retry_after: Optional[float] = None):
+        """Провайдер ответил 429/503: замедляемся и ждём Retry-After."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.throttled += 1
+            self.current_rate = max(self.rate * self.min_ratio, self.current_rate / 2)
+            pause = self.default_pause if retry_after is None else retry_after
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._tokens = min(self._tokens, 0.0)
+
+    def recover(self):
+        if self.rate <= 0 or self.current_rate >= self.rate:
+            return
+        with self._lock:
+            self.current_rate = min(self.rate, self.current_rate + self.rate * self.recovery_ratio)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "current_rate": self.current_rate,
+                "throttled": self.throttled,
+                "waited_seconds": round(self.waited_seconds, 3),
+            }
+
+
+rate_limiter = RateLimiter(rate=settings.EMAIL_RATE_PER_SECOND, burst=settings.EMAIL_RATE_BURST)
+
+def update_rate_limiter(response):
+    """Ответ провайдера: 429/503 замедляют общий лимит, остальные возвращают скорость."""
+    if response.status_code in THROTTLE_STATUSES:
+        rate_limiter.throttle(parse_retry_after(response.headers.get("Retry-After")))
+        logger.warning(f"Postmark throttled with {response.status_code}")
+    else:
+        rate_limiter.recover()
+
+class PostmarkClient:
+    """
+    Долгоживущий HTTP-клиент Postmark: общий requests.Session с пулом
+    keep-alive соединений, который безопасно использовать из нескольких потоков.
+
+    Клиент сам запросы не повторяет: повторы — одна очередь с задержками в
+    конвейере рассылки (EMAIL_MAX_ATTEMPTS), куда письмо попадает, только
+    если ошибка заведомо временная (SendResult.retryable: соединение не
+    установлено, 429, 5xx). Закрытые сервером простаивавшие keep-alive
+    соединения urllib3 замечает до отправки и открывает новые. Сессия
+    создаётся в start() при запуске приложения или лениво при первом
+    запросе и закрывается в close().
+    """
+
+    def __init__(
+        self,
+        pool_size: Optional[int] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        keep_alive: Optional[bool] = None
+    ):
+        self.pool_size = pool_size or settings.POSTMARK_POOL_SIZE
+        self.timeout = (
+            connect_timeout or settings.POSTMARK_CONNECT_TIMEOUT,
+            read_timeout or settings.POSTMARK_READ_TIMEOUT
+        )
+        self.keep_alive = settings.POSTMARK_KEEP_ALIVE if keep_alive is None else keep_alive
+        self._session: Optional[requests.Session] = None
+        self._adapter: Optional[HTTPAdapter] = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self._closed_connections = 0
+
+    def start(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                self._adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    pool_block=True
+                )
+                session.mount("https://", self._adapter)
+                session.mount("http://", self._adapter)
+                session.headers.update(postmark_headers())
+                if not self.keep_alive:
+                    session.headers["Connection"] = "close"
+                self._session = session
+            return self._session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._closed_connections += self._opened_connections()
+                self._session.close()
+                self._session = None
+                self._adapter = None
+
+    def post(self, path: str, payload) -> requests.Response:
+        """
+        POST с учётом общего лимита скорости. На 429/503 лимит замедляется и
+        ставится на паузу Retry-After, а ответ возвращается вызывающему:
+        письмо повторит конвейер рассылки.
+        """
+        cost = len(payload) if isinstance(payload, list) else 1
+        rate_limiter.acquire(cost)
+        response = self._request(path, payload)
+        update_rate_limiter(response)
+        return response
+
+    def _request(self, path: str, payload) -> requests.Response:
+        session = self._session or self.start()
+        with self._lock:
+            self.requests += 1
+        return session.post(
+            f"{settings.POSTMARK_API_URL}{path}",
             json=payload,
-            headers=headers,
-            timeout=30
+            # Токен читается при каждом запросе: настройки могут меняться
+            headers={"X-Postmark-Server-Token": settings.POSTMARK_API_TOKEN},
+            timeout=self.timeout
         )
-        if response.status_code == 200:
-            logger.info(f"Email sent successfully to {to_email}")
-            return True
-        else:
-            logger.error(f"Postmark API error: {response.status_code} - {response.text}")
-            return False
+
+    def _opened_connections(self) -> int:
+        if self._adapter is None:
+            return 0
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def stats(self) -> Dict:
+        """Статистика переиспользования соединений с момента запуска."""
+        with self._lock:
+            opened = self._closed_connections + self._opened_connections()
+            return {
+                "started": self._session is not None,
+                "pool_size": self.pool_size,
+                "keep_alive": self.keep_alive,
+                "requests": self.requests,
+                "connections_opened": opened,
+                "connections_reused": max(self.requests - opened, 0),
+                "reuse_rate": max(self.requests - opened, 0) / self.requests if self.requests else 0.0,
+                "rate_limiter": rate_limiter.stats(),
+            }
+
+
+postmark_client = PostmarkClient()
+
+def check_postmark_response(response, to_email: str) -> SendResult:
+    """Результат ответа /email (requests.Response или httpx.Response)."""
+    if response.status_code == 200:
+        logger.info(f"Email sent successfully to {to_email}")
+        try:
+            message_id = response.json().get("MessageID")
+        except ValueError:
+            message_id = None
+        return SendResult(True, message_id=message_id)
+    logger.error(f"Postmark API error: {response.status_code} - {response.text}")
+    return SendResult(
+        False,
+        error=f"{response.status_code}: {response.text}",
+        retryable=is_retryable_status(response.status_code)
+    )
+
+def send_email_via_postmark(to_email: str, subject: str, html_body: str, text_body: Optional[str] = None, **kwargs) -> SendResult:
+    """Отправляет письмо через Postmark или сохраняет в файл (если тестовый режим)."""
+    if settings.EMAIL_TEST_MODE:
+        save_email_to_file(to_email, subject, html_body, text_body)
+        logger.info(f"📧 Email saved to {TEST_EMAIL_DIR} (test mode) for {to_email}")
+        return SendResult(True)
+
+    if not settings.POSTMARK_API_TOKEN:
+        logger.error("Postmark API token not configured")
+        return SendResult(False, error="Postmark API token not configured")
+
+    payload = build_postmark_message(to_email, subject, html_body, text_body)
+
+    try:
+        response = postmark_client.post("/email", payload)
+        return check_postmark_response(response, to_email)
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to send email to {to_email}: {str(e)}")
-        return False
+        return SendResult(False, error=str(e), retryable=is_connect_failure(e))
     except Exception as e:
         logger.error(f"Unexpected error sending email: {str(e)}")
-        return False
+        return SendResult(False, error=str(e))
+
+class AsyncPostmarkClient:
+    """
+    Асинхронный HTTP-клиент Postmark на httpx.AsyncClient для asyncio-рассылок:
+    один поток держит сотни запросов в полёте. Пул keep-alive соединений и
+    таймауты — как у PostmarkClient; запросы, как и там, не повторяются.
+    Клиент привязан к циклу событий, в котором создан: используйте его внутри
+    одного asyncio.run (async with AsyncPostmarkClient() as client: ...).
+    """
+
+    def __init__(
+        self,
+        pool_size: Optional[int] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None
+    ):
+        self.pool_size = pool_size or settings.POSTMARK_POOL_SIZE
+        self.requests = 0
+        self._client = httpx.AsyncClient(
+            base_url=settings.POSTMARK_API_URL,
+            headers=postmark_headers(),
+            timeout=httpx.Timeout(
+                read_timeout or settings.POSTMARK_READ_TIMEOUT,
+                connect=connect_timeout or settings.POSTMARK_CONNECT_TIMEOUT
+            ),
+            transport=httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size
+                )
+            )
+        )
+
+    async def post(self, path: str, payload) -> httpx.Response:
+        """POST с учётом общего лимита скорости — как PostmarkClient.post."""
+        cost = len(payload) if isinstance(payload, list) else 1
+        await rate_limiter.acquire_async(cost)
+        self.requests += 1
+        response = await self._client.post(
+            path,
+            json=payload,
+            headers={"X-Postmark-Server-Token": settings.POSTMARK_API_TOKEN}
+        )
+        update_rate_limiter(response)
+        return response
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+async def send_email_async(
+    to_email: str,
+    subject: str,
+    html_body: str,
+    text_body: Optional[str] = None,
+    client: Optional[AsyncPostmarkClient] = None
+) -> SendResult:
+    """Асинхронный аналог send_email_via_postmark."""
+    if settings.EMAIL_TEST_MODE:
+        save_email_to_file(to_email, subject, html_body, text_body)
+        logger.info(f"📧 Email saved to {TEST_EMAIL_DIR} (test mode) for {to_email}")
+        return SendResult(True)
+
+    if not settings.POSTMARK_API_TOKEN:
+        logger.error("Postmark API token not configured")
+        return SendResult(False, error="Postmark API token not configured")
+
+    payload = build_postmark_message(to_email, subject, html_body, text_body)
+
+    try:
+        if client is None:
+            async with AsyncPostmarkClient() as own_client:
+                response = await own_client.post("/email", payload)
+        else:
+            response = await client.post("/email", payload)
+        return check_postmark_response(response, to_email)
+    except httpx.HTTPError as e:
+        logger.error(f"Failed to send email to {to_email}: {str(e)}")
+        return SendResult(False, error=str(e), retryable=is_connect_failure(e))
+    except Exception as e:
+        logger.error(f"Unexpected error sending email: {str(e)}")
+        return SendResult(False, error=str(e))
+
+def send_batch_via_postmark(messages: List[dict]) -> List[SendResult]:
+    """
+    Отправляет сообщения (см. build_postmark_message) через /email/batch пакетами
+    по POSTMARK_BATCH_LIMIT. Возвращает результат по каждому сообщению в том же
+    порядке: Postmark отвечает 200 на весь пакет и сообщает ErrorCode отдельно
+    для каждого письма.
+    """
+    if settings.EMAIL_TEST_MODE:
+        for message in messages:
+            save_email_to_file(message["To"], message["Subject"], message["HtmlBody"], message.get("TextBody"))
+        logger.info(f"📧 {len(messages)} emails saved to {TEST_EMAIL_DIR} (test mode)")
+        return [SendResult(True)] * len(messages)
+
+    if not settings.POSTMARK_API_TOKEN:
+        logger.error("Postmark API token not configured")
+        return [SendResult(False, error="Postmark API token not configured")] * len(messages)
+
+    results = []
+    for start in range(0, len(messages), POSTMARK_BATCH_LIMIT):
+        batch = messages[start:start + POSTMARK_BATCH_LIMIT]
+        try:
+            response = postmark_client.post("/email/batch", batch)
+            if response.status_code != 200:
+                logger.error(f"Postmark batch API error: {response.status_code} - {response.text}")
+                results.extend([SendResult(
+                    False,
+                    error=f"{response.status_code}: {response.text}",
+                    retryable=is_retryable_status(response.status_code)
+                )] * len(batch))
+                continue
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to send batch of {len(batch)} emails: {str(e)}")
+            results.extend([SendResult(False, error=str(e), retryable=is_connect_failure(e))] * len(batch))
+            continue
+        # Дальше пакет уже принят (200): письма без подтверждения не повторяются,
+        # чтобы не отправить их дважды, — они попадут в dead-letter на разбор
+        try:
+            batch_results = response.json()
+        except ValueError as e:
+            logger.error(f"Unreadable Postmark batch response for {len(batch)} emails: {str(e)}")
+            results.extend([SendResult(False, error=f"unreadable batch response: {str(e)}")] * len(batch))
+            continue
+
+        for message, result in zip(batch, batch_results):
+            if result.get("ErrorCode") == 0:
+                results.append(SendResult(True, message_id=result.get("MessageID")))
+            else:
+                logger.error(f"Postmark rejected email to {message['To']}: {result.get('ErrorCode')} - {result.get('Message')}")
+                results.append(SendResult(False, error=f"{result.get('ErrorCode')}: {result.get('Message')}"))
+        # Ответ короче пакета — неподтверждённые письма считаем неотправленными
+        results.extend([SendResult(False, error="missing from batch response")] * (len(batch) - len(batch_results)))
+    logger.info(f"Batch sent: {sum(map(bool, results))}/{len(results)} accepted")
+    return results
+
+class BatchingSender:
+    """
+    Копит письма и отправляет их через send_batch пакетами: когда набралось
+    batch_size писем или первое письмо в буфере ждёт дольше flush_interval.
+    submit возвращает Future с результатом отправки конкретного письма.
+    """
+
+    def __init__(
+        self,
+        send_batch: Callable[[List[dict]], List[SendResult]] = send_batch_via_postmark,
+        batch_size: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        workers: Optional[int] = None
+    ):
+        self.send_batch = send_batch
+        self.batch_size = min(batch_size or settings.EMAIL_BATCH_SIZE or POSTMARK_BATCH_LIMIT, POSTMARK_BATCH_LIMIT)
+        self.flush_interval = flush_interval if flush_interval is not None else settings.EMAIL_BATCH_FLUSH_SECONDS
+        self._pending: List[Tuple[dict, Future]] = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or settings.CAMPAIGN_SEND_WORKERS,
+            thread_name_prefix="email-batch"
+        )
+        self._flusher = threading.Thread(target=self._flush_periodically, name="email-batch-flush", daemon=True)
+        self._flusher.start()
+
+    def submit(self, to_email: str, subject: str, html_body: str, text_body: Optional[str] = None) -> Future:
+        future = Future()
+        message = build_postmark_message(to_email, subject, html_body, text_body)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchingSender is closed")
+            self._pending.append((message, future))
+            full = len(self._pending) >= self.batch_size
+            if len(self._pending) == 1:
+                self._wakeup.set()
+        if full:
+            self.flush()
+        return future
+
+    def flush(self):
+        """Отправляет накопленные письма, не дожидаясь заполнения пакета."""
+        with self._lock:
+            batch, self._pending = self._pending, []
+            if batch:
+                self._executor.submit(self._deliver, batch)
+
+    def _deliver(self, batch: List[Tuple[dict, Future]]):
+        try:
+            results = list(self.send_batch([message for message, _ in batch]))
+        except Exception as e:
+            logger.error(f"Unexpected error sending batch: {str(e)}")
+            results = [SendResult(False, error=str(e))] * len(batch)
+        results += [SendResult(False, error="no result")] * (len(batch) - len(results))
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def _flush_periodically(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                return
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        """Отправляет остаток и дожидается завершения всех пакетов."""
+        self.flush()
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 def send_email_via_postmark_stub(to_email: str, subject: str, html_body: str, text_body: Optional[str] = None):
     """Заглушка для тестирования — логирует операцию."""
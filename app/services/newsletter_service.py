@@ -1,71 +1,263 @@
 import logging
 from sqlalchemy.orm import Session
-from typing import List
-from app.models import User, NewsletterLog
-from app.utils.event_matcher import get_events_for_user
-from app.services.email_service import send_email_via_postmark
-from jinja2 import Environment, FileSystemLoader
+from typing import List, Optional, Tuple
+from app.core.config import settings
+from app.models import Event, User, NewsletterCampaign, NewsletterLog
+from app.utils.event_index import EventIndex, load_user_preferences
+from app.utils.event_matcher import date_window_filter, get_events_for_users, upcoming_since
+from app.utils.match_cache import cached_match_many, match_cache
+from app.utils.render_cache import FragmentCache, RenderCache
+from app.utils.segmentation import build_segments
+from app.services.delivery_history import exclude_delivered, load_delivered_event_ids, record_delivered_events
+from app.services.dead_letters import DEAD, DISCARDED, REPLAYED, add_dead_letter, load_dead_letters, resolve_dead_letters
+from app.services.campaign_runner import AsyncCampaignRunner, CampaignRunner, OutgoingEmail
+from app.services.render_pool import RenderPool
+from app.services.outbox import CampaignAlreadyRunning, campaign_lease, claim_pending, enqueue_deliveries, finish_campaign, last_enqueued_user_id, open_campaign, record_delivery
+from app.services.subscribers import count_subscribed_users, iter_subscribed_users
+from app.services.digest_service import clear_pending_digests, load_pending_digests, purge_pending_digests
+from app.services.email_service import AsyncPostmarkClient, BatchingSender, send_email_async, send_email_via_postmark
+from app.services.template_service import email_env
+from jinja2 import TemplateNotFound
+from markupsafe import Markup
+import asyncio
 import os
 import time
 import datetime
+from functools import partial
 
 logger = logging.getLogger(__name__)
 
-# Путь к папке с шаблонами (должно быть app/templates/emails/)
-TEMPLATE_PATH = 'app/templates/emails'
-jinja_env = Environment(loader=FileSystemLoader(TEMPLATE_PATH), autoescape=True)
+# Общее окружение шаблонов писем (см. template_service)
+jinja_env = email_env
 
-def send_newsletter_to_all_users(db: Session):
-    """Основная функция для отправки рассылки всем пользователям."""
-    start_time = time.time()
-    logger.info("🎯 Starting newsletter campaign...")
+NEWSLETTER_SUBJECT = "Анонс мероприятий для вас!"
+# Поля контекста, которые различаются у получателей с одинаковыми событиями
+RECIPIENT_KEYS = ('name', 'user')
+
+def render_event_card(event) -> Markup:
+    """Карточка события (_event_card.html) — готовый HTML для newsletter.html."""
+    return Markup(jinja_env.get_template('_event_card.html').render(event=event))
 
+def email_context(user: User, events: list, now: Optional[datetime.datetime] = None, event_card=render_event_card) -> dict:
+    return {
+        'name': user.email.split('@')[0],
+        'events': events,
+        'now': now or datetime.datetime.now(),
+        'user': user,
+        'event_card': event_card
+    }
+
+def text_template_for(template):
+    """Шаблон текстовой части письма: то же имя с расширением .txt, None — если его нет."""
     try:
-        users = db.query(User).filter(User.is_subscribed == True).all()
-        total_users = len(users)
-        logger.info(f"📋 Found {total_users} subscribed users.")
+        return template.environment.get_template(template.name.rsplit('.', 1)[0] + '.txt')
+    except TemplateNotFound:
+        return None
 
-        successful = 0
-        failed = 0
+def render_email(template, user: User, events: list, event_card=render_event_card, text_template=None) -> OutgoingEmail:
+    """Рендерит письмо пользователю с уже подобранными событиями."""
+    context = email_context(user, events, event_card=event_card)
+    return OutgoingEmail(
+        user_id=user.id,
+        to_email=user.email,
+        subject=NEWSLETTER_SUBJECT,
+        html_body=template.render(context),
+        event_ids=[event.id for event in events],
+        text_body=text_template.render(context) if text_template is not None else None
+    )
 
-        template = jinja_env.get_template('newsletter.html')
+def render_email_cached(
+    cache: RenderCache,
+    now: datetime.datetime,
+    user: User,
+    events: list,
+    event_card=render_event_card,
+    text_cache: Optional[RenderCache] = None
+) -> OutgoingEmail:
+    """Как render_email, но тело письма собирается из кэша по набору событий."""
+    key = tuple((event.id, event.updated_at) for event in events)
+    context = email_context(user, events, now, event_card)
+    return OutgoingEmail(
+        user_id=user.id,
+        to_email=user.email,
+        subject=NEWSLETTER_SUBJECT,
+        html_body=cache.render(context, key=key),
+        event_ids=[event.id for event in events],
+        text_body=text_cache.render(context, key=key) if text_cache is not None else None
+    )
+
+def make_renderer(template):
+    """
+    Рендерер писем кампании. Карточка каждого события рендерится один раз
+    за кампанию (FragmentCache) и вставляется во все письма с этим событием.
+    С RENDER_CACHE_MAX_ENTRIES > 0 и тело целиком рендерится один раз на
+    набор событий, а имя и ссылка отписки вставляются для каждого
+    получателя; время (now) фиксируется на старте кампании. Текстовая часть
+    рендерится из своего шаблона (newsletter.txt) с тем же контекстом.
+    """
+    event_card = FragmentCache(render_event_card, max_entries=settings.FRAGMENT_CACHE_MAX_ENTRIES)
+    text_template = text_template_for(template)
+    if settings.RENDER_CACHE_MAX_ENTRIES <= 0:
+        return partial(render_email, template, event_card=event_card, text_template=text_template)
+    cache = RenderCache(template, RECIPIENT_KEYS, max_entries=settings.RENDER_CACHE_MAX_ENTRIES)
+    text_cache = None
+    if text_template is not None:
+        text_cache = RenderCache(text_template, RECIPIENT_KEYS, max_entries=settings.RENDER_CACHE_MAX_ENTRIES)
+    return partial(render_email_cached, cache, datetime.datetime.now(), event_card=event_card, text_cache=text_cache)
+
+def make_render_stage(template, render):
+    """Стадия рендеринга в пуле процессов при RENDER_WORKERS > 0, иначе None (в координаторе)."""
+    if settings.RENDER_WORKERS <= 0:
+        return None
+    return RenderPool(render, template_name=template.name)
+
+def record_result(db: Session, email: OutgoingEmail, result):
+    """
+    Обработка результата отправки в конвейере: запоминает доставленные
+    события, неотправленное письмо кладёт в dead-letter.
+    """
+    if result:
+        logger.info(f"📩 Email successfully sent to {email.to_email}")
+        record_delivered_events(db, email.user_id, email.event_ids)
+    else:
+        logger.error(f"❌ Failed to send email to {email.to_email}")
+        add_dead_letter(db, email, result)
 
-        for user in users:
-            logger.info(f"👤 Processing user: {user.email} (ID: {user.id})")
-            try:
-                events = get_events_for_user(db, user)
-                logger.info(f"✅ Found {len(events)} events for user.")
-
-                if events:
-                    subject = "Анонс мероприятий для вас!"
-                    context = {
-                        'name': user.email.split('@')[0],
-                        'events': events,
-                        'now': datetime.datetime.now(),
-                        'user': user
-                    }
-                    html_body = template.render(context)
-
-                    logger.info(f"📤 Sending email to {user.email}...")
-                    email_sent = send_email_via_postmark(
-                        to_email=user.email,
-                        subject=subject,
-                        html_body=html_body
-                    )
-
-                    if email_sent:
-                        logger.info(f"📩 Email successfully sent to {user.email}")
-                        successful += 1
-                    else:
-                        logger.error(f"❌ Failed to send email to {user.email}")
-                        failed += 1
-                else:
-                    logger.info(f"ℹ️ No events for user {user.email}. Skipping.")
-                    successful += 1
-            except Exception as e:
-                failed += 1
-                logger.error(f"⚠️ Failed to process user {user.email}: {str(e)}")
-                continue
+def record_outbox_result(db: Session, campaign_id: int, email: OutgoingEmail, result):
+    """Обработка результата отправки кампании: статус письма в outbox и история доставки."""
+    if result:
+        logger.info(f"📩 Email successfully sent to {email.to_email}")
+    else:
+        logger.error(f"❌ Failed to send email to {email.to_email}")
+    record_delivery(db, campaign_id, email.user_id, email.event_ids, result, attempts=email.attempts)
+    if not result:
+        add_dead_letter(db, email, result, campaign_id=campaign_id)
+
+def rollback_on_error(db: Session, on_result):
+    """
+    Обработчик результата, откатывающий транзакцию при ошибке: иначе на
+    PostgreSQL сессия остаётся в прерванной транзакции и все следующие
+    результаты кампании не записываются. Ошибка передаётся конвейеру.
+    """
+    def handle(email: OutgoingEmail, result):
+        try:
+            on_result(email, result)
+        except Exception:
+            db.rollback()
+            raise
+    return handle
+
+async def run_campaign_async(jobs, template, on_result):
+    """Конвейер рассылки на asyncio: все отправки идут через один AsyncPostmarkClient."""
+    async with AsyncPostmarkClient() as client:
+        runner = AsyncCampaignRunner(send=partial(send_email_async, client=client))
+        render = make_renderer(template)
+        return await runner.run(jobs, render=render, on_result=on_result, render_stage=make_render_stage(template, render))
+
+def run_campaign(jobs, template, on_result):
+    """
+    Прогоняет письма через конвейер рассылки. При EMAIL_TRANSPORT="async"
+    отправка идёт в собственном цикле asyncio; при EMAIL_BATCH_SIZE > 1 —
+    пакетами через /email/batch, иначе — по одному письму из пула потоков.
+    При RENDER_WORKERS > 0 письма рендерятся в пуле процессов.
+    """
+    if settings.EMAIL_TRANSPORT == "async":
+        return asyncio.run(run_campaign_async(jobs, template, on_result))
+    batcher = BatchingSender() if settings.EMAIL_BATCH_SIZE > 1 else None
+    try:
+        runner = CampaignRunner(send=send_email_via_postmark, batcher=batcher)
+        render = make_renderer(template)
+        return runner.run(jobs, render=render, on_result=on_result, render_stage=make_render_stage(template, render))
+    finally:
+        if batcher is not None:
+            batcher.close()
+
+def load_matcher(db: Session, since: datetime.datetime):
+    """Загружает движок подбора событий для рассылки (см. settings.MATCH_ENGINE)."""
+    if settings.MATCH_ENGINE == "bitmask":
+        from app.utils.bitmask_matcher import BitmaskMatcher
+        return BitmaskMatcher.load(db, since=since)
+    return EventIndex.load(db, since=since)
+
+def run_all_users_campaign(
+    db: Session,
+    kind: str = "all",
+    after_id: int = 0,
+    upto_id: Optional[int] = None,
+    campaign: Optional[NewsletterCampaign] = None,
+    owner: Optional[str] = None
+) -> Tuple[int, int, int]:
+    """
+    Рассылка подписчикам с after_id < id <= upto_id (по умолчанию — всем)
+    без записи NewsletterLog. Возвращает (total_users, successful, failed)
+    по outbox кампании kind (или уже открытой campaign). Кампания
+    выполняется под арендой в БД (owner — если её заранее взял вызывающий);
+    занятая другим запуском — CampaignAlreadyRunning.
+    """
+    template = jinja_env.get_template('newsletter.html')
+
+    # Предстоящие события загружаются один раз на всю рассылку, подбор
+    # выполняется один раз на сегмент с одинаковыми предпочтениями
+    # (и кэшируется между пачками)
+    since = upcoming_since()
+    match_cache.sync(db)
+    index = load_matcher(db, since=since)
+    match_many = partial(cached_match_many, index, since=since)
+    event_ids = [event.id for event in index.events]
+
+    # Кампания ведётся через outbox (newsletter_deliveries): прерванный
+    # запуск продолжается с того места, где остановился. Диапазон шарда
+    # хранится в кампании, поэтому продолжение идёт по тому же диапазону
+    if campaign is None:
+        id_range = (after_id, upto_id) if after_id or upto_id is not None else None
+        campaign = open_campaign(db, kind, id_range=id_range)
+
+    def jobs(owner):
+        yield from claim_pending(db, campaign.id, owner=owner)
+        # Подписчики читаются пачками, поэтому память не растёт с их числом,
+        # а первые письма уходят сразу после первой пачки
+        start_id = max(after_id, last_enqueued_user_id(db, campaign.id))
+        for users in iter_subscribed_users(db, after_id=start_id, upto_id=upto_id):
+            user_ids = [user.id for user in users]
+            preferences = load_user_preferences(db, user_ids)
+            segments = build_segments(users, preferences, index, match_many=match_many)
+            delivered = load_delivered_event_ids(db, event_ids, user_ids)
+            logger.info(f"🧩 {len(segments)} preference segments for {len(users)} users.")
+            events_by_user = {}
+            for segment in segments:
+                logger.info(f"✅ Found {len(segment.events)} events for segment of {len(segment.users)} users.")
+                for user in segment.users:
+                    events = exclude_delivered(segment.events, delivered.get(user.id))
+                    events_by_user[user.id] = [event.id for event in events]
+            enqueue_deliveries(db, campaign.id, events_by_user)
+            yield from claim_pending(db, campaign.id, owner=owner)
+
+    with campaign_lease(db, campaign.id, owner) as owner:
+        run_campaign(jobs(owner), template, rollback_on_error(db, partial(record_outbox_result, db, campaign.id)))
+        return finish_campaign(db, campaign)
+
+def send_newsletter_to_all_users(
+    db: Session,
+    campaign: Optional[NewsletterCampaign] = None,
+    owner: Optional[str] = None
+):
+    """
+    Основная функция для отправки рассылки всем пользователям. campaign —
+    кампания, заранее открытая (и взятая в аренду owner) вызывающим,
+    например админкой, чтобы сразу вернуть её id; она всегда выполняется
+    в текущем процессе.
+    """
+    if campaign is None and settings.NEWSLETTER_SHARDS > 1:
+        # Рассылка по процессам-шардам; NewsletterLog пишет координатор
+        from app.tasks.newsletter import send_newsletter_sharded
+        return send_newsletter_sharded(db)
+
+    start_time = time.time()
+    logger.info("🎯 Starting newsletter campaign...")
+
+    try:
+        logger.info(f"📋 Found {count_subscribed_users(db)} subscribed users.")
+        total_users, successful, failed = run_all_users_campaign(db, campaign=campaign, owner=owner)
 
         duration_seconds = time.time() - start_time
         log = NewsletterLog(
@@ -79,6 +271,9 @@ def send_newsletter_to_all_users(db: Session):
         logger.info(f"📊 Newsletter finished! Success: {successful}, Failed: {failed}, Duration: {duration_seconds:.2f}s")
         return successful, failed
 
+    except CampaignAlreadyRunning as e:
+        logger.info(f"⏳ {str(e)}, skipping")
+        return 0, 0
     except Exception as e:
         logger.error(f"💥 Critical error in newsletter service: {str(e)}")
         return 0, 0
@@ -88,51 +283,145 @@ def send_newsletter_to_users(db: Session, user_ids: List[int]):
     start_time = time.time()
     logger.info(f"🎯 Starting targeted newsletter for {len(user_ids)} users...")
 
-    successful = 0
-    failed = 0
-
     template = jinja_env.get_template('newsletter.html')
 
-    for user_id in user_ids:
-        try:
-            user = db.query(User).filter(User.id == user_id, User.is_subscribed == True).first()
-            if not user:
-                logger.warning(f"User {user_id} not found or unsubscribed")
-                continue
-
-            events = get_events_for_user(db, user)
-            logger.info(f"✅ Found {len(events)} events for user {user.email}")
-
-            if events:
-                subject = "Анонс мероприятий для вас!"
-                context = {
-                    'name': user.email.split('@')[0],
-                    'events': events,
-                    'now': datetime.datetime.now(),
-                    'user': user
-                }
-                html_body = template.render(context)
-
-                email_sent = send_email_via_postmark(
-                    to_email=user.email,
-                    subject=subject,
-                    html_body=html_body
-                )
-
-                if email_sent:
-                    successful += 1
-                else:
-                    failed += 1
-            else:
-                logger.info(f"ℹ️ No events for user {user.email}. Skipping.")
-                successful += 1
-
-        except Exception as e:
-            failed += 1
-            logger.error(f"⚠️ Failed to process user {user_id}: {str(e)}")
-            continue
+    # Пользователи обрабатываются пачками: на каждую пачку — один запрос
+    # пользователей и один запрос подбора событий
+    chunk_size = settings.MATCH_CHUNK_SIZE
+    since = upcoming_since()
+    campaign = open_campaign(db, "users", user_ids)
+
+    def jobs(owner):
+        yield from claim_pending(db, campaign.id, owner=owner)
+        after_id = last_enqueued_user_id(db, campaign.id)
+        remaining = [user_id for user_id in campaign.user_ids if user_id > after_id]
+        for start in range(0, len(remaining), chunk_size):
+            chunk = remaining[start:start + chunk_size]
+            users = db.query(User).filter(User.id.in_(chunk), User.is_subscribed == True).all()
+            found_ids = {user.id for user in users}
+            for user_id in chunk:
+                if user_id not in found_ids:
+                    logger.warning(f"User {user_id} not found or unsubscribed")
+
+            events_by_user = get_events_for_users(db, found_ids, chunk_size=chunk_size, since=since)
+            matched_ids = {event.id for events in events_by_user.values() for event in events}
+            delivered = load_delivered_event_ids(db, matched_ids, found_ids)
+
+            new_events = {}
+            for user in users:
+                events = exclude_delivered(events_by_user[user.id], delivered.get(user.id))
+                logger.info(f"✅ Found {len(events)} new events for user {user.email}")
+                new_events[user.id] = [event.id for event in events]
+            enqueue_deliveries(db, campaign.id, new_events)
+            yield from claim_pending(db, campaign.id, owner=owner)
+
+    with campaign_lease(db, campaign.id) as owner:
+        run_campaign(jobs(owner), template, rollback_on_error(db, partial(record_outbox_result, db, campaign.id)))
+        _, successful, failed = finish_campaign(db, campaign)
 
     duration_seconds = time.time() - start_time
     logger.info(f"📊 Targeted newsletter finished! Success: {successful}, Failed: {failed}")
     return successful, failed
 
+
+def send_pending_digests(db: Session, user_ids: Optional[List[int]] = None):
+    """
+    Отправляет накопленные в pending_digest события (push-модель): подбор уже
+    выполнен при загрузке событий, здесь читаются только строки очереди.
+    user_ids ограничивает рассылку указанными пользователями.
+    """
+    start_time = time.time()
+    logger.info("🎯 Starting pending digest delivery...")
+
+    try:
+        since = upcoming_since()
+        purged = purge_pending_digests(db, since)
+        if purged:
+            logger.info(f"🧹 Dropped {purged} stale digest entries.")
+
+        pending = load_pending_digests(db, user_ids, since=since)
+        users = db.query(User).filter(User.id.in_(list(pending))).all() if pending else []
+        total_users = len(users)
+        logger.info(f"📋 Found {total_users} users with pending digests.")
+
+        template = jinja_env.get_template('newsletter.html')
+
+        def on_result(email: OutgoingEmail, result):
+            record_result(db, email, result)
+            # При неудаче строки остаются в очереди и уйдут при следующем запуске
+            if result:
+                clear_pending_digests(db, email.user_id, email.event_ids)
+
+        successful, failed = run_campaign(
+            ((user, pending[user.id]) for user in users), template, rollback_on_error(db, on_result)
+        )
+
+        duration_seconds = time.time() - start_time
+        log = NewsletterLog(
+            total_users=total_users,
+            successful_sends=successful,
+            failed_sends=failed,
+            duration_seconds=duration_seconds
+        )
+        db.add(log)
+        db.commit()
+        logger.info(f"📊 Digest finished! Success: {successful}, Failed: {failed}, Duration: {duration_seconds:.2f}s")
+        return successful, failed
+
+    except Exception as e:
+        logger.error(f"💥 Critical error in digest delivery: {str(e)}")
+        return 0, 0
+
+
+def replay_dead_letters(db: Session, ids: Optional[List[int]] = None) -> Tuple[int, int, int]:
+    """
+    Повторно отправляет письма из dead-letter (ids — выбранные, иначе все
+    ждущие разбора). Письмо собирается заново из ещё не доставленных
+    предстоящих событий; если таких не осталось или пользователь отписался,
+    повтор не нужен (discarded). Возвращает (replayed, successful, failed).
+    """
+    letters = load_dead_letters(db, ids, status=DEAD)
+    if not letters:
+        return 0, 0, 0
+    logger.info(f"🔁 Replaying {len(letters)} dead letters...")
+
+    # Несколько писем одному пользователю (из разных кампаний) уходят одним
+    letters_by_user = {}
+    for letter in letters:
+        letters_by_user.setdefault(letter.user_id, []).append(letter)
+    event_ids = {event_id for letter in letters for event_id in letter.event_ids}
+    events = {
+        event.id: event
+        for event in db.query(Event).filter(Event.id.in_(event_ids), *date_window_filter(upcoming_since()))
+    }
+    users = db.query(User).filter(User.id.in_(list(letters_by_user)), User.is_subscribed == True).all()
+    delivered = load_delivered_event_ids(db, events, [user.id for user in users])
+
+    jobs = []
+    found_ids = set()
+    for user in users:
+        user_event_ids = {event_id for letter in letters_by_user[user.id] for event_id in letter.event_ids}
+        user_events = [events[event_id] for event_id in sorted(user_event_ids) if event_id in events]
+        user_events = exclude_delivered(user_events, delivered.get(user.id))
+        if user_events:
+            jobs.append((user, user_events))
+            found_ids.add(user.id)
+    for user_id, user_letters in letters_by_user.items():
+        if user_id not in found_ids:
+            resolve_dead_letters(db, user_letters, DISCARDED)
+
+    def on_result(email: OutgoingEmail, result):
+        user_letters = letters_by_user[email.user_id]
+        if result:
+            logger.info(f"📩 Dead letter replayed to {email.to_email}")
+            record_delivered_events(db, email.user_id, email.event_ids)
+            clear_pending_digests(db, email.user_id, email.event_ids)
+            resolve_dead_letters(db, user_letters, REPLAYED, attempts=email.attempts)
+        else:
+            logger.error(f"❌ Dead letter replay failed for {email.to_email}")
+            resolve_dead_letters(db, user_letters, DEAD, attempts=email.attempts, error=getattr(result, "error", None))
+
+    template = jinja_env.get_template('newsletter.html')
+    successful, failed = run_campaign(jobs, template, rollback_on_error(db, on_result))
+    logger.info(f"📊 Dead letter replay finished! Success: {successful}, Failed: {failed}")
+    return len(letters), successful, failed
@@ -0,0 +1,350 @@
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from uuid import uuid4
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Session
+from typing import Dict, Iterator, List, Optional, Tuple
+from app.core.config import settings
+from app.database import insert_ignore
+from app.models import Event, NewsletterCampaign, NewsletterDelivery, User, delivered_events
+from app.services.delivery_history import exclude_delivered, load_delivered_event_ids
+from app.utils.event_matcher import date_window_filter, upcoming_since
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def open_campaign(
+    db: Session,
+    kind: str,
+    user_ids: Optional[List[int]] = None,
+    id_range: Optional[Tuple[int, Optional[int]]] = None
+) -> NewsletterCampaign:
+    """
+    Возвращает незавершённую кампанию того же вида (с теми же получателями
+    или тем же диапазоном id шарда) или создаёт новую. Письма в статусе sending прерванного запуска
+    отправляются повторно, когда истечёт их аренда (см. claim_pending): их
+    результат неизвестен, поэтому повторов не больше, чем было писем в
+    обработке на момент сбоя. Письма другого, ещё работающего запуска
+    остаются за ним.
+    """
+    user_ids = sorted(set(user_ids)) if user_ids is not None else None
+    expire_stale_campaigns(db)
+    campaign = db.query(NewsletterCampaign).filter(
+        NewsletterCampaign.kind == kind,
+        NewsletterCampaign.status == "running"
+    ).order_by(NewsletterCampaign.id.desc()).first()
+    if campaign is not None and campaign.user_ids == user_ids and campaign_range(campaign) == id_range:
+        logger.info(f"🔁 Resuming campaign {campaign.id}")
+        return campaign
+
+    after_user_id, upto_user_id = id_range or (None, None)
+    campaign = NewsletterCampaign(
+        kind=kind,
+        user_ids=user_ids,
+        after_user_id=after_user_id,
+        upto_user_id=upto_user_id,
+        status="running"
+    )
+    db.add(campaign)
+    db.commit()
+    db.refresh(campaign)
+    logger.info(f"🆕 Started campaign {campaign.id} ({kind})")
+    return campaign
+
+
+class CampaignAlreadyRunning(Exception):
+    """Кампания уже выполняется другим запуском (его аренда не истекла)."""
+
+    def __init__(self, campaign_id: int):
+        super().__init__(f"Campaign {campaign_id} is already running")
+        self.campaign_id = campaign_id
+
+
+def claim_campaign(db: Session, campaign_id: int, owner: str, now: Optional[datetime] = None) -> bool:
+    """
+    Берёт незавершённую кампанию в аренду запуска owner условным UPDATE:
+    только если она ничья, уже его или аренда другого запуска истекла
+    (OUTBOX_LEASE_SECONDS без продления). Работает между процессами и
+    экземплярами приложения; False — кампанию выполняет другой запуск.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+    claimed = db.query(NewsletterCampaign).filter(
+        NewsletterCampaign.id == campaign_id,
+        NewsletterCampaign.status == "running",
+        or_(
+            NewsletterCampaign.claimed_by.is_(None),
+            NewsletterCampaign.claimed_by == owner,
+            NewsletterCampaign.heartbeat_at.is_(None),
+            NewsletterCampaign.heartbeat_at < cutoff
+        )
+    ).update({
+        NewsletterCampaign.claimed_by: owner,
+        NewsletterCampaign.heartbeat_at: now,
+    }, synchronize_session=False)
+    db.commit()
+    return claimed == 1
+
+
+def release_campaign(db: Session, campaign_id: int, owner: str):
+    """Снимает аренду запуска owner, чтобы кампанию можно было сразу продолжить."""
+    db.query(NewsletterCampaign).filter(
+        NewsletterCampaign.id == campaign_id,
+        NewsletterCampaign.claimed_by == owner
+    ).update({NewsletterCampaign.claimed_by: None}, synchronize_session=False)
+    db.commit()
+
+
+@contextmanager
+def campaign_lease(db: Session, campaign_id: int, owner: Optional[str] = None) -> Iterator[str]:
+    """
+    Выполнение кампании под её арендой; выдаёт owner для claim_pending,
+    который продлевает аренду перед каждой пачкой. Если кампанию уже
+    выполняет другой запуск — CampaignAlreadyRunning.
+    """
+    owner = owner or uuid4().hex
+    if not claim_campaign(db, campaign_id, owner):
+        raise CampaignAlreadyRunning(campaign_id)
+    try:
+        yield owner
+    finally:
+        release_campaign(db, campaign_id, owner)
+
+
+def campaign_range(campaign: NewsletterCampaign) -> Optional[Tuple[int, Optional[int]]]:
+    """Диапазон id получателей шарда (after_id, upto_id]; None — кампания не ограничена диапазоном."""
+    if campaign.after_user_id is None and campaign.upto_user_id is None:
+        return None
+    return campaign.after_user_id or 0, campaign.upto_user_id
+
+
+def running_shard_campaigns(db: Session) -> List[NewsletterCampaign]:
+    """
+    Незавершённые кампании шардов (после сбоя части процессов), по id.
+    Кампании без сохранённого диапазона продолжить нельзя — они не
+    возвращаются и закрываются по сроку (expire_stale_campaigns).
+    """
+    expire_stale_campaigns(db)
+    return db.query(NewsletterCampaign).filter(
+        NewsletterCampaign.kind.like("shard:%"),
+        NewsletterCampaign.status == "running",
+        NewsletterCampaign.after_user_id.isnot(None)
+    ).order_by(NewsletterCampaign.id).all()
+
+
+def expire_stale_campaigns(db: Session, now: Optional[datetime] = None) -> int:
+    """
+    Закрывает (status expired) незавершённые кампании старше
+    NEWSLETTER_CAMPAIGN_MAX_AGE_HOURS: их не продолжают спустя дни, а
+    начинают заново с актуальным подбором. Оставшиеся в них письма не
+    отправляются.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(hours=settings.NEWSLETTER_CAMPAIGN_MAX_AGE_HOURS)
+    expired = db.query(NewsletterCampaign).filter(
+        NewsletterCampaign.status == "running",
+        NewsletterCampaign.created_at < cutoff
+    ).update({
+        NewsletterCampaign.status: "expired",
+        NewsletterCampaign.finished_at: func.now(),
+    }, synchronize_session=False)
+    db.commit()
+    if expired:
+        logger.info(f"⌛ Expired {expired} stale campaigns")
+    return expired
+
+
+def last_enqueued_user_id(db: Session, campaign_id: int) -> int:
+    """Наибольший id получателя, уже записанного в outbox (0 — ещё никого)."""
+    return db.query(func.max(NewsletterDelivery.user_id)).filter(
+        NewsletterDelivery.campaign_id == campaign_id
+    ).scalar() or 0
+
+
+def enqueue_deliveries(db: Session, campaign_id: int, events_by_user: Dict[int, List[int]]):
+    """
+    Записывает письма пачки получателей одним INSERT. Получатели без новых
+    событий сохраняются со статусом skipped — так outbox учитывает всех.
+    """
+    rows = [
+        {
+            "campaign_id": campaign_id,
+            "user_id": user_id,
+            "event_ids": event_ids,
+            "status": PENDING if event_ids else SKIPPED,
+            "attempts": 0,
+        }
+        for user_id, event_ids in events_by_user.items()
+    ]
+    if rows:
+        db.execute(NewsletterDelivery.__table__.insert(), rows)
+        db.commit()
+
+
+def _claimable(cutoff: datetime):
+    """Письмо можно забрать: ждёт отправки или его аренда истекла (или её нет — письмо из старого запуска)."""
+    return or_(
+        NewsletterDelivery.status == PENDING,
+        and_(
+            NewsletterDelivery.status == SENDING,
+            or_(NewsletterDelivery.heartbeat_at.is_(None), NewsletterDelivery.heartbeat_at < cutoff)
+        )
+    )
+
+
+def renew_lease(db: Session, campaign_id: int, owner: str, now: Optional[datetime] = None) -> int:
+    """Продлевает аренду кампании и писем запуска owner, которые ещё в отправке."""
+    now = now or datetime.utcnow()
+    db.query(NewsletterCampaign).filter(
+        NewsletterCampaign.id == campaign_id,
+        NewsletterCampaign.claimed_by == owner
+    ).update({NewsletterCampaign.heartbeat_at: now}, synchronize_session=False)
+    renewed = db.query(NewsletterDelivery).filter(
+        NewsletterDelivery.campaign_id == campaign_id,
+        NewsletterDelivery.claimed_by == owner,
+        NewsletterDelivery.status == SENDING
+    ).update({NewsletterDelivery.heartbeat_at: now}, synchronize_session=False)
+    db.commit()
+    return renewed
+
+
+def claim_pending(
+    db: Session,
+    campaign_id: int,
+    chunk_size: Optional[int] = None,
+    owner: Optional[str] = None
+) -> Iterator[Tuple[User, List[Event]]]:
+    """
+    Выдаёт (пользователь, события) для писем в статусе pending, пачками по id.
+    Пачка переводится в sending до выдачи, поэтому повторный вызов после
+    сбоя или отмены продолжает с того же места. Отписавшимся письма не
+    уходят, из писем убираются прошедшие и уже доставленные события.
+
+    Письмо забирается в аренду запуска owner условным UPDATE (только если оно
+    всё ещё pending или его аренда истекла), и выдаются только письма,
+    которые этот запуск действительно забрал, — два одновременных запуска
+    одной кампании не отправят одно письмо дважды. Перед каждой пачкой
+    аренда уже выданных и ещё не отправленных писем продлевается.
+    """
+    chunk_size = chunk_size or settings.MATCH_CHUNK_SIZE
+    owner = owner or uuid4().hex
+    last_id = 0
+    while True:
+        now = datetime.utcnow()
+        renew_lease(db, campaign_id, owner, now)
+        cutoff = now - timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+        candidate_ids = [row.id for row in db.query(NewsletterDelivery.id).filter(
+            NewsletterDelivery.campaign_id == campaign_id,
+            _claimable(cutoff),
+            NewsletterDelivery.id > last_id
+        ).order_by(NewsletterDelivery.id).limit(chunk_size)]
+        if not candidate_ids:
+            return
+        last_id = candidate_ids[-1]
+
+        db.query(NewsletterDelivery).filter(
+            NewsletterDelivery.id.in_(candidate_ids),
+            _claimable(cutoff)
+        ).update({
+            NewsletterDelivery.status: SENDING,
+            NewsletterDelivery.claimed_by: owner,
+            NewsletterDelivery.heartbeat_at: now,
+        }, synchronize_session=False)
+        db.commit()
+        deliveries = db.query(NewsletterDelivery.id, NewsletterDelivery.user_id, NewsletterDelivery.event_ids).filter(
+            NewsletterDelivery.id.in_(candidate_ids),
+            NewsletterDelivery.claimed_by == owner,
+            NewsletterDelivery.status == SENDING
+        ).order_by(NewsletterDelivery.id).all()
+        if len(deliveries) < len(candidate_ids):
+            logger.info(f"🔒 {len(candidate_ids) - len(deliveries)} deliveries of campaign {campaign_id} are claimed by another run")
+        if not deliveries:
+            continue
+
+        # Кампания может продолжаться спустя часы после постановки в очередь:
+        # подписка, окно дат и история доставки проверяются заново
+        users = {
+            user.id: user
+            for user in db.query(User).filter(
+                User.id.in_([delivery.user_id for delivery in deliveries]),
+                User.is_subscribed == True
+            )
+        }
+        event_ids = {event_id for delivery in deliveries for event_id in delivery.event_ids}
+        events = {
+            event.id: event
+            for event in db.query(Event).filter(Event.id.in_(event_ids), *date_window_filter(upcoming_since()))
+        }
+        delivered = load_delivered_event_ids(db, events, users)
+
+        for delivery in deliveries:
+            user = users.get(delivery.user_id)
+            user_events = [events[event_id] for event_id in delivery.event_ids if event_id in events]
+            user_events = exclude_delivered(user_events, delivered.get(delivery.user_id))
+            if user is None or not user_events:
+                # Пользователь удалён или отписался, события удалены, прошли
+                # или уже доставлены другой рассылкой
+                mark_skipped(db, delivery.id)
+                continue
+            yield user, user_events
+
+
+def mark_skipped(db: Session, delivery_id: int):
+    db.query(NewsletterDelivery).filter(NewsletterDelivery.id == delivery_id).update(
+        {NewsletterDelivery.status: SKIPPED}, synchronize_session=False
+    )
+    db.commit()
+
+
+def record_delivery(db: Session, campaign_id: int, user_id: int, event_ids: List[int], result, attempts: int = 1):
+    """
+    Фиксирует результат отправки в outbox; для отправленного письма — ещё и
+    историю доставки, в той же транзакции. attempts — сколько попыток
+    отправки потребовалось (с учётом повторов в конвейере).
+    """
+    values = {
+        NewsletterDelivery.status: SENT if result else FAILED,
+        NewsletterDelivery.attempts: NewsletterDelivery.attempts + attempts,
+        NewsletterDelivery.provider_message_id: getattr(result, "message_id", None),
+        NewsletterDelivery.last_error: None if result else getattr(result, "error", None),
+    }
+    db.query(NewsletterDelivery).filter(
+        NewsletterDelivery.campaign_id == campaign_id,
+        NewsletterDelivery.user_id == user_id
+    ).update(values, synchronize_session=False)
+    if result and event_ids:
+        # Событие могло уже уйти пользователю другим путём (дайджест, повтор)
+        insert_ignore(db, delivered_events, [
+            {"user_id": user_id, "event_id": event_id} for event_id in event_ids
+        ])
+    db.commit()
+
+
+def campaign_counts(db: Session, campaign_id: int) -> Dict[str, int]:
+    """Число писем кампании по статусам."""
+    rows = db.query(NewsletterDelivery.status, func.count(NewsletterDelivery.id)).filter(
+        NewsletterDelivery.campaign_id == campaign_id
+    ).group_by(NewsletterDelivery.status).all()
+    return {status: count for status, count in rows}
+
+
+def finish_campaign(db: Session, campaign: NewsletterCampaign) -> Tuple[int, int, int]:
+    """
+    Закрывает кампанию и возвращает (total_users, successful, failed) по всему
+    outbox, включая письма, отправленные до перезапуска. Пропущенные
+    получатели считаются успешными, как и раньше.
+    """
+    counts = campaign_counts(db, campaign.id)
+    campaign.status = "completed"
+    campaign.finished_at = func.now()
+    db.commit()
+    total = sum(counts.values())
+    successful = counts.get(SENT, 0) + counts.get(SKIPPED, 0)
+    # Всё, что не отправлено и не пропущено (в т.ч. зависшее в sending), — неудача
+    return total, successful, total - successful
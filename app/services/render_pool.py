@@ -0,0 +1,150 @@
+import logging
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain, islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from app import models
+from app.core.config import settings
+from app.services.campaign_runner import OutgoingEmail, RenderedJob, render_in_process
+
+logger = logging.getLogger(__name__)
+
+# Поля, которые шаблоны писем читают у события и получателя, и ключи кэшей
+# рендеринга (FragmentCache, RenderCache) — всё, что уходит в процесс рендеринга
+EventRecord = namedtuple("EventRecord", ["id", "title", "description", "photo", "city", "url", "created_at", "updated_at"])
+RecipientRecord = namedtuple("RecipientRecord", ["id", "email", "unsubscribe_token"])
+
+Job = Tuple[models.User, List[models.Event]]
+PackedChunk = Tuple[List[EventRecord], List[Tuple[RecipientRecord, Tuple[int, ...]]]]
+
+
+def pack_chunk(jobs: List[Job]) -> PackedChunk:
+    """
+    Пачка писем для процесса рендеринга: события пачки — один список
+    кортежей (общие события сегмента передаются один раз), получатели —
+    кортежи с номерами своих событий в этом списке.
+    """
+    events, positions, recipients = [], {}, []
+    for user, user_events in jobs:
+        indexes = []
+        for event in user_events:
+            position = positions.get(id(event))
+            if position is None:
+                position = positions[id(event)] = len(events)
+                events.append(EventRecord(*(getattr(event, name) for name in EventRecord._fields)))
+            indexes.append(position)
+        recipients.append((RecipientRecord(user.id, user.email, user.unsubscribe_token), tuple(indexes)))
+    return events, recipients
+
+
+# Рендерер процесса рендеринга, создаётся один раз при его запуске
+_worker_render: Optional[Callable] = None
+
+
+def _init_worker(template_name: str):
+    global _worker_render
+    from app.services import newsletter_service
+    _worker_render = newsletter_service.make_renderer(newsletter_service.jinja_env.get_template(template_name))
+
+
+def render_chunk(events: List[EventRecord], recipients) -> List[Tuple[Optional[OutgoingEmail], Optional[str]]]:
+    """Выполняется в процессе рендеринга: (письмо, None) или (None, ошибка) на каждого получателя по порядку."""
+    from app.services.email_service import html_to_text
+
+    results = []
+    for recipient, indexes in recipients:
+        try:
+            email = _worker_render(recipient, [events[index] for index in indexes])
+            if email.text_body is None:
+                email.text_body = html_to_text(email.html_body)
+            results.append((email, None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+class RenderPool:
+    """
+    Стадия рендеринга конвейера рассылки в пуле процессов: рендеринг Jinja и
+    текстовая часть письма упираются в процессор, а потоки ему не помогают
+    из-за GIL.
+
+    Письма уходят в процессы пачками по chunk_size — в виде кортежей
+    (pack_chunk), без ORM-объектов и сессии; готовые письма возвращаются в
+    исходном порядке. Впереди отправки рендерится не больше двух пачек на
+    процесс, поэтому обратное давление конвейера сохраняется. Каждый процесс
+    держит свои кэши рендеринга (make_renderer) на всю кампанию.
+
+    Запуск процессов стоит дороже рендеринга небольшой рассылки, поэтому
+    кампания меньше min_jobs писем рендерится в текущем процессе (render),
+    как и пачки, которые не удалось отрендерить из-за сбоя пула.
+    """
+
+    def __init__(
+        self,
+        render: Callable[[models.User, List[models.Event]], OutgoingEmail],
+        template_name: str = "newsletter.html",
+        workers: Optional[int] = None,
+        chunk_size: Optional[int] = None,
+        min_jobs: Optional[int] = None
+    ):
+        self.render = render
+        self.template_name = template_name
+        self.workers = workers or settings.RENDER_WORKERS
+        self.chunk_size = max(chunk_size or settings.RENDER_CHUNK_SIZE, 1)
+        self.min_jobs = settings.RENDER_POOL_MIN_JOBS if min_jobs is None else min_jobs
+        self.pooled = 0
+
+    def _collect(self, chunk: List[Job], future) -> Iterator[RenderedJob]:
+        try:
+            results = iter(future.result())
+        except Exception as e:
+            logger.error(f"⚠️ Render pool failed, rendering {len(chunk)} emails in-process: {str(e)}")
+            yield from render_in_process(chunk, self.render)
+            return
+        self.pooled += len(chunk)
+        for user, events in chunk:
+            if not events:
+                yield user, events, None
+                continue
+            email, error = next(results)
+            yield user, events, email if error is None else RuntimeError(error)
+
+    def __call__(self, jobs: Iterable[Job]) -> Iterator[RenderedJob]:
+        jobs = iter(jobs)
+        head = list(islice(jobs, self.min_jobs))
+        if len(head) < self.min_jobs or self.workers < 1:
+            yield from render_in_process(chain(head, jobs), self.render)
+            return
+
+        logger.info(f"🧮 Rendering emails in {self.workers} processes")
+        jobs = chain(head, jobs)
+        pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.template_name,)
+        )
+        pending = deque()
+        try:
+            while True:
+                chunk = list(islice(jobs, self.chunk_size))
+                if not chunk:
+                    break
+                try:
+                    future = pool.submit(render_chunk, *pack_chunk([job for job in chunk if job[1]]))
+                except BrokenProcessPool as e:
+                    logger.error(f"⚠️ Render pool is broken, rendering the rest in-process: {str(e)}")
+                    while pending:
+                        yield from self._collect(*pending.popleft())
+                    yield from render_in_process(chain(chunk, jobs), self.render)
+                    return
+                pending.append((chunk, future))
+                while len(pending) > 2 * self.workers:
+                    yield from self._collect(*pending.popleft())
+            while pending:
+                yield from self._collect(*pending.popleft())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,58 @@
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from typing import Iterator, List, Optional, Tuple
+from app.core.config import settings
+from app.models import User
+
+
+def count_subscribed_users(db: Session) -> int:
+    """Число подписчиков отдельным COUNT, без загрузки пользователей."""
+    return db.query(func.count(User.id)).filter(User.is_subscribed == True).scalar()
+
+
+def iter_subscribed_users(
+    db: Session,
+    chunk_size: Optional[int] = None,
+    after_id: int = 0,
+    upto_id: Optional[int] = None
+) -> Iterator[List[User]]:
+    """
+    Отдаёт подписчиков с after_id < id <= upto_id пачками по chunk_size с keyset-пагинацией
+    по id: в памяти одновременно только одна пачка, а между пачками можно делать
+    commit (в отличие от серверного курсора, который commit закрывает).
+    """
+    chunk_size = chunk_size or settings.MATCH_CHUNK_SIZE
+    last_id = after_id
+    while True:
+        query = db.query(User).filter(
+            User.is_subscribed == True,
+            User.id > last_id
+        )
+        if upto_id is not None:
+            query = query.filter(User.id <= upto_id)
+        users = query.order_by(User.id).limit(chunk_size).all()
+        if not users:
+            return
+        yield users
+        last_id = users[-1].id
+
+
+def shard_boundaries(db: Session, shards: int) -> List[Tuple[int, Optional[int]]]:
+    """
+    Делит подписчиков по id на shards диапазонов (after_id, upto_id] примерно
+    равного размера. Последний диапазон открыт сверху, чтобы захватить
+    подписавшихся во время рассылки.
+    """
+    total = count_subscribed_users(db)
+    bounds = [0]
+    for shard in range(1, shards):
+        offset = total * shard // shards
+        if offset == 0:
+            continue
+        boundary = db.query(User.id).filter(User.is_subscribed == True).order_by(User.id).offset(offset - 1).limit(1).scalar()
+        if boundary is not None and boundary > bounds[-1]:
+            bounds.append(boundary)
+    return [
+        (after_id, bounds[i + 1] if i + 1 < len(bounds) else None)
+        for i, after_id in enumerate(bounds)
+    ]
@@ -1,31 +1,72 @@
+import heapq
+import itertools
 import logging
+import random
 import time
-from functools import wraps
+from typing import Any, Callable, List, Optional
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
-def background_task_with_retry(max_retries=3, delay=60):
-    """Декоратор для повтора фоновых задач при ошибках"""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            last_error = None
-            for attempt in range(1, max_retries + 1):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    last_error = e
-                    logger.warning(f"Attempt {attempt} failed for {func.__name__}: {str(e)}")
-                    if attempt < max_retries:
-                        time.sleep(delay * attempt)
-            logger.error(f"Task {func.__name__} failed after {max_retries} attempts: {str(last_error)}")
-            raise last_error
-        return wrapper
-    return decorator
-
-# Пример использования в email_service.py
-@background_task_with_retry(max_retries=3, delay=30)
-def send_email_via_postmark(to_email: str, subject: str, html_body: str):
-    # существующая логика
-    pass
\ No newline at end of file
+
+class RetryQueue:
+    """
+    Очередь повторных попыток с экспоненциальной задержкой и случайным
+    разбросом (full jitter): повтор после n-й неудачной попытки откладывается
+    на случайное время от 0 до min(max_delay, base_delay * 2 ** (n - 1)).
+
+    Очередь не блокирует: элементы с наступившим сроком забираются через
+    pop_due, а до тех пор вызывающий продолжает свою работу; next_delay
+    подсказывает, сколько можно ждать до ближайшего повтора.
+    """
+
+    def __init__(
+        self,
+        max_attempts: Optional[int] = None,
+        base_delay: Optional[float] = None,
+        max_delay: Optional[float] = None,
+        rng: Optional[random.Random] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.max_attempts = max_attempts or settings.EMAIL_MAX_ATTEMPTS
+        self.base_delay = base_delay if base_delay is not None else settings.EMAIL_RETRY_BASE_SECONDS
+        self.max_delay = max_delay if max_delay is not None else settings.EMAIL_RETRY_MAX_SECONDS
+        self._rng = rng or random.Random()
+        self._clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self.scheduled = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def can_retry(self, attempts: int) -> bool:
+        """Остались ли попытки после attempts уже сделанных."""
+        return attempts < self.max_attempts
+
+    def backoff(self, attempts: int) -> float:
+        """Задержка перед повтором после attempts неудачных попыток."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** max(attempts - 1, 0))
+        return self._rng.uniform(0, ceiling)
+
+    def schedule(self, item: Any, attempts: int) -> float:
+        """Откладывает item на время backoff(attempts); возвращает задержку."""
+        delay = self.backoff(attempts)
+        # Счётчик — второй ключ: элементы с одинаковым сроком не сравниваются между собой
+        heapq.heappush(self._heap, (self._clock() + delay, next(self._counter), item))
+        self.scheduled += 1
+        return delay
+
+    def pop_due(self) -> List[Any]:
+        """Забирает все элементы, срок повтора которых наступил."""
+        now = self._clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def next_delay(self) -> Optional[float]:
+        """Секунды до ближайшего повтора (0 — уже пора); None, если очередь пуста."""
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - self._clock(), 0.0)
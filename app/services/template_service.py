@@ -1,27 +1,141 @@
+import logging
+import os
+import sys
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from fastapi.templating import Jinja2Templates
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader, select_autoescape
+from typing import List, Optional
 from app.core.config import settings
+from app.utils.html_minify import minify_html
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIR = Path(__file__).parent.parent / "templates"
+EMAIL_TEMPLATES_DIR = TEMPLATES_DIR / "emails"
+EMAIL_TEMPLATE_EXTENSIONS = ("html", "txt")
+
+
+def bytecode_cache() -> Optional[FileSystemBytecodeCache]:
+    """
+    Кэш скомпилированного байткода шаблонов на диске: после перезапуска
+    шаблоны не разбираются и не компилируются заново, пока не изменятся.
+    Без TEMPLATES_BYTECODE_CACHE_DIR используется временный каталог Jinja.
+    """
+    if not settings.TEMPLATES_BYTECODE_CACHE:
+        return None
+    if settings.TEMPLATES_BYTECODE_CACHE_DIR:
+        os.makedirs(settings.TEMPLATES_BYTECODE_CACHE_DIR, exist_ok=True)
+        return FileSystemBytecodeCache(settings.TEMPLATES_BYTECODE_CACHE_DIR)
+    return FileSystemBytecodeCache()
+
+
+class MinifyingLoader(BaseLoader):
+    """
+    Отдаёт HTML-шаблоны минифицированными (minify_html): минификация
+    выполняется один раз при компиляции шаблона, а не на каждое письмо,
+    и попадает в кэш байткода и скомпилированные модули.
+    """
+
+    def __init__(self, loader: BaseLoader, extensions=("html",)):
+        self.loader = loader
+        self.extensions = tuple(extensions)
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = self.loader.get_source(environment, template)
+        if template.rsplit(".", 1)[-1] in self.extensions:
+            source = minify_html(source)
+        return source, filename, uptodate
+
+    def list_templates(self):
+        return self.loader.list_templates()
+
+
+def source_loader() -> BaseLoader:
+    """Загрузчик исходников шаблонов писем; с EMAIL_TEMPLATES_MINIFY — минифицирующий."""
+    loader = FileSystemLoader(EMAIL_TEMPLATES_DIR)
+    return MinifyingLoader(loader) if settings.EMAIL_TEMPLATES_MINIFY else loader
+
+
+def create_email_environment(loader: Optional[BaseLoader] = None) -> Environment:
+    """
+    Окружение шаблонов писем. Если EMAIL_TEMPLATES_COMPILED_DIR указывает на
+    шаблоны, заранее скомпилированные compile_email_templates, они
+    загружаются как модули Python, без разбора исходников. Автоперезагрузка
+    (os.stat файла при каждом get_template) включается только
+    TEMPLATES_AUTO_RELOAD — для разработки.
+    """
+    if loader is None:
+        compiled_dir = settings.EMAIL_TEMPLATES_COMPILED_DIR
+        if compiled_dir and os.path.isdir(compiled_dir):
+            loader = ModuleLoader(compiled_dir)
+        else:
+            loader = source_loader()
+    return Environment(
+        loader=loader,
+        autoescape=select_autoescape(['html', 'xml']),
+        auto_reload=settings.TEMPLATES_AUTO_RELOAD,
+        bytecode_cache=bytecode_cache()
+    )
+
+
+def email_template_names() -> List[str]:
+    return FileSystemLoader(EMAIL_TEMPLATES_DIR).list_templates()
+
+
+def precompile_email_templates(env: Optional[Environment] = None) -> int:
+    """
+    Загружает все шаблоны писем заранее (при старте приложения), чтобы
+    первая рассылка не тратила время на их разбор и компиляцию.
+    Возвращает число шаблонов.
+    """
+    env = env or email_env
+    names = [name for name in email_template_names() if name.rsplit(".", 1)[-1] in EMAIL_TEMPLATE_EXTENSIONS]
+    for name in names:
+        env.get_template(name)
+    logger.info(f"🧩 Precompiled {len(names)} email templates")
+    return len(names)
+
+
+def compile_email_templates(target: str):
+    """Компилирует шаблоны писем в модули Python для EMAIL_TEMPLATES_COMPILED_DIR."""
+    env = create_email_environment(source_loader())
+    env.compile_templates(target, extensions=EMAIL_TEMPLATE_EXTENSIONS, zip=None, ignore_errors=False)
+
+
+# Общее окружение шаблонов писем для всего приложения
+email_env = create_email_environment()
+
+# Общие шаблоны страниц (админка)
+page_templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader(TEMPLATES_DIR),
+    autoescape=True,
+    auto_reload=settings.TEMPLATES_AUTO_RELOAD,
+    bytecode_cache=bytecode_cache()
+))
+
 
 class TemplateService:
-    def __init__(self):
-        self.template_dir = Path(__file__).parent.parent / "templates" / "emails"
-        self.env = Environment(
-            loader=FileSystemLoader(self.template_dir),
-            autoescape=select_autoescape(['html', 'xml'])
-        )
-    
+    def __init__(self, env: Optional[Environment] = None):
+        self.env = env or email_env
+
     def render_newsletter_template(self, user, events, **kwargs):
         """Рендер шаблона рассылки для пользователя"""
         template = self.env.get_template("newsletter.html")
-        
+
         context = {
             "user": user,
             "events": events,
             "unsubscribe_url": f"{settings.BASE_URL}/api/unsubscribe/{user.id}",
             **kwargs
         }
-        
+
         return template.render(context)
 
 # Создаем папку для шаблонов
-template_service = TemplateService()
\ No newline at end of file
+template_service = TemplateService()
+
+
+if __name__ == "__main__":
+    # python -m app.services.template_service build/email_templates
+    compile_email_templates(sys.argv[1])
+    print(f"Email templates compiled to {sys.argv[1]}")
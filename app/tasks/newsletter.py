@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy.orm import Session
+from typing import List, Optional, Tuple
+from app.core.config import settings
+from app.database import SessionLocal
+from app.models import NewsletterCampaign, NewsletterLog
+from app.services.outbox import campaign_range, running_shard_campaigns
+from app.services.subscribers import shard_boundaries
+
+logger = logging.getLogger(__name__)
+
+
+def run_newsletter_job(campaign_id: int, owner: str):
+    """
+    Фоновая задача рассылки всем подписчикам по открытой кампании: одна
+    сессия БД на всю кампанию, закрывается по завершении. Вызывающий
+    должен сначала взять кампанию в аренду owner (outbox.claim_campaign) —
+    тогда повторный запуск, в том числе из другого процесса, её не начнёт.
+    """
+    from app.services import newsletter_service
+
+    db = SessionLocal()
+    try:
+        campaign = db.get(NewsletterCampaign, campaign_id)
+        if campaign is None or campaign.status != "running":
+            logger.warning(f"Campaign {campaign_id} not found or already finished")
+            return
+        newsletter_service.send_newsletter_to_all_users(db, campaign=campaign, owner=owner)
+    except Exception as e:
+        logger.error(f"💥 Campaign {campaign_id} failed: {str(e)}")
+    finally:
+        db.close()
+
+
+def run_shard(kind: str, count: int, after_id: int, upto_id: Optional[int]) -> Tuple[int, int, int]:
+    """
+    Точка входа процесса-шарда: рассылка подписчикам с after_id < id <= upto_id
+    по кампании kind со своей сессией БД, своим HTTP-клиентом и своей долей
+    лимита скорости (count — число одновременно работающих шардов).
+    """
+    from app.services import email_service, newsletter_service
+
+    # Лимит провайдера общий на все процессы — каждому шарду достаётся его доля
+    email_service.rate_limiter = email_service.RateLimiter(
+        rate=settings.EMAIL_RATE_PER_SECOND / count,
+        burst=max(settings.EMAIL_RATE_BURST // count, 1)
+    )
+    db = SessionLocal()
+    try:
+        logger.info(f"🧵 Shard {kind}: users ({after_id}, {upto_id or '∞'}]")
+        return newsletter_service.run_all_users_campaign(
+            db,
+            kind=kind,
+            after_id=after_id,
+            upto_id=upto_id
+        )
+    finally:
+        db.close()
+        email_service.postmark_client.close()
+
+
+def plan_shards(db: Session, shards: int) -> List[Tuple[str, int, Optional[int]]]:
+    """
+    Шарды запуска: (kind, after_id, upto_id). Если после сбоя остались
+    незавершённые кампании шардов, продолжаются только они — по диапазонам,
+    сохранённым в кампаниях: новое разбиение сдвинуло бы границы, и часть
+    подписчиков попала бы в чужой шард или не попала никуда. Иначе
+    подписчики делятся заново.
+    """
+    resumed = running_shard_campaigns(db)
+    if resumed:
+        logger.info(f"🔁 Resuming {len(resumed)} unfinished shards")
+        return [
+            (campaign.kind, *campaign_range(campaign))
+            for campaign in resumed
+        ]
+    ranges = shard_boundaries(db, shards)
+    return [
+        (f"shard:{index}/{len(ranges)}", after_id, upto_id)
+        for index, (after_id, upto_id) in enumerate(ranges)
+    ]
+
+
+def send_newsletter_sharded(db: Session, shards: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Рассылка всем подписчикам в нескольких процессах без внешнего брокера:
+    пространство id делится на диапазоны, каждый диапазон обрабатывает свой
+    процесс (ProcessPoolExecutor, start method "spawn" — без унаследованных
+    соединений). Счётчики шардов сводятся в одну запись NewsletterLog.
+    Шард, упавший с ошибкой, продолжит свою кампанию при следующем запуске.
+    """
+    start_time = time.time()
+    shards = shards or settings.NEWSLETTER_SHARDS
+    plan = plan_shards(db, shards)
+    logger.info(f"🎯 Starting sharded newsletter campaign: {len(plan)} shards")
+
+    total_users = successful = failed = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(plan), mp_context=context) as pool:
+        futures = [
+            pool.submit(run_shard, kind, len(plan), after_id, upto_id)
+            for kind, after_id, upto_id in plan
+        ]
+        for (kind, _, _), future in zip(plan, futures):
+            try:
+                shard_total, shard_successful, shard_failed = future.result()
+            except Exception as e:
+                logger.error(f"💥 Shard {kind} failed: {str(e)}")
+                continue
+            total_users += shard_total
+            successful += shard_successful
+            failed += shard_failed
+
+    duration_seconds = time.time() - start_time
+    log = NewsletterLog(
+        total_users=total_users,
+        successful_sends=successful,
+        failed_sends=failed,
+        duration_seconds=duration_seconds
+    )
+    db.add(log)
+    db.commit()
+    logger.info(f"📊 Sharded newsletter finished! Success: {successful}, Failed: {failed}, Duration: {duration_seconds:.2f}s")
+    return successful, failed
@@ -0,0 +1,103 @@
+import numpy as np
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+from app import models
+from app.utils.event_matcher import date_window_filter
+from app.utils.taxonomy import split_categories
+
+WORD_BITS = 64
+
+
+class BitmaskMatcher:
+    """
+    Векторизованный подбор событий для больших рассылок.
+
+    Каждой категории и каждой корзине города назначается бит. События и
+    пользователи кодируются битовыми масками (массивы uint64 по 64 бита
+    в слове), и матрица совпадений пользователь×событие считается
+    поэлементным AND по пачкам пользователей. Правила те же, что
+    у get_events_for_user: хотя бы одна общая категория и общая корзина
+    города; порядок событий — порядок, в котором они переданы.
+    """
+
+    def __init__(self, events: Sequence[models.Event]):
+        self.events = list(events)
+        self.category_bits: Dict[str, int] = {}
+        self.city_bits: Dict[str, int] = {}
+
+        event_categories = [split_categories(event.category) for event in self.events]
+        for categories in event_categories:
+            for category in categories:
+                self.category_bits.setdefault(category, len(self.category_bits))
+        for event in self.events:
+            if event.city_bucket is not None:
+                self.city_bits.setdefault(event.city_bucket, len(self.city_bits))
+
+        self.category_words = max(1, -(-len(self.category_bits) // WORD_BITS))
+        self.city_words = max(1, -(-len(self.city_bits) // WORD_BITS))
+        self.event_category_masks = np.stack(
+            [self._encode(c, self.category_bits, self.category_words) for c in event_categories]
+        ) if self.events else np.zeros((0, self.category_words), dtype=np.uint64)
+        self.event_city_masks = np.stack(
+            [self._encode([e.city_bucket], self.city_bits, self.city_words) for e in self.events]
+        ) if self.events else np.zeros((0, self.city_words), dtype=np.uint64)
+
+    @classmethod
+    def load(cls, db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None) -> "BitmaskMatcher":
+        events = db.query(models.Event).filter(
+            *date_window_filter(since, until)
+        ).order_by(
+            models.Event.created_at.desc()
+        ).all()
+        return cls(events)
+
+    @staticmethod
+    def _encode(values: Iterable[Optional[str]], bits: Dict[str, int], words: int) -> np.ndarray:
+        mask = np.zeros(words, dtype=np.uint64)
+        for value in values:
+            bit = bits.get(value)
+            if bit is not None:
+                mask[bit // WORD_BITS] |= np.uint64(1) << np.uint64(bit % WORD_BITS)
+        return mask
+
+    @staticmethod
+    def _intersects(user_masks: np.ndarray, event_masks: np.ndarray) -> np.ndarray:
+        # (users, words) & (events, words) -> (users, events): есть ли общий бит
+        return np.bitwise_and(user_masks[:, None, :], event_masks[None, :, :]).any(axis=2)
+
+    def match_matrix(self, preferences: Sequence[Tuple[Iterable[str], Iterable[str]]]) -> np.ndarray:
+        """Булева матрица совпадений для списка предпочтений (categories, cities)."""
+        user_categories = np.stack(
+            [self._encode(c, self.category_bits, self.category_words) for c, _ in preferences]
+        ) if preferences else np.zeros((0, self.category_words), dtype=np.uint64)
+        user_cities = np.stack(
+            [self._encode(c, self.city_bits, self.city_words) for _, c in preferences]
+        ) if preferences else np.zeros((0, self.city_words), dtype=np.uint64)
+        return (
+            self._intersects(user_categories, self.event_category_masks)
+            & self._intersects(user_cities, self.event_city_masks)
+        )
+
+    def match(self, categories: Iterable[str], cities: Iterable[str]) -> List[models.Event]:
+        row = self.match_matrix([(list(categories), list(cities))])[0]
+        return [self.events[i] for i in np.flatnonzero(row)]
+
+    def match_many(
+        self,
+        preferences: Dict[Hashable, Tuple[Iterable[str], Iterable[str]]],
+        chunk_size: int = 512
+    ) -> Dict[Hashable, List[models.Event]]:
+        """
+        Подбирает события для многих пользователей (или сегментов) сразу.
+        Матрица считается пачками по chunk_size строк, чтобы промежуточный
+        массив users×events×words оставался ограниченным по памяти.
+        """
+        keys = list(preferences)
+        result = {}
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            matrix = self.match_matrix([preferences[key] for key in chunk])
+            for key, row in zip(chunk, matrix):
+                result[key] = [self.events[i] for i in np.flatnonzero(row)]
+        return result
@@ -1,5 +1,6 @@
 from typing import Dict, Optional, List
 from app import schemas
+from app.utils.taxonomy import split_categories
 
 def parse_csv_row(row: Dict) -> Optional[schemas.EventCreate]:
     """
@@ -30,13 +31,12 @@ def parse_csv_row(row: Dict) -> Optional[schemas.EventCreate]:
             print(f"Skipping row - missing title or url: title='{title}', url='{url}'")
             return None
 
-        # Обрабатываем категории (разделены ;)
+        # Обрабатываем категории (разделены ;); нормализованная строка
+        # раскладывается в event_categories при сохранении события
         categories_list = []
         if category and category != 'None':
-            if ';' in category:
-                categories_list = [cat.strip() for cat in category.split(';') if cat.strip()]
-            else:
-                categories_list = [category]
+            categories_list = split_categories(category)
+            category = ';'.join(categories_list)
 
         # Обрабатываем даты
         dates_str = characteristics.get('Дата', '').strip().strip('"')
@@ -0,0 +1,85 @@
+import re
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+# Месяцы в родительном падеже, сопоставление по первым трём буквам
+MONTHS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'мая': 5, 'май': 5,
+    'июн': 6, 'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12,
+}
+
+ISO_DATE_RE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+NUMERIC_DATE_RE = re.compile(r'\b(\d{1,2})\.(\d{1,2})(?:\.(\d{4}|\d{2}))?\b')
+# "24 августа", "24-26 августа", "24 августа 2025"
+TEXT_DATE_RE = re.compile(r'(\d{1,2})(?:\s*[-–—]\s*(\d{1,2}))?\s+([а-яё]+)(?:\s+(\d{4}))?', re.IGNORECASE)
+
+# Дата без года, которая оказалась бы старше этого срока, относится к следующему году
+YEAR_ROLLOVER = timedelta(days=183)
+
+
+def _make_date(year: Optional[int], month: int, day: int, reference: date) -> Optional[date]:
+    try:
+        if year is not None:
+            if year < 100:
+                year += 2000
+            return date(year, month, day)
+        value = date(reference.year, month, day)
+        if value < reference - YEAR_ROLLOVER:
+            value = date(reference.year + 1, month, day)
+        return value
+    except ValueError:
+        return None
+
+
+def parse_date_string(value: str, reference: date) -> List[date]:
+    """Извлекает все даты из строки вида "24 августа", "24-26 августа", "2024-12-01", "24.08"."""
+    result = []
+
+    iso_matches = ISO_DATE_RE.findall(value)
+    for year, month, day in iso_matches:
+        parsed = _make_date(int(year), int(month), int(day), reference)
+        if parsed:
+            result.append(parsed)
+    if iso_matches:
+        return result
+
+    for day_from, day_to, month_name, year in TEXT_DATE_RE.findall(value):
+        month = MONTHS.get(month_name.lower()[:3])
+        if not month:
+            continue
+        year = int(year) if year else None
+        for day in filter(None, (day_from, day_to)):
+            parsed = _make_date(year, month, int(day), reference)
+            if parsed:
+                result.append(parsed)
+    if result:
+        return result
+
+    for day, month, year in NUMERIC_DATE_RE.findall(value):
+        parsed = _make_date(int(year) if year else None, int(month), int(day), reference)
+        if parsed:
+            result.append(parsed)
+    return result
+
+
+def parse_event_dates(
+    dates: Optional[Iterable[str]],
+    reference: Optional[datetime] = None
+) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """
+    Переводит свободные строки Event.dates в диапазон (starts_at, ends_at).
+
+    starts_at — начало первого дня, ends_at — конец последнего. Год, если он
+    не указан, берётся относительно reference (по умолчанию — сейчас).
+    Если ни одной даты распознать не удалось, возвращается (None, None).
+    """
+    reference_date = (reference or datetime.now()).date()
+    parsed = []
+    for value in dates or []:
+        if value:
+            parsed.extend(parse_date_string(str(value), reference_date))
+    if not parsed:
+        return None, None
+    starts_at = datetime.combine(min(parsed), time.min)
+    ends_at = datetime.combine(max(parsed), time.max)
+    return starts_at, ends_at
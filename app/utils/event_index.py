@@ -0,0 +1,83 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy.orm import Session
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from app import models
+from app.utils.event_matcher import date_window_filter
+from app.utils.taxonomy import split_categories
+
+
+def load_user_preferences(db: Session, user_ids: Optional[Iterable[int]] = None) -> Dict[int, Tuple[List[str], List[str]]]:
+    """
+    Загружает категории и города пользователей двумя запросами.
+    Если user_ids не передан — загружаются предпочтения всех пользователей.
+    """
+    categories_stmt = models.user_categories.select()
+    cities_stmt = models.user_cities.select()
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        categories_stmt = categories_stmt.where(models.user_categories.c.user_id.in_(user_ids))
+        cities_stmt = cities_stmt.where(models.user_cities.c.user_id.in_(user_ids))
+
+    preferences = defaultdict(lambda: ([], []))
+    for row in db.execute(categories_stmt).fetchall():
+        preferences[row.user_id][0].append(row.category)
+    for row in db.execute(cities_stmt).fetchall():
+        preferences[row.user_id][1].append(row.city)
+    return dict(preferences)
+
+
+class EventIndex:
+    """
+    Индекс событий в памяти для одной рассылки.
+
+    События загружаются один раз, после чего подбор для каждого пользователя
+    сводится к пересечению множеств без обращений к БД. Результат совпадает
+    с get_events_for_user: те же правила по категориям и городам и тот же
+    порядок (created_at по убыванию).
+    """
+
+    def __init__(self, events: List[models.Event]):
+        self.events = list(events)
+        self._by_category: Dict[str, Set[int]] = defaultdict(set)
+        self._by_city: Dict[str, Set[int]] = defaultdict(set)
+
+        for position, event in enumerate(self.events):
+            for category in split_categories(event.category):
+                self._by_category[category].add(position)
+            if event.city_bucket is not None:
+                self._by_city[event.city_bucket].add(position)
+
+    @classmethod
+    def load(cls, db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None) -> "EventIndex":
+        """Загружает события, идущие в окне [since, until] (см. date_window_filter)."""
+        events = db.query(models.Event).filter(
+            *date_window_filter(since, until)
+        ).order_by(
+            models.Event.created_at.desc()
+        ).all()
+        return cls(events)
+
+    def match(self, categories: Iterable[str], cities: Iterable[str]) -> List[models.Event]:
+        """Подбирает события по категориям и городам пользователя."""
+        category_positions = set()
+        for category in categories:
+            category_positions |= self._by_category.get(category, set())
+        if not category_positions:
+            return []
+
+        city_positions = set()
+        for city in cities:
+            city_positions |= self._by_city.get(city, set())
+        if not city_positions:
+            return []
+
+        return [self.events[i] for i in sorted(category_positions & city_positions)]
+
+    def match_many(self, preferences: Dict[Hashable, Tuple[Iterable[str], Iterable[str]]]) -> Dict[Hashable, List[models.Event]]:
+        """Подбор для многих ключей (пользователей или сегментов) — тот же интерфейс, что у BitmaskMatcher."""
+        return {key: self.match(categories, cities) for key, (categories, cities) in preferences.items()}
+
+    def match_user(self, preferences: Dict[int, Tuple[List[str], List[str]]], user: models.User) -> List[models.Event]:
+        categories, cities = preferences.get(user.id, ([], []))
+        return self.match(categories, cities)
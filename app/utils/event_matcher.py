@@ -1,9 +1,40 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import or_, and_, not_
-from typing import List
+from sqlalchemy import and_, or_, select
+from datetime import datetime, time
+from typing import Dict, Iterable, List, Optional
 from app import models
+from app.core.config import settings
 
-def get_events_for_user(db: Session, user: models.User) -> List[models.Event]:
+def upcoming_since() -> datetime:
+    """
+    Начало окна для «предстоящих» событий — полночь текущего дня.
+    ends_at хранит конец последнего дня события, поэтому результат
+    не меняется в течение суток.
+    """
+    return datetime.combine(datetime.now().date(), time.min)
+
+def date_window_filter(since: Optional[datetime] = None, until: Optional[datetime] = None) -> list:
+    """
+    Условия на пересечение [starts_at, ends_at] события с окном [since, until].
+    События без распознанных дат в окно попадают всегда.
+    """
+    conditions = []
+    if since is not None:
+        conditions.append(or_(models.Event.ends_at.is_(None), models.Event.ends_at >= since))
+    if until is not None:
+        conditions.append(or_(models.Event.starts_at.is_(None), models.Event.starts_at <= until))
+    return conditions
+
+def get_events_for_user(
+    db: Session,
+    user: models.User,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> List[models.Event]:
+    """
+    Подбирает события пользователя по категориям и городам.
+    since/until ограничивают выборку событиями, идущими в этом окне.
+    """
     # Получаем категории пользователя
     categories_stmt = models.user_categories.select().where(
         models.user_categories.c.user_id == user.id
@@ -21,46 +52,97 @@ def get_events_for_user(db: Session, user: models.User) -> List[models.Event]:
     cities_result = db.execute(cities_stmt).fetchall()
     user_cities = [row.city for row in cities_result]
     
+    return get_events_for_preferences(db, user_categories, user_cities, since, until)
+
+
+def get_events_for_preferences(
+    db: Session,
+    user_categories: List[str],
+    user_cities: List[str],
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> List[models.Event]:
+    """Подбор событий по уже загруженным категориям и городам пользователя."""
+    if not user_categories:
+        return []  # Если нет категорий — нет событий
     if not user_cities:
         return []  # Если нет городов — нет событий
     
-    # Определим основной список городов
-    main_cities = {'Подгорица', 'Будва', 'Херцег-Нови', 'Тиват', 'Бар'}
-    
-    # Формируем условия по категориям (как было)
-    cond_category = []
-    for category in user_categories:
-        cond_category.append(models.Event.category.like(f'%{category}%'))
-    
-    # Формируем условия по городам
-    cond_city = []
-    other_cities_selected = 'Другие города' in user_cities
-    for city in user_cities:
-        if city in main_cities:
-            cond_city.append(models.Event.city == city)
-        elif city == 'Другие города':
-            # Все города, которых нет в main_cities
-            cond_city.append(and_(
-                models.Event.city != None,
-                not_(models.Event.city.in_(main_cities))
-            ))
-    
-    # Если других городов нет, исключаем пустые строки
-    if not [c for c in user_cities if c != 'Другие города']:
-        cond_city = [and_(models.Event.city != None, not_(models.Event.city.in_(main_cities)))]
-    if not cond_city:
-        return []  # Без городов нет событий
-    
-    queries = []
-    for cc in cond_category:
-        for c in cond_city:
-            queries.append(and_(cc, c))
+    # События с категориями пользователя: равенство по индексу event_categories
+    category_event_ids = select(models.event_categories.c.event_id).where(
+        models.event_categories.c.category.in_(user_categories)
+    )
     
     # Отбираем события по категориям и городам, сортируем по дате
     events = db.query(models.Event).filter(
-        or_(*queries)
+        models.Event.id.in_(category_event_ids),
+        # Корзины событий — основные города и «Другие города», поэтому
+        # выбранные пользователем города сравниваются с ними напрямую
+        models.Event.city_bucket.in_(user_cities),
+        *date_window_filter(since, until)
     ).order_by(
         models.Event.created_at.desc()
     ).all()
     
     return events
+
+
+def get_events_for_users(
+    db: Session,
+    user_ids: Iterable[int],
+    chunk_size: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> Dict[int, List[models.Event]]:
+    """
+    Пакетный аналог get_events_for_user: {user_id: [event, ...]}.
+
+    Пары (пользователь, событие) подбираются одним SQL-запросом на пачку
+    пользователей: user_categories соединяется с event_categories по категории,
+    user_cities — с events.city_bucket по городу. Ещё один запрос догружает
+    события, которых не было в предыдущих пачках, — каждое событие читается
+    один раз. Порядок событий у каждого пользователя — created_at по убыванию;
+    since/until — как в get_events_for_user.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    chunk_size = chunk_size or settings.MATCH_CHUNK_SIZE
+    result = {user_id: [] for user_id in user_ids}
+    events: Dict[int, models.Event] = {}
+
+    uc = models.user_categories
+    ucity = models.user_cities
+    ec = models.event_categories
+
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        pairs = select(
+            uc.c.user_id, ec.c.event_id, models.Event.created_at
+        ).select_from(uc).join(
+            ec, ec.c.category == uc.c.category
+        ).join(
+            models.Event, models.Event.id == ec.c.event_id
+        ).join(
+            ucity, and_(
+                ucity.c.user_id == uc.c.user_id,
+                ucity.c.city == models.Event.city_bucket
+            )
+        ).where(
+            uc.c.user_id.in_(chunk),
+            *date_window_filter(since, until)
+        ).distinct().subquery()
+
+        stmt = select(pairs.c.user_id, pairs.c.event_id).order_by(
+            pairs.c.user_id,
+            pairs.c.created_at.desc()
+        )
+        rows = db.execute(stmt).fetchall()
+
+        missing = {event_id for _, event_id in rows if event_id not in events}
+        if missing:
+            for event in db.query(models.Event).filter(models.Event.id.in_(missing)):
+                events[event.id] = event
+
+        for user_id, event_id in rows:
+            result[user_id].append(events[event_id])
+
+    return result
@@ -0,0 +1,22 @@
+import re
+
+# Комментарии HTML, кроме условных комментариев Outlook (<!--[if mso]> ... <![endif]-->)
+_COMMENT_RE = re.compile(r"<!--(?!\[if|<!).*?-->", re.S)
+# Перевод строки с отступами между тегами HTML или блоками Jinja ({% ... %})
+_BETWEEN_TAGS_RE = re.compile(r"(>|%\})[ \t\r\n]*\n[ \t\r\n]*(?=<|\{%)")
+# Остальные переводы строк с отступами — внутри текста и тегов
+_NEWLINE_RE = re.compile(r"[ \t\r]*\n[ \t\r\n]*")
+
+
+def minify_html(source: str) -> str:
+    """
+    Минифицирует исходник HTML-шаблона Jinja: убирает комментарии HTML и
+    отступы. Перевод строки между тегами (и блоками {% %}) удаляется
+    целиком, внутри текста и тегов заменяется одним пробелом; пробелы внутри
+    строки не трогаются. Шаблоны с <pre> и <textarea> не поддерживаются;
+    строчные элементы, разнесённые по строкам, склеиваются без пробела.
+    """
+    source = _COMMENT_RE.sub("", source)
+    source = _BETWEEN_TAGS_RE.sub(r"\1", source)
+    source = _NEWLINE_RE.sub(" ", source)
+    return source.strip()
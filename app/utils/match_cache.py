@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+from app import models
+from app.core.config import settings
+from app.database import insert_ignore
+from app.utils.event_index import load_user_preferences
+from app.utils.event_matcher import get_events_for_preferences
+from app.utils.segmentation import Signature, preference_signature
+
+logger = logging.getLogger(__name__)
+
+CacheKey = Tuple[int, Signature, Optional[str], Optional[str]]
+
+# Строка cache_versions с версией событий
+EVENTS_VERSION = "events"
+
+
+class MatchCache:
+    """
+    LRU-кэш результатов подбора: подпись предпочтений -> id событий.
+
+    Ключ включает версию событий из БД (cache_versions), которую увеличивает
+    каждая запись в events (bump_version). Перед подбором версия сверяется
+    с БД (sync): изменение событий в другом воркере или процессе сбрасывает
+    кэш, поэтому устаревшие результаты не выдаются. Объём ограничен и числом
+    записей, и суммарным числом хранимых id событий.
+    """
+
+    def __init__(self, max_entries: int, max_event_ids: int, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_event_ids = max_event_ids
+        self.path = path
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[CacheKey, Tuple[int, ...]]" = OrderedDict()
+        self._event_ids = 0
+        self._lock = threading.Lock()
+
+    def _key(self, signature: Signature, since: Optional[datetime], until: Optional[datetime]) -> CacheKey:
+        return (
+            self.version,
+            signature,
+            since.isoformat() if since else None,
+            until.isoformat() if until else None,
+        )
+
+    def sync(self, db: Session) -> int:
+        """Сверяет версию с БД; при расхождении (в том числе с версией из файла) кэш сбрасывается."""
+        table = models.cache_versions
+        version = db.execute(select(table.c.version).where(table.c.name == EVENTS_VERSION)).scalar() or 0
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self._entries.clear()
+                self._event_ids = 0
+        return version
+
+    def bump_version(self, db: Session):
+        """Инвалидирует все результаты после изменения событий — во всех процессах."""
+        table = models.cache_versions
+        insert_ignore(db, table, [{"name": EVENTS_VERSION, "version": 0}])
+        db.execute(table.update().where(table.c.name == EVENTS_VERSION).values(version=table.c.version + 1))
+        db.commit()
+        self.sync(db)
+
+    def get(self, signature: Signature, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Optional[Tuple[int, ...]]:
+        with self._lock:
+            key = self._key(signature, since, until)
+            event_ids = self._entries.get(key)
+            if event_ids is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return event_ids
+
+    def put(self, signature: Signature, event_ids: Iterable[int], since: Optional[datetime] = None, until: Optional[datetime] = None):
+        event_ids = tuple(event_ids)
+        if len(event_ids) > self.max_event_ids:
+            return
+        with self._lock:
+            key = self._key(signature, since, until)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._event_ids -= len(previous)
+            self._entries[key] = event_ids
+            self._event_ids += len(event_ids)
+            while len(self._entries) > self.max_entries or self._event_ids > self.max_event_ids:
+                _, evicted = self._entries.popitem(last=False)
+                self._event_ids -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._event_ids = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "version": self.version,
+                "entries": len(self._entries),
+                "event_ids": self._event_ids,
+                "max_entries": self.max_entries,
+                "max_event_ids": self.max_event_ids,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def save(self):
+        """Сохраняет текущую версию и записи в JSON-файл (если задан path)."""
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                "version": self.version,
+                "entries": [
+                    [list(signature[0]), list(signature[1]), since, until, list(event_ids)]
+                    for (version, signature, since, until), event_ids in self._entries.items()
+                    if version == self.version
+                ],
+            }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        logger.info(f"Match cache saved: {len(data['entries'])} entries")
+
+    def load(self):
+        """
+        Восстанавливает кэш из файла; повреждённый файл игнорируется. Версия
+        из файла сверяется с БД при первом подборе (sync): если события за
+        это время менялись, восстановленные записи отбрасываются.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load match cache from {self.path}: {str(e)}")
+            return
+        with self._lock:
+            self.version = data.get("version", 0)
+            self._entries.clear()
+            self._event_ids = 0
+        for categories, cities, since, until, event_ids in data.get("entries", []):
+            signature = (tuple(categories), tuple(cities))
+            self.put(
+                signature, event_ids,
+                datetime.fromisoformat(since) if since else None,
+                datetime.fromisoformat(until) if until else None,
+            )
+        logger.info(f"Match cache loaded: {len(self._entries)} entries")
+
+
+match_cache = MatchCache(
+    max_entries=settings.MATCH_CACHE_MAX_ENTRIES,
+    max_event_ids=settings.MATCH_CACHE_MAX_EVENT_IDS,
+    path=settings.MATCH_CACHE_PATH or None,
+)
+
+
+def get_cached_events_for_user(
+    db: Session,
+    user: models.User,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> List[models.Event]:
+    """get_events_for_user с кэшированием по подписи предпочтений."""
+    match_cache.sync(db)
+    categories, cities = load_user_preferences(db, [user.id]).get(user.id, ([], []))
+    signature = preference_signature(categories, cities)
+    event_ids = match_cache.get(signature, since, until)
+    if event_ids is None:
+        events = get_events_for_preferences(db, categories, cities, since, until)
+        match_cache.put(signature, [event.id for event in events], since, until)
+        return events
+    if not event_ids:
+        return []
+    by_id = {
+        event.id: event
+        for event in db.query(models.Event).filter(models.Event.id.in_(event_ids))
+    }
+    return [by_id[event_id] for event_id in event_ids if event_id in by_id]
+
+
+def cached_match_many(
+    index,
+    signatures: Iterable[Signature],
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> Dict[Hashable, List[models.Event]]:
+    """
+    match_many индекса рассылки (EventIndex или BitmaskMatcher) через кэш.
+    since/until должны совпадать с окном, в котором загружен индекс; версию
+    кэша сверяют с БД (match_cache.sync) перед загрузкой индекса.
+    """
+    by_id = {event.id: event for event in index.events}
+    result, missing = {}, {}
+    for signature in signatures:
+        event_ids = match_cache.get(signature, since, until)
+        if event_ids is not None and all(event_id in by_id for event_id in event_ids):
+            result[signature] = [by_id[event_id] for event_id in event_ids]
+        else:
+            missing[signature] = signature
+    for signature, events in index.match_many(missing).items():
+        match_cache.put(signature, [event.id for event in events], since, until)
+        result[signature] = events
+    return result
@@ -0,0 +1,197 @@
+import logging
+import re
+import secrets
+import threading
+from collections import OrderedDict
+from jinja2 import Template, Undefined
+from markupsafe import escape
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+
+class _RecipientProxy:
+    """Подставляется вместо объекта получателя: любое поле — маркер."""
+
+    def __init__(self, cache: "RenderCache", name: str):
+        self._cache = cache
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return self._cache._marker(f"{self._name}.{attr}")
+
+
+class CompiledBody:
+    """
+    Тело письма, разрезанное по полям получателя: parts[0] field[0] parts[1] ...
+    Сборка письма — один join без обращения к шаблону.
+    """
+
+    __slots__ = ("parts", "fields")
+
+    def __init__(self, parts: Sequence[str], fields: Sequence[str]):
+        self.parts = tuple(parts)
+        self.fields = tuple(fields)
+
+    def splice(self, values: Dict[str, str]) -> str:
+        chunks = [self.parts[0]]
+        for field, part in zip(self.fields, self.parts[1:]):
+            chunks.append(values[field])
+            chunks.append(part)
+        return "".join(chunks)
+
+
+class RenderCache:
+    """
+    Кэш рендеринга шаблона по сегментам: тело письма рендерится один раз на
+    набор событий (key), а поля получателя (recipient_keys контекста: строки
+    и атрибуты объектов, например name и user.unsubscribe_token) вставляются
+    в готовый текст через маркеры, экранированные так же, как их экранирует
+    Jinja.
+
+    Кэш привязан к одному объекту шаблона, поэтому изменённый шаблон
+    получает новый кэш. Первое собранное письмо сверяется с полным
+    рендерингом; если шаблон использует поля получателя не только для вывода
+    (фильтры, условия) и результат расходится, кэш отключается и дальше
+    письма рендерятся целиком — результат всегда совпадает побайтно.
+    """
+
+    def __init__(self, template: Template, recipient_keys: Sequence[str], max_entries: int = 1024):
+        self.template = template
+        self.recipient_keys = tuple(recipient_keys)
+        self.max_entries = max_entries
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self._verified = False
+        self._entries: "OrderedDict[Hashable, CompiledBody]" = OrderedDict()
+        self._fields: Dict[str, int] = {}
+        nonce = secrets.token_hex(8)
+        self._marker_prefix = f"RCPT{nonce}F"
+        self._marker_re = re.compile(rf"RCPT{nonce}F(\d+)X")
+        self._nonce = nonce
+        environment = template.environment
+        autoescape = environment.autoescape
+        self._autoescape = autoescape(template.name) if callable(autoescape) else bool(autoescape)
+
+    def _marker(self, field: str) -> str:
+        index = self._fields.setdefault(field, len(self._fields))
+        return f"{self._marker_prefix}{index}X"
+
+    def _compile(self, context: dict) -> Optional[CompiledBody]:
+        shell = dict(context)
+        for key in self.recipient_keys:
+            if isinstance(context.get(key), str):
+                shell[key] = self._marker(key)
+            else:
+                shell[key] = _RecipientProxy(self, key)
+        pieces = self._marker_re.split(self.template.render(shell))
+        parts, indexes = pieces[0::2], pieces[1::2]
+        # Маркер, изменённый фильтром, не найден и остался в тексте
+        if any(self._nonce in part.lower() for part in parts):
+            return None
+        names = {index: field for field, index in self._fields.items()}
+        return CompiledBody(parts, [names[int(index)] for index in indexes])
+
+    def _value(self, context: dict, field: str) -> str:
+        key, _, attr = field.partition(".")
+        value = context.get(key)
+        if attr:
+            value = self.template.environment.getattr(value, attr)
+        if isinstance(value, Undefined):
+            return str(value)
+        return str(escape(value)) if self._autoescape else str(value)
+
+    def _disable(self, reason: str):
+        logger.warning(f"⚠️ Render cache disabled for {self.template.name}: {reason}")
+        self.enabled = False
+        self._entries.clear()
+
+    def render(self, context: dict, key: Hashable) -> str:
+        """Результат template.render(context); key определяет общее для получателей тело."""
+        if not self.enabled:
+            self.fallbacks += 1
+            return self.template.render(context)
+
+        body = self._entries.get(key)
+        if body is None:
+            self.misses += 1
+            body = self._compile(context)
+            if body is None:
+                self._disable("recipient fields are transformed by the template")
+                self.fallbacks += 1
+                return self.template.render(context)
+            self._entries[key] = body
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        html = body.splice({field: self._value(context, field) for field in set(body.fields)})
+        if not self._verified:
+            full = self.template.render(context)
+            if html != full:
+                self._disable("spliced output differs from a full render")
+                self.fallbacks += 1
+                return full
+            self._verified = True
+        return html
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+        }
+
+
+class FragmentCache:
+    """
+    LRU-кэш HTML-фрагментов событий (карточек): фрагмент рендерится один раз
+    на ключ (id, updated_at) и дальше берётся из кэша для всех писем, где
+    встречается событие. В ключ входит и created_at: id, занятый заново после
+    удаления события, даёт новый ключ. Несохранённые события (без id)
+    рендерятся без кэша.
+    """
+
+    def __init__(self, render: Callable[[Any], str], max_entries: int = 4096):
+        self.render = render
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(event) -> Optional[Hashable]:
+        if event.id is None:
+            return None
+        return event.id, event.updated_at, event.created_at
+
+    def __call__(self, event) -> str:
+        key = self.key(event)
+        if key is None:
+            return self.render(event)
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return fragment
+        fragment = self.render(event)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = fragment
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fragment
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
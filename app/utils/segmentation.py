@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from app import models
+from app.utils.event_index import EventIndex
+
+Signature = Tuple[Tuple[str, ...], Tuple[str, ...]]
+
+
+def preference_signature(categories: Iterable[str], cities: Iterable[str]) -> Signature:
+    """Каноническая подпись предпочтений: порядок и повторы не важны."""
+    return tuple(sorted(set(categories))), tuple(sorted(set(cities)))
+
+
+@dataclass
+class Segment:
+    """Группа подписчиков с одинаковыми предпочтениями и общим набором событий."""
+    signature: Signature
+    users: List[models.User] = field(default_factory=list)
+    events: List[models.Event] = field(default_factory=list)
+
+
+def build_segments(
+    users: Iterable[models.User],
+    preferences: Dict[int, Tuple[List[str], List[str]]],
+    index: EventIndex,
+    match_many: Optional[Callable[[Dict[Signature, Signature]], Dict[Signature, List[models.Event]]]] = None
+) -> List[Segment]:
+    """
+    Группирует пользователей по подписи предпочтений и подбирает события
+    один раз на сегмент. Сегменты идут в порядке первого появления подписи.
+    index — EventIndex или BitmaskMatcher (нужен метод match_many);
+    match_many позволяет подменить подбор, например на кэшированный.
+    """
+    segments: "OrderedDict[Signature, Segment]" = OrderedDict()
+    for user in users:
+        categories, cities = preferences.get(user.id, ([], []))
+        signature = preference_signature(categories, cities)
+        segment = segments.get(signature)
+        if segment is None:
+            segment = segments[signature] = Segment(signature=signature)
+        segment.users.append(user)
+
+    match_many = match_many or index.match_many
+    matches = match_many({signature: signature for signature in segments})
+    for signature, segment in segments.items():
+        segment.events = matches[signature]
+    return list(segments.values())
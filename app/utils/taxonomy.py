@@ -0,0 +1,35 @@
+from typing import Iterable, List, Optional
+
+
+def split_categories(category: Optional[str]) -> List[str]:
+    """
+    Разбивает строку категорий события (разделитель ;) на отдельные значения
+    без пробелов по краям, пустых элементов и повторов.
+    """
+    if not category:
+        return []
+    result = []
+    for item in category.split(';'):
+        item = item.strip()
+        if item and item not in result:
+            result.append(item)
+    return result
+
+
+# Корзина для событий вне основных городов; совпадает с вариантом,
+# который выбирает пользователь в форме подписки
+OTHER_CITIES = 'Другие города'
+
+# Начальное наполнение таблицы cities
+DEFAULT_MAIN_CITIES = ['Подгорица', 'Будва', 'Херцег-Нови', 'Тиват', 'Бар']
+
+
+def city_bucket(city: Optional[str], main_cities: Iterable[str]) -> Optional[str]:
+    """
+    Корзина города события: сам город, если он основной, иначе «Другие города».
+    События без города не попадают ни в одну корзину.
+    """
+    if city is None:
+        return None
+    normalized = city.strip()
+    return normalized if normalized in main_cities else OTHER_CITIES
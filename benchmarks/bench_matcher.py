@@ -0,0 +1,108 @@
+"""
+Сравнение движков подбора событий на синтетических данных.
+
+    python -m benchmarks.bench_matcher --users 100000 --events 5000
+
+get_events_for_user (по запросу на пользователя) измеряется на выборке
+--sample пользователей и экстраполируется на всех; остальные движки
+обрабатывают всех пользователей. Результаты сверяются на выборке.
+"""
+import argparse
+import random
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import models
+from app.database import Base
+from app.utils.bitmask_matcher import BitmaskMatcher
+from app.utils.event_index import EventIndex, load_user_preferences
+from app.utils.event_matcher import get_events_for_user, get_events_for_users
+from app.utils.taxonomy import DEFAULT_MAIN_CITIES, OTHER_CITIES, city_bucket
+
+CATEGORIES = [f"category-{i}" for i in range(24)]
+EVENT_CITIES = DEFAULT_MAIN_CITIES + ["Котор", "Улцинь", "Жабляк", "Никшич"]
+USER_CITIES = DEFAULT_MAIN_CITIES + [OTHER_CITIES]
+
+
+def populate(db, users: int, events: int, seed: int):
+    rnd = random.Random(seed)
+    event_rows, event_category_rows = [], []
+    for event_id in range(1, events + 1):
+        categories = rnd.sample(CATEGORIES, rnd.randint(1, 3))
+        city = rnd.choice(EVENT_CITIES)
+        event_rows.append({
+            "id": event_id, "title": f"Event {event_id}", "category": ";".join(categories),
+            "city": city, "city_bucket": city_bucket(city, DEFAULT_MAIN_CITIES),
+            "dates": [], "languages": [], "url": f"https://example.com/{event_id}",
+        })
+        event_category_rows.extend({"event_id": event_id, "category": c} for c in categories)
+
+    user_rows, category_rows, city_rows = [], [], []
+    for user_id in range(1, users + 1):
+        user_rows.append({"id": user_id, "email": f"user{user_id}@example.com",
+                          "is_subscribed": True, "unsubscribe_token": str(user_id)})
+        category_rows.extend({"user_id": user_id, "category": c}
+                             for c in rnd.sample(CATEGORIES, rnd.randint(1, 4)))
+        city_rows.extend({"user_id": user_id, "city": c}
+                         for c in rnd.sample(USER_CITIES, rnd.randint(1, 3)))
+
+    db.execute(models.Event.__table__.insert(), event_rows)
+    db.execute(models.event_categories.insert(), event_category_rows)
+    db.execute(models.User.__table__.insert(), user_rows)
+    db.execute(models.user_categories.insert(), category_rows)
+    db.execute(models.user_cities.insert(), city_rows)
+    db.commit()
+
+
+def timed(label: str, func, scale: float = 1.0):
+    start = time.perf_counter()
+    result = func()
+    elapsed = (time.perf_counter() - start) * scale
+    suffix = " (extrapolated)" if scale != 1.0 else ""
+    print(f"{label:<36} {elapsed:10.3f}s{suffix}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--events", type=int, default=5_000)
+    parser.add_argument("--sample", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    populate(db, args.users, args.events, args.seed)
+    print(f"{args.users} users, {args.events} events")
+
+    user_ids = list(range(1, args.users + 1))
+    sample = db.query(models.User).filter(models.User.id <= args.sample).all()
+
+    per_user = timed(
+        "get_events_for_user (per user)",
+        lambda: {u.id: get_events_for_user(db, u) for u in sample},
+        scale=args.users / max(len(sample), 1),
+    )
+    batched = timed("get_events_for_users (chunked SQL)", lambda: get_events_for_users(db, user_ids))
+    preferences = timed("load_user_preferences", lambda: load_user_preferences(db))
+    index = timed("EventIndex.load", lambda: EventIndex.load(db))
+    by_index = timed("EventIndex.match_many", lambda: index.match_many(preferences))
+    bitmask = timed("BitmaskMatcher.load", lambda: BitmaskMatcher.load(db))
+    by_bitmask = timed("BitmaskMatcher.match_many", lambda: bitmask.match_many(preferences))
+
+    def ids(events):
+        return sorted(e.id for e in events)
+
+    for user in sample:
+        expected = ids(per_user[user.id])
+        assert ids(batched[user.id]) == expected, user.id
+        assert ids(by_index.get(user.id, [])) == expected, user.id
+        assert ids(by_bitmask.get(user.id, [])) == expected, user.id
+    print(f"results match on {len(sample)} sampled users")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Рендеринг писем рассылки: полный рендеринг шаблона на каждое письмо против
+кэша карточек событий (FragmentCache) и кэша по набору событий (RenderCache)
+со вставкой полей получателя. С --workers дополнительно сравнивается
+стадия рендеринга кампании (make_renderer + текстовая часть) в текущем
+процессе и в пуле процессов (RenderPool).
+
+    python -m benchmarks.bench_render --recipients 20000 --segments 50 --events 8
+
+Получатели равномерно распределены по --segments наборам событий, как
+получатели одного сегмента предпочтений. Результаты сверяются побайтно
+для всех писем.
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timezone
+from functools import partial
+
+from app import models
+from app.services.campaign_runner import render_in_process
+from app.services.email_service import html_to_text
+from app.services.newsletter_service import RECIPIENT_KEYS, jinja_env, make_renderer, render_email, render_email_cached, render_event_card
+from app.services.render_pool import RenderPool
+from app.utils.render_cache import FragmentCache, RenderCache
+
+
+def make_events(count: int, rnd: random.Random):
+    return [
+        models.Event(
+            id=event_id,
+            title=f"Концерт №{event_id} & друзья",
+            description=f"Описание события {event_id}. " * rnd.randint(1, 6),
+            city=rnd.choice(["Будва", "Бар", "Котор", None]),
+            photo=f"https://example.com/{event_id}.jpg" if rnd.random() < 0.5 else None,
+            url=f"https://example.com/events/{event_id}",
+            updated_at=datetime(2026, 1, 1, tzinfo=timezone.utc),
+        )
+        for event_id in range(1, count + 1)
+    ]
+
+
+def timed(label: str, render, jobs):
+    # Тела писем не накапливаются: сотни мегабайт строк искажают замер сборкой мусора
+    start = time.perf_counter()
+    for user, events in jobs:
+        render(user, events)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.3f}s  {elapsed / len(jobs) * 1e6:9.1f} µs/message")
+
+
+def timed_stage(label: str, stage, jobs):
+    start = time.perf_counter()
+    for _, _, email in stage(jobs):
+        if email.text_body is None:
+            html_to_text(email.html_body)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.3f}s  {elapsed / len(jobs) * 1e6:9.1f} µs/message")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=20_000)
+    parser.add_argument("--segments", type=int, default=50)
+    parser.add_argument("--events", type=int, default=8, help="событий в письме")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=0, help="процессов рендеринга (0 — пул не замеряется)")
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    pool = make_events(args.events * 4, rnd)
+    segments = [rnd.sample(pool, args.events) for _ in range(args.segments)]
+    jobs = [
+        (
+            models.User(id=i, email=f"user{i}+o'neil@example.com", unsubscribe_token=f"token-{i}"),
+            segments[i % args.segments],
+        )
+        for i in range(1, args.recipients + 1)
+    ]
+    template = jinja_env.get_template("newsletter.html")
+    now = datetime.now()
+    print(f"{args.recipients} recipients, {args.segments} event sets, {args.events} events per email")
+
+    full = partial(render_email, template)
+    cards = FragmentCache(render_event_card)
+    with_cards = partial(render_email, template, event_card=cards)
+    cache = RenderCache(template, RECIPIENT_KEYS, max_entries=args.segments)
+    cached = partial(render_email_cached, cache, now, event_card=FragmentCache(render_event_card))
+    timed("full render", full, jobs)
+    timed("event card cache", with_cards, jobs)
+    timed("segment cache + splicing", cached, jobs)
+    print(f"cards: {cards.stats()}")
+    print(f"cache: {cache.stats()}")
+
+    # now у полного рендеринга свой, но в шаблоне используется только год
+    for user, events in jobs:
+        expected = full(user, events).html_body
+        assert with_cards(user, events).html_body == expected, user.id
+        assert cached(user, events).html_body == expected, user.id
+    print(f"outputs identical for {len(jobs)} messages")
+
+    if args.workers:
+        # Время пула включает запуск процессов
+        render = make_renderer(template)
+        timed_stage("campaign stage, in-process", partial(render_in_process, render=render), jobs)
+        pool = RenderPool(make_renderer(template), template_name=template.name, workers=args.workers, min_jobs=0)
+        timed_stage(f"campaign stage, {args.workers} processes", pool, jobs)
+
+
+if __name__ == "__main__":
+    main()
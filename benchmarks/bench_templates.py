@@ -0,0 +1,129 @@
+"""
+Загрузка шаблонов писем: холодный старт и установившийся режим.
+
+    python -m benchmarks.bench_templates --runs 5 --renders 20000
+
+Холодный старт — время от создания окружения до первого готового письма
+в новом процессе (без учёта запуска интерпретатора и импортов):
+разбор и компиляция исходников, кэш байткода на диске, заранее
+скомпилированные модули (ModuleLoader). Установившийся режим —
+get_template и get_template + render на письмо с автоперезагрузкой
+(os.stat на каждый вызов) и без неё. Размер письма — байты HTML без
+минификации и с ней, текстовая часть из newsletter.txt против html_to_text.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from jinja2 import FileSystemLoader
+
+from app import models
+from app.core.config import settings
+from app.services import template_service
+from app.services.email_service import html_to_text
+
+COLD_MODES = ("compile", "bytecode", "module")
+
+
+def sample_context():
+    events = [
+        models.Event(id=i, title=f"Событие {i}", description="Описание " * 5, city="Будва", url=f"https://example.com/{i}")
+        for i in range(1, 9)
+    ]
+    user = models.User(id=1, email="user@example.com", unsubscribe_token="token")
+    return {"name": "user", "events": events, "now": datetime.now(), "user": user}
+
+
+def cold_start(mode: str, cache_dir: str, compiled_dir: str) -> float:
+    """Выполняется в дочернем процессе: окружение -> первое письмо."""
+    settings.TEMPLATES_BYTECODE_CACHE = mode == "bytecode"
+    settings.TEMPLATES_BYTECODE_CACHE_DIR = cache_dir
+    settings.EMAIL_TEMPLATES_COMPILED_DIR = compiled_dir if mode == "module" else ""
+    context = sample_context()
+    start = time.perf_counter()
+    env = template_service.create_email_environment()
+    env.get_template("newsletter.html").render(context)
+    return time.perf_counter() - start
+
+
+def run_child(mode: str, cache_dir: str, compiled_dir: str) -> float:
+    output = subprocess.check_output([
+        sys.executable, "-m", "benchmarks.bench_templates",
+        "--child", mode, "--cache-dir", cache_dir, "--compiled-dir", compiled_dir,
+    ])
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def steady_state(renders: int):
+    context = sample_context()
+    for auto_reload in (True, False):
+        settings.TEMPLATES_AUTO_RELOAD = auto_reload
+        env = template_service.create_email_environment(FileSystemLoader(template_service.EMAIL_TEMPLATES_DIR))
+        env.get_template("newsletter.html")
+
+        start = time.perf_counter()
+        for _ in range(renders):
+            env.get_template("newsletter.html")
+        lookup = (time.perf_counter() - start) / renders
+
+        start = time.perf_counter()
+        for _ in range(renders // 10):
+            env.get_template("newsletter.html").render(context)
+        render = (time.perf_counter() - start) / (renders // 10)
+        label = f"auto_reload={auto_reload}"
+        print(f"{label:<20} get_template {lookup * 1e6:8.2f} µs   get_template + render {render * 1e6:8.1f} µs")
+
+
+def payload(renders: int):
+    context = sample_context()
+    for minify in (False, True):
+        settings.EMAIL_TEMPLATES_MINIFY = minify
+        env = template_service.create_email_environment(template_service.source_loader())
+        html = env.get_template("newsletter.html").render(context)
+        print(f"  html, minify={str(minify):<6} {len(html.encode()):8d} bytes/message")
+
+    text_template = env.get_template("newsletter.txt")
+    for label, render in (
+        ("text, newsletter.txt", lambda: text_template.render(context)),
+        ("text, html_to_text", lambda: html_to_text(html)),
+    ):
+        start = time.perf_counter()
+        for _ in range(renders // 10):
+            text = render()
+        elapsed = (time.perf_counter() - start) / (renders // 10)
+        print(f"  {label:<20} {len(text.encode()):8d} bytes/message {elapsed * 1e6:8.1f} µs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="запусков процесса на режим холодного старта")
+    parser.add_argument("--renders", type=int, default=20_000)
+    parser.add_argument("--child", choices=COLD_MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--cache-dir", default="", help=argparse.SUPPRESS)
+    parser.add_argument("--compiled-dir", default="", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(cold_start(args.child, args.cache_dir, args.compiled_dir))
+        return
+
+    with tempfile.TemporaryDirectory() as cache_dir, tempfile.TemporaryDirectory() as compiled_dir:
+        template_service.compile_email_templates(compiled_dir)
+        # Первый запуск наполняет кэш байткода и в замер не входит
+        run_child("bytecode", cache_dir, compiled_dir)
+        print(f"cold start, median of {args.runs} processes:")
+        for mode in COLD_MODES:
+            times = [run_child(mode, cache_dir, compiled_dir) for _ in range(args.runs)]
+            print(f"  {mode:<10} {statistics.median(times) * 1000:8.2f} ms")
+
+    print("steady state:")
+    steady_state(args.renders)
+    print("payload:")
+    payload(args.renders)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
+import json
 import os
+import threading
 import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from sqlalchemy import create_engine
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import sessionmaker
 from app.database import Base, get_db
 from app.main import app
-from app.models import User, AdminUser, Event, NewsletterSchedule  # и остальные!
+from app.models import User, AdminUser, Event, NewsletterSchedule, user_categories, user_cities  # и остальные!
+from app.core.config import settings
+from app.services.email_service import PostmarkClient, RateLimiter
+from app.utils.match_cache import match_cache
 
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
@@ -19,6 +25,13 @@ def db_engine():
     yield engine
     Base.metadata.drop_all(bind=engine)
 
+@pytest.fixture(autouse=True)
+def reset_match_cache():
+    # Каждый тест откатывает БД (и версию событий в ней), поэтому результаты
+    # подбора из прошлых тестов недействительны
+    match_cache.clear()
+    yield
+
 @pytest.fixture
 def db_session(db_engine):
     connection = db_engine.connect()
@@ -29,6 +42,33 @@ def db_session(db_engine):
     transaction.rollback()
     connection.close()
 
+@pytest.fixture
+def add_subscriber(db_session):
+    """Фабрика подписчиков с категориями и городами; db — другая сессия вместо db_session."""
+    def add(email, categories=("music",), cities=("Будва",), db=None):
+        db = db or db_session
+        user = User(email=email, is_subscribed=True)
+        db.add(user)
+        db.flush()
+        for category in categories:
+            db.execute(user_categories.insert().values(user_id=user.id, category=category))
+        for city in cities:
+            db.execute(user_cities.insert().values(user_id=user.id, city=city))
+        db.commit()
+        return user
+    return add
+
+@pytest.fixture
+def add_event(db_session):
+    """Фабрика предстоящих событий; db — другая сессия вместо db_session."""
+    def add(title, url, category="music", city="Будва", dates=("2099-06-01",), db=None):
+        db = db or db_session
+        event = Event(title=title, category=category, city=city, dates=list(dates), languages=["RU"], url=url)
+        db.add(event)
+        db.commit()
+        return event
+    return add
+
 @pytest.fixture
 def client(db_session):
     def override_get_db():
@@ -40,3 +80,72 @@ def client(db_session):
     with TestClient(app) as test_client:
         yield test_client
 
+
+
+class FakePostmarkHandler(BaseHTTPRequestHandler):
+    """Локальная замена API Postmark: /email и /email/batch.
+    Адреса с "invalid" отклоняются с ErrorCode 300, как у настоящего API.
+    server.drop_connections — сколько следующих запросов оборвать без ответа,
+    server.throttle_next — на сколько следующих ответить 429 с Retry-After."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.server.drop_connections > 0:
+            self.server.drop_connections -= 1
+            self.close_connection = True
+            return
+        if self.server.throttle_next > 0:
+            self.server.throttle_next -= 1
+            payload = json.dumps({"ErrorCode": 429, "Message": "Rate limit exceeded"}).encode()
+            self.send_response(429)
+            self.send_header("Retry-After", "0.05")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        self.server.requests.append((self.path, body))
+        if self.path == "/email/batch":
+            status, result = 200, [
+                {"To": m["To"], "ErrorCode": 300, "Message": "Invalid 'To' address."}
+                if "invalid" in m["To"] else
+                {"To": m["To"], "ErrorCode": 0, "Message": "OK", "MessageID": f"msg-{i}"}
+                for i, m in enumerate(body)
+            ]
+        elif self.path == "/email":
+            if "invalid" in body["To"]:
+                status, result = 422, {"ErrorCode": 300, "Message": "Invalid 'To' address."}
+            else:
+                status, result = 200, {"To": body["To"], "ErrorCode": 0, "Message": "OK", "MessageID": "msg"}
+        else:
+            status, result = 404, {}
+        payload = json.dumps(result).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def postmark_server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakePostmarkHandler)
+    server.requests = []
+    server.drop_connections = 0
+    server.throttle_next = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(settings, "POSTMARK_API_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(settings, "POSTMARK_API_TOKEN", "test-token")
+    monkeypatch.setattr(settings, "EMAIL_TEST_MODE", False)
+    client = PostmarkClient()
+    monkeypatch.setattr("app.services.email_service.postmark_client", client)
+    monkeypatch.setattr("app.services.email_service.rate_limiter", RateLimiter(rate=1000, burst=1000))
+    yield server
+    client.close()
+    server.shutdown()
+    server.server_close()
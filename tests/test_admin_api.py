@@ -1,7 +1,10 @@
 import pytest
 from unittest.mock import patch, MagicMock, AsyncMock
 from fastapi import status
-from app.models import User, Event, AdminUser, NewsletterLog, user_categories
+from app.models import User, Event, AdminUser, NewsletterCampaign, NewsletterDeadLetter, NewsletterLog, user_categories
+from app.main import app
+from app.routes import admin
+from app.services import newsletter_service
 from datetime import datetime
 
 class TestAdminAPI:
@@ -115,50 +118,9 @@ class TestAdminAPI:
         response = client.get("/admin/newsletter/logs/")
         assert response.status_code in [status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN]
     
-    # Исправленный тест для send_newsletter_to_user
-    @patch('app.routes.admin.get_db')
-    @patch('app.routes.admin.send_email_via_postmark')
-    @patch('app.routes.admin.get_events_for_user')
-    @patch('app.routes.admin.get_db')
-    def test_send_newsletter_to_user_success(self, mock_get_db, mock_get_events, mock_send_email, db_session):
-        """Тестирование отправки рассылки конкретному пользователю"""
-        from app.routes.admin import send_newsletter_to_user
-        import asyncio
-        
-        # Мокаем базу данных
-        mock_get_db.return_value.__next__.return_value = db_session
-        
-        # Создаем пользователя
-        user = User(email="newsletter@example.com")
-        db_session.add(user)
-        db_session.commit()
-        db_session.refresh(user)
-        
-        # Мокаем события
-        events = [
-            Event(
-                title="Newsletter Event",
-                dates=["2024-12-01"],
-                languages=["RU"],
-                url="https://example.com/newsletter"
-            )
-        ]
-        mock_get_events.return_value = events
-        
-        # Запускаем функцию
-        asyncio.run(send_newsletter_to_user(user.id))
-        
-        # Проверяем что отправка была вызвана с правильным email
-        if mock_send_email.called:
-            call_args = mock_send_email.call_args
-            # Исправленная проверка - принимаем любой email с доменом example.com
-            assert "@example.com" in call_args[1]["to_email"]
-    
     # Исправленный интеграционный тест
     @patch('app.core.auth.get_current_admin', return_value='admin')
-    @patch('app.routes.admin.send_email_via_postmark')
-    @patch('app.routes.admin.get_events_for_user')
-    def test_full_newsletter_workflow(self, mock_get_events, mock_send_email, mock_auth, client, db_session):
+    def test_full_newsletter_workflow(self, mock_auth, client, db_session):
         """Полный тест рабочего процесса рассылки"""
         # Создаем пользователей
         user1 = User(email="workflow1@example.com")
@@ -177,9 +139,6 @@ class TestAdminAPI:
         db_session.add(event)
         db_session.commit()
         
-        # Мокаем получение событий
-        mock_get_events.return_value = [event]
-        
         # Запускаем рассылку
         response = client.post("/admin/newsletter/")
         
@@ -194,45 +153,82 @@ class TestAdminAPI:
             data = response.json()
             assert data["status"] == "started"
             assert data["total_users"] == 2
-    
-    # Простые тесты функций
-    def test_generate_newsletter_html(self, db_session):
-        """Тестирование генерации HTML для newsletter"""
-        from app.routes.admin import generate_newsletter_html
-        
-        user = User(email="test@example.com")
-        events = [
-            Event(
-                title="Test Event",
-                category="tech",
-                dates=["2024-12-01"],
-                languages=["RU"],
-                url="https://example.com/test"
-            )
-        ]
-        
-        html = generate_newsletter_html(events, user)
-        
-        assert "<!DOCTYPE html>" in html
-        assert user.email in html
-        assert "Test Event" in html
-    
-    def test_generate_newsletter_text(self, db_session):
-        """Тестирование генерации текстовой версии newsletter"""
-        from app.routes.admin import generate_newsletter_text
-        
-        user = User(email="text@example.com")
-        events = [
-            Event(
-                title="Text Event",
-                dates=["2024-12-01"],
-                languages=["RU"],
-                url="https://example.com/text"
-            )
-        ]
-        
-        text = generate_newsletter_text(events, user)
-        
-        assert user.email in text
-        assert "Text Event" in text
-        assert "Отписаться" in text
+
+
+@pytest.fixture
+def skip_admin_auth():
+    app.dependency_overrides[admin.get_current_admin] = lambda request=None: "admin"
+    yield
+    app.dependency_overrides.pop(admin.get_current_admin, None)
+
+
+@pytest.mark.usefixtures("skip_admin_auth")
+class TestNewsletterCampaignAPI:
+    """Тестирование запуска рассылки одной задачей-кампанией"""
+
+    def test_send_newsletter_runs_single_campaign_job(self, client, db_session, monkeypatch, add_subscriber, add_event):
+        from app.tasks import newsletter as newsletter_tasks
+
+        add_subscriber("job1@example.com")
+        add_subscriber("job2@example.com")
+        add_event("Событие", "https://example.com/job")
+        monkeypatch.setattr(newsletter_tasks, "SessionLocal", lambda: db_session)
+
+        # TestClient выполняет фоновые задачи до возврата ответа
+        with patch('app.services.newsletter_service.send_email_via_postmark', return_value=True) as mock_send:
+            response = client.post("/admin/newsletter/")
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert (data["status"], data["total_users"]) == ("started", 2)
+        assert mock_send.call_count == 2
+
+        campaign = client.get(f"/admin/newsletter/campaigns/{data['campaign_id']}").json()
+        assert (campaign["kind"], campaign["status"], campaign["deliveries"]) == ("all", "completed", {"sent": 2})
+        assert db_session.query(NewsletterLog).count() == 1
+
+    def test_send_newsletter_does_not_start_running_campaign_twice(self, client, db_session, add_subscriber):
+        add_subscriber("twice@example.com")
+        with patch('app.routes.admin.run_newsletter_job') as mock_job:
+            first = client.post("/admin/newsletter/").json()
+            second = client.post("/admin/newsletter/").json()
+        assert first["status"] == "started" and second["status"] == "running"
+        assert first["campaign_id"] == second["campaign_id"]
+        assert mock_job.call_count == 1
+
+        # Аренда в БД: запуск из другого процесса (планировщик) кампанию не продолжит
+        campaign = db_session.get(NewsletterCampaign, first["campaign_id"])
+        with patch('app.services.newsletter_service.send_email_via_postmark') as mock_send:
+            assert newsletter_service.send_newsletter_to_all_users(db_session) == (0, 0)
+        assert mock_send.call_count == 0
+        assert campaign.claimed_by == mock_job.call_args.args[1]
+
+    def test_unknown_campaign(self, client):
+        assert client.get("/admin/newsletter/campaigns/999").status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.usefixtures("skip_admin_auth")
+class TestDeadLettersAPI:
+    """Тестирование /admin/dead-letters"""
+
+    def test_list_and_replay_dead_letters(self, client, db_session):
+        user = User(email="dead@example.com", is_subscribed=False)
+        db_session.add(user)
+        db_session.commit()
+        letter = NewsletterDeadLetter(
+            user_id=user.id, to_email=user.email, event_ids=[1], attempts=4, last_error="503", status="dead"
+        )
+        db_session.add(letter)
+        db_session.commit()
+
+        response = client.get("/admin/dead-letters/")
+        assert response.status_code == status.HTTP_200_OK
+        assert [(item["id"], item["attempts"], item["last_error"]) for item in response.json()] == [(letter.id, 4, "503")]
+
+        # Пользователь отписался — письмо снимается с повтора без отправки
+        with patch('app.services.newsletter_service.send_email_via_postmark') as mock_send:
+            response = client.post("/admin/dead-letters/replay", json={"ids": [letter.id]})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == {"status": "completed", "replayed": 1, "successful": 0, "failed": 0}
+        assert mock_send.call_count == 0
+        assert client.get("/admin/dead-letters/").json() == []
+        assert client.get("/admin/dead-letters/?status=discarded").json()[0]["id"] == letter.id
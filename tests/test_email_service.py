@@ -0,0 +1,219 @@
+import asyncio
+import random
+import socket
+import time
+import httpx
+import pytest
+import requests
+from app.core.config import settings
+from app.services import email_service, newsletter_service
+from app.models import Event, User
+from app.services.campaign_runner import AsyncCampaignRunner, OutgoingEmail
+from app.services.email_service import BatchingSender, RateLimiter, is_connect_failure, parse_retry_after, build_postmark_message, send_batch_via_postmark, send_email_async, send_email_via_postmark
+from app.services.task_service import RetryQueue
+
+
+class TestPostmarkTransport:
+    """Тестирование отправки через Postmark на локальной замене API"""
+
+    def test_single_send(self, postmark_server):
+        assert send_email_via_postmark("a@example.com", "Тема", "<p>Привет</p>").sent is True
+        assert send_email_via_postmark("invalid@example.com", "Тема", "<p>Привет</p>").sent is False
+        path, body = postmark_server.requests[0]
+        assert path == "/email"
+        assert body["To"] == "a@example.com"
+        assert body["TextBody"] == "Привет\n\n"
+
+    def test_connections_are_reused(self, postmark_server):
+        for i in range(3):
+            assert send_email_via_postmark(f"user{i}@example.com", "Тема", "<p></p>").sent is True
+        stats = email_service.postmark_client.stats()
+        assert stats["requests"] == 3
+        assert stats["connections_opened"] == 1
+        assert stats["connections_reused"] == 2
+
+    def test_dropped_connection_is_not_resent(self, postmark_server):
+        # Сервер прочитал письмо и оборвал соединение: повтор мог бы отправить его дважды
+        postmark_server.drop_connections = 1
+        assert send_email_via_postmark("a@example.com", "Тема", "<p></p>").sent is False
+        assert postmark_server.drop_connections == 0
+        assert postmark_server.requests == []
+
+    def test_client_does_not_retry(self, postmark_server):
+        # Единственный слой повторов — очередь конвейера (EMAIL_MAX_ATTEMPTS)
+        retry = email_service.postmark_client.start().get_adapter(settings.POSTMARK_API_URL).max_retries
+        assert retry.total == 0
+
+    def test_throttled_send_slows_down_and_is_left_to_the_runner(self, postmark_server):
+        postmark_server.throttle_next = 1
+        result = send_email_via_postmark("a@example.com", "Тема", "<p></p>")
+        assert result.sent is False and result.retryable is True
+        assert postmark_server.requests == []
+        stats = email_service.rate_limiter.stats()
+        assert stats["throttled"] == 1
+        assert stats["current_rate"] < stats["rate"]
+
+    def test_failures_are_marked_retryable(self, postmark_server):
+        # Отклонённый адрес и обрыв после отправки не повторяются, отказ в подключении — повторяется
+        assert send_email_via_postmark("invalid@example.com", "Тема", "<p></p>").retryable is False
+        postmark_server.drop_connections = 1
+        result = send_email_via_postmark("a@example.com", "Тема", "<p></p>")
+        assert result.sent is False and result.retryable is False
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            closed_url = f"http://127.0.0.1:{sock.getsockname()[1]}/email"
+        with pytest.raises(requests.exceptions.ConnectionError) as refused:
+            requests.post(closed_url, timeout=1)
+        assert is_connect_failure(refused.value) is True
+        with pytest.raises(httpx.ConnectError) as refused_async:
+            httpx.post(closed_url, timeout=1)
+        assert is_connect_failure(refused_async.value) is True
+        assert is_connect_failure(requests.exceptions.ReadTimeout()) is False
+        assert is_connect_failure(httpx.ReadTimeout("timeout")) is False
+
+    def test_accepted_batch_is_not_retried(self, postmark_server, monkeypatch):
+        # Пакет принят (200), но ответ не разобран или неполон — повтор отправил бы письма дважды
+        class Response:
+            status_code = 200
+
+            def __init__(self, body):
+                self.body = body
+
+            def json(self):
+                if self.body is None:
+                    raise ValueError("Expecting value")
+                return self.body
+
+        messages = [build_postmark_message(to, "Тема", "<p></p>") for to in ["a@example.com", "b@example.com"]]
+        monkeypatch.setattr(email_service.postmark_client, "post", lambda path, payload: Response(None))
+        assert [(r.sent, r.retryable) for r in send_batch_via_postmark(messages)] == [(False, False)] * 2
+        monkeypatch.setattr(email_service.postmark_client, "post", lambda path, payload: Response([{"ErrorCode": 0}]))
+        assert [(r.sent, r.retryable) for r in send_batch_via_postmark(messages)] == [(True, False), (False, False)]
+
+    def test_batch_send_parses_per_message_results(self, postmark_server, monkeypatch):
+        monkeypatch.setattr("app.services.email_service.POSTMARK_BATCH_LIMIT", 2)
+        messages = [
+            build_postmark_message(to, "Тема", "<p>Привет</p>")
+            for to in ["a@example.com", "invalid@example.com", "b@example.com"]
+        ]
+        assert [result.sent for result in send_batch_via_postmark(messages)] == [True, False, True]
+        assert [(path, len(body)) for path, body in postmark_server.requests] == [
+            ("/email/batch", 2), ("/email/batch", 1)
+        ]
+
+    def test_batching_sender_flushes_by_size_and_time(self, postmark_server):
+        with BatchingSender(batch_size=2, flush_interval=0.05) as sender:
+            full = [sender.submit(f"user{i}@example.com", "Тема", "<p></p>") for i in range(2)]
+            assert all(future.result(timeout=5) for future in full)
+            # Неполный пакет уходит по таймеру, без явного flush
+            partial = sender.submit("invalid@example.com", "Тема", "<p></p>")
+            assert partial.result(timeout=5).sent is False
+        assert [len(body) for _, body in postmark_server.requests] == [2, 1]
+
+    def test_campaign_with_batch_transport(self, postmark_server, db_session, monkeypatch, add_subscriber, add_event):
+        monkeypatch.setattr(settings, "EMAIL_BATCH_SIZE", 10)
+        for email in ["one@example.com", "two@example.com", "invalid@example.com"]:
+            add_subscriber(email)
+        add_event("Концерт", "https://example.com/batch1")
+
+        assert newsletter_service.send_newsletter_to_all_users(db_session) == (2, 1)
+        assert [path for path, _ in postmark_server.requests] == ["/email/batch"]
+        assert len(postmark_server.requests[0][1]) == 3
+
+    def test_async_send(self, postmark_server):
+        assert asyncio.run(send_email_async("a@example.com", "Тема", "<p>Привет</p>")).sent is True
+        assert asyncio.run(send_email_async("invalid@example.com", "Тема", "<p></p>")).sent is False
+        assert [body["To"] for _, body in postmark_server.requests] == ["a@example.com", "invalid@example.com"]
+
+    def test_campaign_with_async_transport(self, postmark_server, db_session, monkeypatch, add_subscriber, add_event):
+        monkeypatch.setattr(settings, "EMAIL_TRANSPORT", "async")
+        for email in ["one@example.com", "two@example.com", "invalid@example.com"]:
+            add_subscriber(email)
+        add_event("Концерт", "https://example.com/async1")
+
+        assert newsletter_service.send_newsletter_to_all_users(db_session) == (2, 1)
+        assert sorted(body["To"] for _, body in postmark_server.requests) == [
+            "invalid@example.com", "one@example.com", "two@example.com"
+        ]
+
+
+class TestAsyncCampaignRunner:
+    """Тестирование асинхронного конвейера рассылки"""
+
+    def test_keeps_many_sends_in_flight(self):
+        state = {"in_flight": 0, "peak": 0}
+
+        async def send(to_email, subject, html_body, text_body=None):
+            state["in_flight"] += 1
+            state["peak"] = max(state["peak"], state["in_flight"])
+            await asyncio.sleep(0.05)
+            state["in_flight"] -= 1
+            return True
+
+        jobs = [(User(id=i, email=f"user{i}@example.com"), [Event(id=1)]) for i in range(300)]
+        runner = AsyncCampaignRunner(send=send, max_in_flight=100)
+        started = time.monotonic()
+        result = asyncio.run(runner.run(
+            jobs,
+            render=lambda user, events: OutgoingEmail(user.id, user.email, "s", "<p></p>", [1]),
+            on_result=lambda email, sent: None
+        ))
+
+        assert result == (300, 0)
+        assert state["peak"] == 100
+        # 300 писем по 50 мс при 100 одновременных — около трёх «волн», а не 15 секунд
+        assert time.monotonic() - started < 2
+
+
+class TestRateLimiter:
+    """Тестирование token bucket"""
+
+    def test_sustained_rate_after_burst(self):
+        limiter = RateLimiter(rate=50, burst=5)
+        started = time.monotonic()
+        for _ in range(15):
+            limiter.acquire()
+        # 5 писем сразу, ещё 10 — со скоростью 50 в секунду
+        assert 0.15 <= time.monotonic() - started < 1
+
+    def test_throttle_pauses_and_recovers(self):
+        limiter = RateLimiter(rate=100, burst=10, recovery_ratio=0.5)
+        limiter.throttle(retry_after=0.1)
+        assert limiter.current_rate == 50
+        started = time.monotonic()
+        asyncio.run(limiter.acquire_async())
+        assert time.monotonic() - started >= 0.09
+        limiter.recover()
+        assert limiter.current_rate == 100
+
+    def test_parse_retry_after(self):
+        assert parse_retry_after("3") == 3.0
+        assert parse_retry_after(None) is None
+        assert parse_retry_after("soon") is None
+        assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+class TestRetryQueue:
+    """Тестирование очереди повторов"""
+
+    def test_backoff_grows_exponentially_up_to_cap(self):
+        queue = RetryQueue(max_attempts=10, base_delay=1, max_delay=8, rng=random.Random(1))
+        for attempts, ceiling in [(1, 1), (2, 2), (3, 4), (4, 8), (9, 8)]:
+            delays = [queue.backoff(attempts) for _ in range(200)]
+            assert 0 <= min(delays) and max(delays) <= ceiling
+            # Разброс: задержки не совпадают, и заметная часть — выше половины потолка
+            assert max(delays) > ceiling / 2
+        assert queue.can_retry(9) and not queue.can_retry(10)
+
+    def test_items_are_released_when_due(self):
+        now = [0.0]
+        queue = RetryQueue(max_attempts=5, base_delay=1, max_delay=1, rng=random.Random(2), clock=lambda: now[0])
+        delays = {item: queue.schedule(item, 1) for item in ["a", "b", "c"]}
+        assert queue.next_delay() == min(delays.values())
+        first = min(delays, key=delays.get)
+        now[0] = delays[first]
+        assert queue.pop_due() == [first]
+        now[0] = 1.0
+        assert sorted(queue.pop_due()) == sorted(set(delays) - {first})
+        assert len(queue) == 0 and queue.next_delay() is None
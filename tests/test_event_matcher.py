@@ -1,4 +1,5 @@
 import pytest
+from sqlalchemy import event as sa_event
 from app.utils.event_matcher import get_events_for_user
 from app.models import Event, User, user_categories, user_cities
 
@@ -45,3 +46,203 @@ def test_get_events_for_user_with_category(db_session):
     assert len(events) == 1
     assert events[0].category == "music"
     assert events[0].title == "Концерт"
+
+
+def test_event_index_matches_get_events_for_user(db_session, add_subscriber):
+    """Индекс событий рассылки подбирает то же, что и get_events_for_user"""
+    from datetime import datetime, timedelta
+    from app.utils.event_index import EventIndex, load_user_preferences
+
+    base = datetime(2024, 12, 1, 12, 0, 0)
+    events = [
+        Event(title="Рок", category="music;party", city="Будва", url="https://example.com/i1"),
+        Event(title="Джаз", category="music", city="Котор", url="https://example.com/i2"),
+        Event(title="Митап", category="tech", city="Подгорица", url="https://example.com/i3"),
+        Event(title="Лекция", category="tech;music", city=None, url="https://example.com/i4"),
+        Event(title="Выставка", category="art", city="Бар", url="https://example.com/i5"),
+    ]
+    for i, event in enumerate(events):
+        event.dates = ["2024-12-01"]
+        event.languages = ["RU"]
+        event.created_at = base + timedelta(hours=i)
+    db_session.add_all(events)
+
+    preferences = {
+        "a@example.com": (["music"], ["Будва", "Другие города"]),
+        "b@example.com": (["tech", "art"], ["Подгорица", "Бар"]),
+        "c@example.com": (["music"], ["Другие города"]),
+        "d@example.com": (["art"], ["Москва"]),
+        "e@example.com": ([], ["Будва"]),
+    }
+    users = [
+        add_subscriber(email, categories, cities)
+        for email, (categories, cities) in preferences.items()
+    ]
+
+    index = EventIndex.load(db_session)
+    loaded = load_user_preferences(db_session)
+    for user in users:
+        expected = [e.id for e in get_events_for_user(db_session, user)]
+        assert [e.id for e in index.match_user(loaded, user)] == expected
+
+    assert [e.title for e in index.match(["music"], ["Будва", "Другие города"])] == ["Джаз", "Рок"]
+
+    # Битовые маски дают тот же результат, в том числе при пачках по одному
+    from app.utils.bitmask_matcher import BitmaskMatcher
+    bitmask = BitmaskMatcher.load(db_session)
+    by_bitmask = bitmask.match_many(loaded, chunk_size=1)
+    for user in users:
+        assert [e.id for e in by_bitmask.get(user.id, [])] == [e.id for e in index.match_user(loaded, user)]
+
+    # Пакетный подбор даёт тот же результат при любом размере пачки
+    from app.utils.event_matcher import get_events_for_users
+    for chunk_size in (1, 2, 1000):
+        batch = get_events_for_users(db_session, [u.id for u in users], chunk_size=chunk_size)
+        for user in users:
+            assert [e.id for e in batch[user.id]] == [e.id for e in index.match_user(loaded, user)]
+
+
+def test_build_segments_groups_identical_preferences(db_session, add_subscriber):
+    """Пользователи с одинаковыми предпочтениями попадают в один сегмент"""
+    from app.utils.event_index import EventIndex, load_user_preferences
+    from app.utils.segmentation import build_segments
+
+    db_session.add(Event(
+        title="Концерт", category="music", city="Будва",
+        dates=["2024-12-01"], languages=["RU"], url="https://example.com/s1"
+    ))
+    preferences = {
+        "s1@example.com": (["music", "tech"], ["Будва"]),
+        "s2@example.com": (["tech", "music"], ["Будва"]),
+        "s3@example.com": (["art"], ["Будва"]),
+    }
+    users = [
+        add_subscriber(email, categories, cities)
+        for email, (categories, cities) in preferences.items()
+    ]
+
+    segments = build_segments(users, load_user_preferences(db_session), EventIndex.load(db_session))
+
+    assert len(segments) == 2
+    assert [u.email for u in segments[0].users] == ["s1@example.com", "s2@example.com"]
+    assert [e.title for e in segments[0].events] == ["Концерт"]
+    assert segments[1].events == []
+
+
+def test_get_events_for_user_matches_whole_categories(db_session, add_subscriber):
+    """Категории сравниваются целиком через event_categories, без подстрок"""
+    user = add_subscriber("tokens@example.com")
+    event1 = Event(title="Мюзикл", category="musical", city="Будва",
+                   dates=["2024-12-01"], languages=["RU"], url="https://example.com/t1")
+    event2 = Event(title="Фестиваль", category="food; music", city="Будва",
+                   dates=["2024-12-01"], languages=["RU"], url="https://example.com/t2")
+    db_session.add_all([event1, event2])
+    db_session.commit()
+
+    assert [e.title for e in get_events_for_user(db_session, user)] == ["Фестиваль"]
+
+    # Изменение категории пересобирает строки event_categories
+    event1.category = "music;theatre"
+    event2.category = "food"
+    db_session.commit()
+    assert [e.title for e in get_events_for_user(db_session, user)] == ["Мюзикл"]
+
+
+def test_event_city_bucket_assigned_on_write(db_session):
+    """Корзина города вычисляется при записи и обновляется вместе с городом"""
+    main = Event(title="A", city=" Будва", dates=[], languages=[], url="https://example.com/b1")
+    other = Event(title="B", city="Котор", dates=[], languages=[], url="https://example.com/b2")
+    empty = Event(title="C", city=None, dates=[], languages=[], url="https://example.com/b3")
+    db_session.add_all([main, other, empty])
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)
+    sa_event.listen(db_session.get_bind(), "before_cursor_execute", listener)
+    try:
+        db_session.commit()
+    finally:
+        sa_event.remove(db_session.get_bind(), "before_cursor_execute", listener)
+    # Таблица основных городов читается один раз на flush, а не на событие
+    assert sum("FROM cities" in statement for statement in statements) == 1
+
+    assert main.city_bucket == "Будва"
+    assert other.city_bucket == "Другие города"
+    assert empty.city_bucket is None
+
+    other.city = "Тиват"
+    db_session.commit()
+    assert other.city_bucket == "Тиват"
+
+
+def test_parse_event_dates():
+    """Свободные строки дат переводятся в диапазон [starts_at, ends_at]"""
+    from datetime import datetime
+    from app.utils.date_parser import parse_event_dates
+
+    reference = datetime(2025, 7, 1)
+    assert parse_event_dates(["24 августа"], reference) == (
+        datetime(2025, 8, 24), datetime(2025, 8, 24, 23, 59, 59, 999999)
+    )
+    starts_at, ends_at = parse_event_dates(["24-26 августа"], reference)
+    assert (starts_at.day, ends_at.day) == (24, 26)
+    # Дата без года, давно прошедшая относительно reference, — следующий год
+    assert parse_event_dates(["15 января"], datetime(2025, 11, 1))[0] == datetime(2026, 1, 15)
+    assert parse_event_dates(["2024-12-01", "2024-12-05"])[1].date().day == 5
+    assert parse_event_dates(["скоро"]) == (None, None)
+
+
+def test_get_events_for_user_upcoming_window(db_session, add_subscriber):
+    """Окно since отсекает прошедшие события, события без дат остаются"""
+    from datetime import datetime
+
+    user = add_subscriber("window@example.com")
+    past = Event(title="Прошло", category="music", city="Будва",
+                 dates=["2020-01-01"], languages=[], url="https://example.com/w1")
+    future = Event(title="Будет", category="music", city="Будва",
+                   dates=["2099-01-01"], languages=[], url="https://example.com/w2")
+    undated = Event(title="Без даты", category="music", city="Будва",
+                    dates=[], languages=[], url="https://example.com/w3")
+    db_session.add_all([past, future, undated])
+    db_session.commit()
+
+    assert past.starts_at == datetime(2020, 1, 1)
+    assert len(get_events_for_user(db_session, user)) == 3
+    titles = {e.title for e in get_events_for_user(db_session, user, since=datetime(2025, 1, 1))}
+    assert titles == {"Будет", "Без даты"}
+
+
+def test_match_cache_lru_versioning_and_persistence(tmp_path, db_session):
+    """Кэш подбора: LRU с лимитами, инвалидация версией, сохранение на диск"""
+    from app.utils.match_cache import MatchCache
+
+    sig_a = (("music",), ("Будва",))
+    sig_b = (("tech",), ("Бар",))
+    sig_c = (("art",), ("Тиват",))
+
+    cache = MatchCache(max_entries=2, max_event_ids=5, path=str(tmp_path / "cache.json"))
+    assert cache.get(sig_a) is None
+    cache.put(sig_a, [1, 2])
+    cache.put(sig_b, [3])
+    assert cache.get(sig_a) == (1, 2)
+    cache.put(sig_c, [4])  # вытесняет давно не использованный sig_b
+    assert cache.get(sig_b) is None
+    cache.put(sig_b, [5, 6, 7])  # превышение лимита id вытесняет sig_a
+    assert cache.get(sig_a) is None
+    stats = cache.stats()
+    assert stats["event_ids"] <= 5 and stats["evictions"] == 2
+    assert stats["hits"] == 1 and stats["misses"] == 3
+
+    cache.save()
+    restored = MatchCache(max_entries=2, max_event_ids=5, path=cache.path)
+    restored.load()
+    assert restored.sync(db_session) == 0
+    assert restored.get(sig_b) == (5, 6, 7)
+
+    # События изменил другой процесс: версия в БД новее сохранённой
+    MatchCache(max_entries=2, max_event_ids=5).bump_version(db_session)
+    assert restored.get(sig_b) == (5, 6, 7)
+    assert restored.sync(db_session) == 1
+    assert restored.get(sig_b) is None
+
+    restored.load()
+    restored.sync(db_session)
+    assert restored.get(sig_b) is None
@@ -342,3 +342,97 @@ class TestEventsAPI:
         assert len(data) == 1
         assert data[0]["title"] == "Концерт в Москве"
 
+
+    def test_get_recommended_events_batch(self, client, db_session, add_subscriber):
+        """POST /events/users/recommended - подбор событий для нескольких пользователей"""
+        event = Event(
+            title="Концерт в Будве",
+            category="music",
+            city="Будва",
+            dates=["2024-12-01"],
+            languages=["RU"],
+            url="https://example.com/batch"
+        )
+        db_session.add(event)
+        db_session.commit()
+        fan = add_subscriber("fan@example.com")
+        other = add_subscriber("other@example.com", categories=(), cities=())
+
+        response = client.post("/events/users/recommended", json=[fan.id, other.id])
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert [e["title"] for e in data[str(fan.id)]] == ["Концерт в Будве"]
+        assert data[str(other.id)] == []
+
+        response = client.post("/events/users/recommended?chunk_size=1", json=[fan.id, other.id])
+        assert response.json() == data
+        for chunk_size in (0, -1):
+            response = client.post(f"/events/users/recommended?chunk_size={chunk_size}", json=[fan.id])
+            assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    def test_recommended_events_cache_invalidated_on_create(self, client, db_session, add_subscriber):
+        """GET /events/user/{id}/recommended - новое событие сбрасывает кэш подбора"""
+        user = add_subscriber("cached@example.com")
+
+        assert client.get(f"/events/user/{user.id}/recommended").json() == []
+        hits = client.get("/events/match-cache/stats").json()["hits"]
+        assert client.get(f"/events/user/{user.id}/recommended").json() == []
+        assert client.get("/events/match-cache/stats").json()["hits"] == hits + 1
+
+        response = client.post("/events/", json={
+            "title": "Новый концерт",
+            "category": "music",
+            "city": "Будва",
+            "dates": ["2024-12-01"],
+            "languages": ["RU"],
+            "url": "https://example.com/cached"
+        })
+        assert response.status_code == status.HTTP_200_OK
+
+        data = client.get(f"/events/user/{user.id}/recommended").json()
+        assert [e["title"] for e in data] == ["Новый концерт"]
+
+    def test_create_event_enqueues_pending_digest(self, client, db_session, add_subscriber):
+        """POST /events/ - новое предстоящее событие попадает в очередь дайджеста подписчиков"""
+        from app.models import pending_digest
+
+        user = add_subscriber("digest@example.com")
+
+        for url, dates in [("https://example.com/future", ["2099-06-01"]), ("https://example.com/past", ["2001-06-01"])]:
+            response = client.post("/events/", json={
+                "title": "Концерт",
+                "category": "music",
+                "city": "Будва",
+                "dates": dates,
+                "languages": ["RU"],
+                "url": url
+            })
+            assert response.status_code == status.HTTP_200_OK
+            if url.endswith("future"):
+                future_id = response.json()["id"]
+
+        rows = db_session.execute(pending_digest.select()).fetchall()
+        assert [(row.user_id, row.event_id) for row in rows] == [(user.id, future_id)]
+
+    def test_update_event_requeues_pending_digest(self, client, db_session, add_subscriber):
+        """PUT /events/{id} - очередь дайджеста пересобирается по новым категориям события"""
+        from app.models import pending_digest
+
+        user = add_subscriber("digest-update@example.com")
+
+        event_id = client.post("/events/", json={
+            "title": "Матч",
+            "category": "sport",
+            "city": "Будва",
+            "dates": ["2099-06-01"],
+            "languages": ["RU"],
+            "url": "https://example.com/requeue"
+        }).json()["id"]
+        assert db_session.execute(pending_digest.select()).fetchall() == []
+
+        assert client.put(f"/events/{event_id}", json={"category": "music"}).status_code == status.HTTP_200_OK
+        rows = db_session.execute(pending_digest.select()).fetchall()
+        assert [(row.user_id, row.event_id) for row in rows] == [(user.id, event_id)]
+
+        assert client.put(f"/events/{event_id}", json={"category": "sport"}).status_code == status.HTTP_200_OK
+        assert db_session.execute(pending_digest.select()).fetchall() == []
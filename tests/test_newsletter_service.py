@@ -0,0 +1,592 @@
+import datetime
+import threading
+import time
+import pytest
+from unittest.mock import Mock, patch
+from jinja2 import DictLoader, Environment, ModuleLoader
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from app.database import Base, insert_ignore
+from app.models import Event, NewsletterCampaign, NewsletterDeadLetter, NewsletterDelivery, NewsletterLog, User, delivered_events, pending_digest
+from app.core.config import settings
+from app.services import newsletter_service, template_service
+from app.services.delivery_history import record_delivered_events
+from app.services.outbox import CampaignAlreadyRunning, campaign_lease, claim_campaign, claim_pending, enqueue_deliveries, open_campaign, record_delivery
+from app.services.subscribers import count_subscribed_users, iter_subscribed_users, shard_boundaries
+from app.tasks.newsletter import plan_shards, send_newsletter_sharded
+from app.services import render_pool
+from app.services.campaign_runner import CampaignRunner, OutgoingEmail, render_in_process
+from app.services.email_service import SendResult
+from app.services.render_pool import RenderPool
+from app.services.task_service import RetryQueue
+from app.utils.html_minify import minify_html
+from app.utils.render_cache import FragmentCache, RenderCache
+from app.services.digest_service import enqueue_pending_digests
+
+
+class TestNewsletterService:
+    """Тестирование рассылки из newsletter_service"""
+
+    @patch('app.services.newsletter_service.send_email_via_postmark', return_value=True)
+    def test_campaign_sends_only_new_events(self, mock_send, db_session, add_subscriber, add_event):
+        """Повторная рассылка не отправляет уже доставленные события"""
+        user = add_subscriber("history@example.com")
+        first = add_event("Первое", "https://example.com/h1")
+
+        assert newsletter_service.send_newsletter_to_all_users(db_session) == (1, 0)
+        assert mock_send.call_count == 1
+        delivered = db_session.execute(delivered_events.select()).fetchall()
+        assert [(row.user_id, row.event_id) for row in delivered] == [(user.id, first.id)]
+
+        # Ничего нового — письмо не отправляется
+        mock_send.reset_mock()
+        newsletter_service.send_newsletter_to_all_users(db_session)
+        assert mock_send.call_count == 0
+
+        # Новое событие — в письме только оно
+        add_event("Второе", "https://example.com/h2")
+        newsletter_service.send_newsletter_to_users(db_session, [user.id])
+        assert mock_send.call_count == 1
+        html_body = mock_send.call_args[1]["html_body"]
+        assert "Второе" in html_body
+        assert "Первое" not in html_body
+
+    @patch('app.services.newsletter_service.send_email_via_postmark', return_value=False)
+    def test_campaign_failed_send_is_not_recorded(self, mock_send, db_session, add_subscriber, add_event):
+        """Неудачная отправка учитывается как ошибка и не попадает в историю"""
+        add_subscriber("fail@example.com")
+        add_event("Событие", "https://example.com/f1")
+
+        assert newsletter_service.send_newsletter_to_all_users(db_session) == (0, 1)
+        assert db_session.execute(delivered_events.select()).fetchall() == []
+        log = db_session.query(NewsletterLog).order_by(NewsletterLog.id.desc()).first()
+        assert log.failed_sends == 1
+
+    @patch('app.services.newsletter_service.send_email_via_postmark', return_value=True)
+    def test_pending_digest_delivery(self, mock_send, db_session, add_subscriber, add_event):
+        """Новые события попадают в очередь подходящих пользователей и уходят одним дайджестом"""
+        user = add_subscriber("digest@example.com")
+        other = add_subscriber("digest-other@example.com", categories=("theatre",))
+        first = add_event("Концерт", "https://example.com/d1")
+        second = add_event("Спектакль", "https://example.com/d2", category="theatre; music")
+        add_event("Лекция", "https://example.com/d3", category="science")
+
+        assert enqueue_pending_digests(db_session, [first, second]) == 3
+        rows = db_session.execute(pending_digest.select()).fetchall()
+        assert sorted((row.user_id, row.event_id) for row in rows) == sorted([
+            (user.id, first.id), (user.id, second.id), (other.id, second.id)
+        ])
+
+        assert newsletter_service.send_pending_digests(db_session, [user.id]) == (1, 0)
+        html_body = mock_send.call_args[1]["html_body"]
+        assert "Концерт" in html_body and "Спектакль" in html_body
+        rows = db_session.execute(pending_digest.select()).fetchall()
+        assert [(row.user_id, row.event_id) for row in rows] == [(other.id, second.id)]
+
+        # Доставленное событие не уходит повторно, даже если снова оказалось в очереди
+        db_session.execute(pending_digest.insert().values(user_id=user.id, event_id=first.id))
+        db_session.commit()
+        mock_send.reset_mock()
+        assert newsletter_service.send_pending_digests(db_session) == (1, 0)
+        assert mock_send.call_count == 1
+        assert mock_send.call_args[1]["to_email"] == "digest-other@example.com"
+        assert db_session.execute(pending_digest.select()).fetchall() == []
+
+    @patch('app.services.newsletter_service.send_email_via_postmark', return_value=False)
+    def test_pending_digest_kept_on_failure(self, mock_send, db_session, add_subscriber, add_event):
+        """При неудачной отправке события остаются в очереди"""
+        add_subscriber("digest-fail@example.com")
+        event = add_event("Событие", "https://example.com/df1")
+        enqueue_pending_digests(db_session, [event])
+
+        assert newsletter_service.send_pending_digests(db_session) == (0, 1)
+        assert len(db_session.execute(pending_digest.select()).fetchall()) == 1
+        assert db_session.execute(delivered_events.select()).fetchall() == []
+
+    @patch('app.services.newsletter_service.send_email_via_postmark', return_value=True)
+    def test_campaign_streams_subscribers_in_chunks(self, mock_send, db_session, monkeypatch, add_subscriber, add_event):
+        """Подписчики читаются пачками по keyset, итоговое число — из COUNT"""
+        monkeypatch.setattr(settings, "MATCH_CHUNK_SIZE", 2)
+        users = [add_subscriber(f"chunk{i}@example.com") for i in range(5)]
+        users[2].is_subscribed = False
+        db_session.commit()
+        add_event("Концерт", "https://example.com/c1")
+
+        chunks = [[user.id for user in chunk] for chunk in iter_subscribed_users(db_session)]
+        expected = [user.id for user in users if user.is_subscribed]
+        assert chunks == [expected[:2], expected[2:]]
+        assert count_subscribed_users(db_session) == 4
+
+        assert newsletter_service.send_newsletter_to_all_users(db_session) == (4, 0)
+        assert sorted(call[1]["to_email"] for call in mock_send.call_args_list) == sorted(
+            user.email for user in users if user.is_subscribed
+        )
+        log = db_session.query(NewsletterLog).order_by(NewsletterLog.id.desc()).first()
+        assert log.total_users == 4
+
+    @patch('app.services.newsletter_service.send_email_via_postmark', return_value=True)
+    def test_interrupted_campaign_resumes_from_outbox(self, mock_send, db_session, add_subscriber, add_event):
+        """Прерванная кампания продолжается: отправленным повторно не пишем, новых добавляем"""
+        users = [add_subscriber(f"resume{i}@example.com") for i in range(3)]
+        event = add_event("Концерт", "https://example.com/r1")
+
+        # Состояние после сбоя: первому письмо ушло, второму было в отправке, третьего не успели записать
+        campaign = open_campaign(db_session, "all")
+        enqueue_deliveries(db_session, campaign.id, {users[0].id: [event.id], users[1].id: [event.id]})
+        statuses = {users[0].id: "sent", users[1].id: "sending"}
+        for delivery in db_session.query(NewsletterDelivery).filter(NewsletterDelivery.campaign_id == campaign.id):
+            delivery.status = statuses[delivery.user_id]
+        db_session.execute(delivered_events.insert().values(user_id=users[0].id, event_id=event.id))
+        db_session.commit()
+
+        assert newsletter_service.send_newsletter_to_all_users(db_session) == (3, 0)
+        assert sorted(call[1]["to_email"] for call in mock_send.call_args_list) == [
+            "resume1@example.com", "resume2@example.com"
+        ]
+        deliveries = db_session.query(NewsletterDelivery).filter(NewsletterDelivery.campaign_id == campaign.id).all()
+        assert {d.user_id: d.status for d in deliveries} == {user.id: "sent" for user in users}
+        db_session.refresh(campaign)
+        assert campaign.status == "completed"
+        log = db_session.query(NewsletterLog).order_by(NewsletterLog.id.desc()).first()
+        assert (log.total_users, log.successful_sends, log.failed_sends) == (3, 3, 0)
+
+        # Следующий запуск — новая кампания, писать некому
+        mock_send.reset_mock()
+        assert newsletter_service.send_newsletter_to_all_users(db_session) == (3, 0)
+        assert mock_send.call_count == 0
+
+    def test_concurrent_runs_claim_disjoint_deliveries(self, db_session, add_subscriber, add_event):
+        """Два запуска одной кампании не получают одно письмо; брошенная аренда истекает"""
+        users = [add_subscriber(f"lease{i}@example.com") for i in range(4)]
+        event = add_event("Концерт", "https://example.com/l1")
+        campaign = open_campaign(db_session, "all")
+        enqueue_deliveries(db_session, campaign.id, {user.id: [event.id] for user in users})
+
+        first = claim_pending(db_session, campaign.id, chunk_size=2, owner="run-a")
+        second = claim_pending(db_session, campaign.id, chunk_size=2, owner="run-b")
+        claimed_a = [next(first)[0].id, next(first)[0].id]
+        claimed_b = [user.id for user, _ in second]
+        assert sorted(claimed_a + claimed_b) == sorted(user.id for user in users)
+        assert not set(claimed_a) & set(claimed_b)
+
+        # Новый запуск не трогает письма в живой аренде, но забирает просроченные
+        assert list(claim_pending(db_session, campaign.id, owner="run-c")) == []
+        db_session.query(NewsletterDelivery).filter(NewsletterDelivery.claimed_by == "run-a").update(
+            {NewsletterDelivery.heartbeat_at: datetime.datetime.utcnow() - datetime.timedelta(hours=1)}
+        )
+        db_session.commit()
+        assert sorted(user.id for user, _ in claim_pending(db_session, campaign.id, owner="run-c")) == sorted(claimed_a)
+
+    def test_campaign_lease_is_exclusive_until_it_expires(self, db_session):
+        """Кампанию выполняет один запуск; брошенную аренду забирает следующий"""
+        campaign = open_campaign(db_session, "all")
+        assert claim_campaign(db_session, campaign.id, "run-a") is True
+        assert claim_campaign(db_session, campaign.id, "run-b") is False
+        with pytest.raises(CampaignAlreadyRunning):
+            with campaign_lease(db_session, campaign.id):
+                pass
+
+        campaign.heartbeat_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        db_session.commit()
+        with campaign_lease(db_session, campaign.id, "run-b") as owner:
+            db_session.refresh(campaign)
+            assert (owner, campaign.claimed_by) == ("run-b", "run-b")
+        db_session.refresh(campaign)
+        assert campaign.claimed_by is None
+
+    def test_resumed_campaign_rechecks_recipients_and_events(self, db_session, add_subscriber, add_event):
+        """При продолжении кампании отписавшиеся, прошедшие и доставленные события отсеиваются"""
+        users = [add_subscriber(f"recheck{i}@example.com") for i in range(3)]
+        event = add_event("Концерт", "https://example.com/rc1")
+        past = Event(title="Прошло", category="music", city="Будва", dates=["2001-06-01"], url="https://example.com/rc2")
+        db_session.add(past)
+        db_session.commit()
+        campaign = open_campaign(db_session, "all")
+        enqueue_deliveries(db_session, campaign.id, {user.id: [event.id, past.id] for user in users})
+
+        users[0].is_subscribed = False
+        db_session.execute(delivered_events.insert().values(user_id=users[1].id, event_id=event.id))
+        db_session.commit()
+
+        claimed = [(user.id, [e.id for e in events]) for user, events in claim_pending(db_session, campaign.id)]
+        assert claimed == [(users[2].id, [event.id])]
+        statuses = {d.user_id: d.status for d in db_session.query(NewsletterDelivery).filter(NewsletterDelivery.campaign_id == campaign.id)}
+        assert statuses == {users[0].id: "skipped", users[1].id: "skipped", users[2].id: "sending"}
+
+    def test_recording_an_already_delivered_event_is_idempotent(self, db_session, add_subscriber, add_event):
+        """Событие, уже доставленное другим путём, не ломает запись результата"""
+        user = add_subscriber("twice@example.com")
+        event = add_event("Концерт", "https://example.com/t1")
+        campaign = open_campaign(db_session, "all")
+        enqueue_deliveries(db_session, campaign.id, {user.id: [event.id]})
+
+        record_delivered_events(db_session, user.id, [event.id])
+        record_delivered_events(db_session, user.id, [event.id])
+        record_delivery(db_session, campaign.id, user.id, [event.id], SendResult(True))
+        delivered = db_session.execute(delivered_events.select()).fetchall()
+        assert [(row.user_id, row.event_id) for row in delivered] == [(user.id, event.id)]
+        assert db_session.query(NewsletterDelivery).filter(NewsletterDelivery.campaign_id == campaign.id).one().status == "sent"
+
+    def test_insert_ignore_without_on_conflict_skips_existing_rows(self, db_session, monkeypatch, add_subscriber, add_event):
+        """На СУБД без ON CONFLICT дубликаты пропускаются через точки сохранения"""
+        user = add_subscriber("fallback@example.com")
+        first = add_event("Концерт", "https://example.com/f1")
+        second = add_event("Лекция", "https://example.com/f2")
+        monkeypatch.setattr(db_session.get_bind().dialect, "name", "mysql")
+
+        insert_ignore(db_session, delivered_events, [{"user_id": user.id, "event_id": first.id}])
+        insert_ignore(db_session, delivered_events, [
+            {"user_id": user.id, "event_id": first.id},
+            {"user_id": user.id, "event_id": second.id},
+        ])
+        delivered = db_session.execute(delivered_events.select()).fetchall()
+        assert sorted(row.event_id for row in delivered) == [first.id, second.id]
+
+    def test_failed_result_handler_rolls_back(self):
+        db = Mock()
+        handler = newsletter_service.rollback_on_error(db, Mock(side_effect=RuntimeError("db error")))
+        with pytest.raises(RuntimeError):
+            handler(OutgoingEmail(1, "rollback@example.com", "s", "<p></p>"), SendResult(True))
+        db.rollback.assert_called_once_with()
+
+    def test_stale_campaign_is_expired_not_resumed(self, db_session):
+        campaign = open_campaign(db_session, "all")
+        campaign.created_at = datetime.datetime.utcnow() - datetime.timedelta(days=3)
+        db_session.commit()
+
+        fresh = open_campaign(db_session, "all")
+        db_session.refresh(campaign)
+        assert fresh.id != campaign.id
+        assert campaign.status == "expired"
+        assert open_campaign(db_session, "all").id == fresh.id
+
+    def test_failed_send_goes_to_dead_letters_and_replays(self, db_session, add_subscriber, add_event):
+        """Неотправленное письмо попадает в dead-letter и отправляется повторно"""
+        user = add_subscriber("dead@example.com")
+        event = add_event("Событие", "https://example.com/d1")
+
+        rejected = SendResult(False, error="422: Inactive recipient")
+        with patch('app.services.newsletter_service.send_email_via_postmark', return_value=rejected):
+            assert newsletter_service.send_newsletter_to_all_users(db_session) == (0, 1)
+        letter = db_session.query(NewsletterDeadLetter).one()
+        assert (letter.user_id, letter.event_ids, letter.attempts) == (user.id, [event.id], 1)
+        assert letter.last_error == "422: Inactive recipient"
+        assert letter.campaign_id is not None
+
+        with patch('app.services.newsletter_service.send_email_via_postmark', return_value=SendResult(True)) as mock_send:
+            assert newsletter_service.replay_dead_letters(db_session) == (1, 1, 0)
+            assert mock_send.call_args[1]["to_email"] == "dead@example.com"
+            # Письмо уже доставлено — повторять нечего
+            assert newsletter_service.replay_dead_letters(db_session) == (0, 0, 0)
+        db_session.refresh(letter)
+        assert (letter.status, letter.attempts) == ("replayed", 2)
+        delivered = db_session.execute(delivered_events.select()).fetchall()
+        assert [(row.user_id, row.event_id) for row in delivered] == [(user.id, event.id)]
+
+
+class TestRenderCache:
+    """Тестирование рендеринга писем по сегментам"""
+
+    def test_spliced_emails_match_full_render(self):
+        template = newsletter_service.jinja_env.get_template('newsletter.html')
+        events = [
+            Event(id=1, title="Джаз & блюз", description="<b>живьём</b>", city="Будва", url="https://example.com/j"),
+            Event(id=2, title="Кино", photo="https://example.com/p.jpg", url="https://example.com/k"),
+        ]
+        users = [
+            User(id=1, email="anna@example.com", unsubscribe_token="t-1"),
+            User(id=2, email="o'neil&<co>@example.com", unsubscribe_token="t\"2"),
+            User(id=3, email="boris@example.com", unsubscribe_token=None),
+        ]
+        cache = RenderCache(template, newsletter_service.RECIPIENT_KEYS)
+        now = datetime.datetime.now()
+        for user in users:
+            for user_events in (events, events[:1]):
+                cached = newsletter_service.render_email_cached(cache, now, user, user_events)
+                full = newsletter_service.render_email(template, user, user_events)
+                assert cached.html_body == full.html_body
+                assert cached.event_ids == full.event_ids
+        assert cache.stats() == {"enabled": True, "entries": 2, "hits": 4, "misses": 2, "fallbacks": 0}
+
+    def test_falls_back_when_template_transforms_recipient_fields(self):
+        env = Environment(loader=DictLoader({
+            "filtered.html": "<p>{{ name|upper }}</p>{% for e in events %}{{ e }}{% endfor %}",
+            "conditional.html": "{% if name == 'anna' %}Hi{% else %}Hello{% endif %}, {{ name }}",
+        }), autoescape=True)
+        for name in ("filtered.html", "conditional.html"):
+            template = env.get_template(name)
+            cache = RenderCache(template, ["name"])
+            for person in ("anna", "boris", "anna"):
+                context = {"name": person, "events": [1, 2]}
+                assert cache.render(context, key="same") == template.render(context)
+            assert cache.enabled is False
+
+    def test_event_cards_render_once_per_campaign(self, monkeypatch):
+        rendered = []
+        render_event_card = newsletter_service.render_event_card
+
+        def render_card(event):
+            rendered.append(event.id)
+            return render_event_card(event)
+
+        monkeypatch.setattr(newsletter_service, "render_event_card", render_card)
+        monkeypatch.setattr(settings, "RENDER_CACHE_MAX_ENTRIES", 0)
+        template = newsletter_service.jinja_env.get_template('newsletter.html')
+        events = [Event(id=i, title=f"Событие {i}", url=f"https://example.com/{i}") for i in range(1, 4)]
+        render = newsletter_service.make_renderer(template)
+        for i, user_events in enumerate([events, events[:2], events[1:], events]):
+            user = User(id=i, email=f"user{i}@example.com", unsubscribe_token=str(i))
+            full = newsletter_service.render_email(template, user, user_events).html_body
+            assert render(user, user_events).html_body == full
+        assert sorted(rendered) == [1, 2, 3]
+
+    def test_fragment_cache_keys_on_event_version(self):
+        rendered = []
+        cache = FragmentCache(lambda event: rendered.append(event.title) or event.title)
+        event = Event(id=1, title="v1", created_at=datetime.datetime(2026, 1, 1))
+        assert cache(event) == cache(event) == "v1"
+        event.title, event.updated_at = "v2", datetime.datetime(2026, 1, 2)
+        assert cache(event) == "v2"
+        # Без id события не кэшируются
+        assert cache(Event(title="draft")) == cache(Event(title="draft")) == "draft"
+        assert rendered == ["v1", "v2", "draft", "draft"]
+        assert cache.stats() == {"entries": 2, "hits": 1, "misses": 2}
+
+
+class TestEmailTemplates:
+    """Тестирование окружения шаблонов писем"""
+
+    def test_shared_environment_without_auto_reload(self):
+        assert newsletter_service.jinja_env is template_service.email_env
+        assert template_service.email_env.auto_reload is False
+        assert template_service.precompile_email_templates() == 3
+        assert template_service.email_env.cache is not None
+        assert len(template_service.email_env.cache) >= 2
+
+    def test_compiled_templates_render_identically(self, tmp_path, monkeypatch):
+        template_service.compile_email_templates(str(tmp_path))
+        monkeypatch.setattr(settings, "EMAIL_TEMPLATES_COMPILED_DIR", str(tmp_path))
+        monkeypatch.setattr(settings, "TEMPLATES_BYTECODE_CACHE", False)
+        compiled_env = template_service.create_email_environment()
+        assert isinstance(compiled_env.loader, ModuleLoader)
+
+        events = [Event(id=1, title="Джаз & блюз", city="Будва", url="https://example.com/j")]
+        user = User(id=1, email="anna@example.com", unsubscribe_token="t-1")
+        compiled = newsletter_service.render_email(compiled_env.get_template('newsletter.html'), user, events)
+        source = newsletter_service.render_email(newsletter_service.jinja_env.get_template('newsletter.html'), user, events)
+        assert compiled.html_body == source.html_body
+
+    def test_minify_html(self):
+        source = (
+            "<table>\n    <!-- Шапка -->\n    <tr>\n        <td style=\"a: 1;  b: 2\">\n"
+            "            Привет,\n            {{ name }}!\n        </td>\n    </tr>\n"
+            "    {% for event in events %}\n    <p>{{ event }}</p>\n    {% endfor %}\n"
+            "    <!--[if mso]><td></td><![endif]-->\n</table>\n"
+        )
+        assert minify_html(source) == (
+            "<table><tr><td style=\"a: 1;  b: 2\"> Привет, {{ name }}! </td></tr>"
+            "{% for event in events %}<p>{{ event }}</p>{% endfor %}<!--[if mso]><td></td><![endif]--></table>"
+        )
+
+    def test_email_is_minified_and_has_text_part(self):
+        template = newsletter_service.jinja_env.get_template('newsletter.html')
+        source = template_service.EMAIL_TEMPLATES_DIR.joinpath('newsletter.html').read_text(encoding='utf-8')
+        events = [Event(id=1, title="Джаз & блюз", description="Живьём", city="Будва", url="https://example.com/j")]
+        user = User(id=1, email="o'neil@example.com", unsubscribe_token="t-1")
+
+        email = newsletter_service.render_email(template, user, events, text_template=newsletter_service.text_template_for(template))
+        assert "\n" not in email.html_body and "<!--" not in email.html_body
+        assert len(email.html_body) < len(source)
+        assert "Джаз &amp; блюз" in email.html_body
+        assert email.text_body.startswith("Привет, o'neil!")
+        assert "Джаз & блюз\n📍 Будва\nЖивьём\nhttps://example.com/j\n" in email.text_body
+        assert "/api/unsubscribe/token/t-1/" in email.text_body
+
+        # Рендерер кампании собирает обе части из кэша, результат тот же
+        render = newsletter_service.make_renderer(template)
+        for _ in range(2):
+            cached = render(user, events)
+            assert (cached.html_body, cached.text_body) == (email.html_body, email.text_body)
+
+
+class TestCampaignRunner:
+    """Тестирование конвейера рассылки"""
+
+    def test_bounded_in_flight_and_accounting(self):
+        """Число писем в пуле не превышает лимит, результаты учитываются как в NewsletterLog"""
+        lock = threading.Lock()
+        state = {"in_flight": 0, "peak": 0}
+
+        def send(to_email, subject, html_body, text_body=None):
+            with lock:
+                state["in_flight"] += 1
+                state["peak"] = max(state["peak"], state["in_flight"])
+            time.sleep(0.01)
+            with lock:
+                state["in_flight"] -= 1
+            if to_email.startswith("boom"):
+                raise RuntimeError("connection reset")
+            return not to_email.startswith("bad")
+
+        users = [User(id=i, email=f"user{i}@example.com") for i in range(20)]
+        users += [User(id=100, email="bad@example.com"), User(id=101, email="boom@example.com")]
+        users += [User(id=102, email="empty@example.com")]
+        jobs = [(user, [] if user.id == 102 else [Event(id=1)]) for user in users]
+
+        results = {}
+        runner = CampaignRunner(send=send, workers=4, max_in_flight=4)
+        successful, failed = runner.run(
+            jobs,
+            render=lambda user, events: OutgoingEmail(user.id, user.email, "s", "<p></p>", [1]),
+            on_result=lambda email, result: results.__setitem__(email.user_id, bool(result))
+        )
+
+        assert (successful, failed) == (21, 2)
+        assert state["peak"] <= 4
+        assert (runner.rendered, runner.bytes_per_message()) == (22, len("<p></p>"))
+        assert results[100] is False and results[101] is False
+        assert 102 not in results
+
+    def test_transient_failures_are_retried_without_blocking(self):
+        """Временные ошибки откладываются с задержкой, остальные письма тем временем уходят"""
+        calls = []
+
+        def send(to_email, subject, html_body, text_body=None):
+            calls.append(to_email)
+            if to_email == "down@example.com" or (to_email == "flaky@example.com" and calls.count(to_email) == 1):
+                return SendResult(False, error="503: Service Unavailable", retryable=True)
+            if to_email == "invalid@example.com":
+                return SendResult(False, error="300: Invalid 'To' address.")
+            return SendResult(True)
+
+        emails = ["flaky@example.com", "down@example.com", "invalid@example.com"]
+        emails += [f"user{i}@example.com" for i in range(5)]
+        jobs = [(User(id=i, email=email), [Event(id=1)]) for i, email in enumerate(emails)]
+
+        results = {}
+        runner = CampaignRunner(
+            send=send,
+            workers=2,
+            max_in_flight=2,
+            retry_queue=RetryQueue(max_attempts=3, base_delay=0.05, max_delay=0.05)
+        )
+        successful, failed = runner.run(
+            jobs,
+            render=lambda user, events: OutgoingEmail(user.id, user.email, "s", "<p></p>", [1]),
+            on_result=lambda email, result: results.__setitem__(email.to_email, (bool(result), email.attempts))
+        )
+
+        assert (successful, failed) == (6, 2)
+        assert results["flaky@example.com"] == (True, 2)
+        assert results["down@example.com"] == (False, 3)
+        # Постоянная ошибка не повторяется
+        assert results["invalid@example.com"] == (False, 1)
+        assert calls.count("down@example.com") == 3
+        assert runner.retried == 3
+
+
+class TestRenderPool:
+    """Тестирование рендеринга писем в пуле процессов"""
+
+    def make_jobs(self):
+        events = [
+            Event(id=i, title=f"Событие {i} & Co", description="<b>живьём</b>", city="Будва",
+                  url=f"https://example.com/{i}", updated_at=datetime.datetime(2026, 1, i))
+            for i in range(1, 5)
+        ]
+        return [
+            (User(id=i, email=f"user{i}@example.com", unsubscribe_token=f"t-{i}"), [] if i == 3 else events[i % 3:])
+            for i in range(1, 9)
+        ]
+
+    def test_pool_renders_in_order_like_in_process(self):
+        template = newsletter_service.jinja_env.get_template('newsletter.html')
+        render = newsletter_service.make_renderer(template)
+        jobs = self.make_jobs()
+        pool = RenderPool(render, template_name=template.name, workers=2, chunk_size=3, min_jobs=1)
+
+        rendered = list(pool(jobs))
+        assert pool.pooled == len(jobs)
+        assert [(user.id, events) for user, events, _ in rendered] == [(user.id, events) for user, events in jobs]
+        for (user, events, email), (_, _, expected) in zip(rendered, render_in_process(jobs, render)):
+            if not events:
+                assert email is None
+                continue
+            assert (email.user_id, email.to_email, email.event_ids) == (expected.user_id, expected.to_email, expected.event_ids)
+            assert email.html_body == expected.html_body
+            assert email.text_body == expected.text_body
+
+    def test_small_campaign_renders_in_process(self, monkeypatch):
+        def no_pool(*args, **kwargs):
+            raise AssertionError("process pool started for a small campaign")
+
+        monkeypatch.setattr(render_pool, "ProcessPoolExecutor", no_pool)
+        render = lambda user, events: OutgoingEmail(user.id, user.email, "s", f"<p>{len(events)}</p>", [1])
+        jobs = self.make_jobs()
+        runner = CampaignRunner(send=lambda **kwargs: True, workers=2)
+        results = {}
+        successful, failed = runner.run(
+            jobs,
+            render=render,
+            on_result=lambda email, result: results.__setitem__(email.user_id, email.html_body),
+            render_stage=RenderPool(render, workers=2, min_jobs=len(jobs) + 1)
+        )
+        assert (successful, failed) == (8, 0)
+        assert results == {user.id: f"<p>{len(events)}</p>" for user, events in jobs if events}
+
+
+class TestShardedNewsletter:
+    """Тестирование рассылки по процессам-шардам"""
+
+    def test_shard_boundaries_cover_all_subscribers(self, db_session, add_subscriber):
+        users = [add_subscriber(f"bound{i}@example.com") for i in range(7)]
+        ranges = shard_boundaries(db_session, 3)
+        assert len(ranges) == 3
+        assert ranges[0][0] == 0 and ranges[-1][1] is None
+        covered = [
+            user.id for user in users
+            for after_id, upto_id in ranges
+            if user.id > after_id and (upto_id is None or user.id <= upto_id)
+        ]
+        assert sorted(covered) == sorted(user.id for user in users)
+
+    def test_unfinished_shards_resume_with_their_stored_ranges(self, db_session, add_subscriber):
+        users = [add_subscriber(f"resume{i}@example.com") for i in range(6)]
+        ranges = shard_boundaries(db_session, 3)
+        assert [kind for kind, _, _ in plan_shards(db_session, 3)] == ["shard:0/3", "shard:1/3", "shard:2/3"]
+
+        # Шард 1 упал; за это время подписались новые пользователи и границы сдвинулись
+        campaign = open_campaign(db_session, "shard:1/3", id_range=ranges[1])
+        for i in range(6):
+            add_subscriber(f"late{i}@example.com")
+        assert shard_boundaries(db_session, 3)[1] != ranges[1]
+        assert plan_shards(db_session, 3) == [("shard:1/3", *ranges[1])]
+        assert open_campaign(db_session, "shard:1/3", id_range=ranges[1]).id == campaign.id
+        assert open_campaign(db_session, "shard:1/3", id_range=(0, users[0].id)).id != campaign.id
+
+    def test_sharded_campaign_merges_counters(self, tmp_path, monkeypatch, postmark_server, add_subscriber, add_event):
+        # Процессам-шардам нужна общая БД, поэтому — файл SQLite вместо памяти
+        url = f"sqlite:///{tmp_path}/shards.db"
+        engine = create_engine(url)
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        for i in range(5):
+            add_subscriber(f"shard{i}@example.com", db=db)
+        add_subscriber("invalid@example.com", db=db)
+        add_event("Концерт", "https://example.com/s1", db=db)
+
+        monkeypatch.setenv("DATABASE_URL", url)
+        monkeypatch.setenv("POSTMARK_API_URL", settings.POSTMARK_API_URL)
+        monkeypatch.setenv("POSTMARK_API_TOKEN", "test-token")
+        monkeypatch.setenv("EMAIL_TEST_MODE", "false")
+        try:
+            assert send_newsletter_sharded(db, shards=3) == (5, 1)
+            assert sorted(body["To"] for _, body in postmark_server.requests) == sorted(
+                [f"shard{i}@example.com" for i in range(5)] + ["invalid@example.com"]
+            )
+            log = db.query(NewsletterLog).one()
+            assert (log.total_users, log.successful_sends, log.failed_sends) == (6, 5, 1)
+            assert db.query(NewsletterCampaign).count() == 3
+        finally:
+            db.close()
+            engine.dispose()
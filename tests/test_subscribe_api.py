@@ -30,6 +30,24 @@ class TestSubscribeAPI:
         assert response.status_code == status.HTTP_200_OK
         assert "User categories updated successfully" in response.json()["message"]
 
+    def test_subscribe_queues_upcoming_events_for_digest(self, client, db_session):
+        from app.models import Event, pending_digest
+
+        event = Event(title="Концерт", category="music", city="Будва", dates=["2099-06-01"], url="https://example.com/sub-digest")
+        db_session.add(event)
+        db_session.commit()
+        data = {"email": "digest@example.com", "categories": ["music"], "cities": ["Будва"], "subscription_types": []}
+        assert client.post("/api/subscribe/", json=data).status_code == status.HTTP_200_OK
+        user = db_session.query(User).filter(User.email == "digest@example.com").one()
+        rows = db_session.execute(pending_digest.select()).fetchall()
+        assert [(row.user_id, row.event_id) for row in rows] == [(user.id, event.id)]
+
+        # Смена городов пересобирает очередь
+        data["cities"] = ["Котор"]
+        assert client.post("/api/subscribe/", json=data).status_code == status.HTTP_200_OK
+        assert db_session.execute(pending_digest.select()).fetchall() == []
+
+
 class TestUnsubscribeAPI:
     def test_unsubscribe_success(self, client, db_session):
         user = User(email="unsubscribe@example.com", is_subscribed=True)